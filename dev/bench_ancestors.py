@@ -0,0 +1,54 @@
+'''
+Compares get_nth_parent_hash on a synthetic 20k-share chain between the
+randomized DistanceSkipList and the AncestorIndex that trackers now use.
+
+usage: python dev/bench_ancestors.py [SHARES] [QUERIES]
+'''
+
+from __future__ import division
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from p2pool.util import forest
+
+class Share(object):
+    __slots__ = ['hash', 'previous_hash']
+    def __init__(self, hash, previous_hash):
+        self.hash = hash
+        self.previous_hash = previous_hash
+
+def timed(f, queries):
+    start = time.time()
+    for start_hash, n in queries:
+        f(start_hash, n)
+    return time.time() - start
+
+def main():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    start = time.time()
+    tracker = forest.Tracker(Share(i, i - 1 if i else None) for i in xrange(length))
+    print 'built %i-share tracker and ancestor index in %.2fs' % (length, time.time() - start)
+
+    skip_list = forest.DistanceSkipList(tracker)
+    index = forest.AncestorIndex(tracker)
+
+    for name, queries in [
+        ('random depth', [(h, random.randrange(h + 1)) for h in (random.randrange(length) for i in xrange(count))]),
+        ('depth <= 100', [(h, random.randrange(min(h, 100) + 1)) for h in (random.randrange(length) for i in xrange(count))]),
+        ('from the head', [(length - 1, random.randrange(length)) for i in xrange(count)]),
+    ]:
+        cold = timed(skip_list, queries)
+        warm = timed(skip_list, queries)
+        indexed = timed(index, queries)
+        print '%-14s skip list: %8.0f queries/s (first pass %8.0f)  ancestor index: %8.0f queries/s' % (
+            name, count/warm, count/cold, count/indexed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+'''
+Measures WorkerBridge.get_work calls/s when new work has to be handed to 1,
+100 and 1000 miners at once, with the work template shared between them (as
+get_work does now) and rebuilt for every call (as it used to be).
+
+The sharechain and bitcoind work are synthetic: SHARES shares paying out to
+a few hundred addresses, and a block template of TXS transactions.
+
+usage: python dev/bench_get_work.py [SHARES] [TXS]
+'''
+
+from __future__ import division
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from p2pool import data as p2pool_data, p2p, work
+from p2pool.bitcoin import data as bitcoin_data, networks
+from p2pool.util import math, variable
+
+net = math.Object(
+    PARENT=networks.nets['bitcoin'],
+    SHARE_PERIOD=30,
+    CHAIN_LENGTH=400,
+    REAL_CHAIN_LENGTH=400,
+    TARGET_LOOKBEHIND=200,
+    SPREAD=3,
+    IDENTIFIER='cca5e24ec6408b1e'.decode('hex'),
+    MIN_TARGET=0,
+    MAX_TARGET=2**256-1,
+    PERSIST=False,
+)
+
+def make_sharechain(length):
+    tracker = p2pool_data.OkayTracker(net)
+    previous_share_hash = None
+    for i in xrange(length):
+        share_info, gentx, other_tx_hashes, get_share = p2pool_data.Share.generate_transaction(
+            tracker=tracker,
+            share_data=dict(
+                previous_share_hash=previous_share_hash,
+                coinbase='\x01\x02',
+                nonce=i,
+                pubkey_hash=random.randrange(300),
+                subsidy=5000000000,
+                donation=655,
+                stale_info=None,
+                desired_version=16,
+            ),
+            block_target=2**240,
+            desired_timestamp=1400000000 + 30*i,
+            desired_target=2**256-1,
+            ref_merkle_link=dict(branch=[], index=0),
+            desired_other_transaction_hashes_and_fees=[],
+            net=net,
+            known_txs={},
+            base_subsidy=5000000000,
+        )
+        for nonce in xrange(i, 2**32, 2**20): # the share target lets about 1 in 65536 hashes fail
+            try:
+                share = get_share(dict(
+                    version=0x20000000,
+                    previous_block=1234,
+                    timestamp=1400000000 + 30*i,
+                    bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**240),
+                    nonce=nonce,
+                    merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.hash256(bitcoin_data.tx_id_type.pack(gentx)), bitcoin_data.calculate_merkle_link([None] + other_tx_hashes, 0)),
+                ))
+            except p2p.PeerMisbehavingError:
+                continue
+            break
+        tracker.add(share)
+        previous_share_hash = share.hash
+    return tracker, previous_share_hash
+
+def make_worker_bridge(tracker, best, tx_count):
+    txs = [dict(version=1, tx_ins=[dict(previous_output=dict(hash=random.randrange(2**256), index=0), script='\x00'*100, sequence=2**32-2)],
+        tx_outs=[dict(value=10000, script='\x00'*25)]*2, lock_time=0) for i in xrange(tx_count)]
+    node = math.Object(
+        net=net,
+        tracker=tracker,
+        p2p_node=None,
+        best_share_var=variable.Variable(best),
+        best_block_header=variable.Variable(None),
+        bitcoind_work=variable.Variable(dict(
+            version=0x20000000,
+            previous_block=1234,
+            bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**240),
+            coinbaseflags='',
+            height=400000,
+            time=1400000000,
+            transactions=txs,
+            transaction_fees=[1000]*len(txs),
+            merkle_link=bitcoin_data.calculate_merkle_link([None] + [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in txs], 0),
+            subsidy=1250000000 + 1000*len(txs),
+            last_update=time.time() + 10**9,
+            rules=[],
+        )),
+    )
+    return work.WorkerBridge(node, 0, 0, [], 0, math.Object(donation_percentage=0, worker_fee=0, address=None, timeaddresses=0), None, None)
+
+def main():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    tx_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    start = time.time()
+    tracker, best = make_sharechain(length)
+    wb = make_worker_bridge(tracker, best, tx_count)
+    print 'built %i-share chain and %i-transaction block template in %.2fs' % (length, tx_count, time.time() - start)
+
+    for miners in [1, 100, 1000]:
+        pubkey_hashes = [random.randrange(2**160) for i in xrange(miners)]
+        res = {}
+        for name, shared in [('shared template', True), ('rebuilt per call', False)]:
+            wb._work_template = None # as if new_work_event had just fired
+            start = time.time()
+            for pubkey_hash in pubkey_hashes:
+                if not shared:
+                    wb._work_template = None
+                wb.get_work(pubkey_hash, None, None)
+            res[name] = miners/(time.time() - start)
+        print '%4i miners: shared template %7.0f get_work calls/s  rebuilt per call %7.0f get_work calls/s' % (
+            miners, res['shared template'], res['rebuilt per call'])
+
+if __name__ == '__main__':
+    main()
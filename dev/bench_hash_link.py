@@ -0,0 +1,56 @@
+'''
+Measures hash_link throughput with the pure-Python SHA-256 compression
+function and with the sha256_midstate C extension (if installed).
+
+usage: python dev/bench_hash_link.py [SECONDS]
+'''
+
+from __future__ import division
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from p2pool import data as p2pool_data
+from p2pool.bitcoin import sha256
+
+def random_bytes(length):
+    return ''.join(chr(random.randrange(2**8)) for i in xrange(length))
+
+def rate(f, duration):
+    count = 0
+    start = time.time()
+    while time.time() < start + duration:
+        f()
+        count += 1
+    return count/(time.time() - start)
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+    # a share's gentx prefix with ~100 payout outputs, followed by the ref hash, last_txout_nonce and lock_time
+    prefix = random_bytes(100*40) + p2pool_data.BaseShare.gentx_before_refhash
+    suffix = random_bytes(32 + 8 + 4)
+    hash_link = p2pool_data.prefix_to_hash_link(prefix, p2pool_data.BaseShare.gentx_before_refhash)
+
+    impls = [('python', sha256._process_blocks_python)]
+    if sha256._process_blocks_native is not None:
+        impls.append(('native', sha256._process_blocks_native))
+    else:
+        print 'sha256_midstate extension not installed; only measuring the pure-Python fallback'
+
+    old = sha256.process_blocks
+    try:
+        for name, impl in impls:
+            sha256.process_blocks = impl
+            check = rate(lambda: p2pool_data.check_hash_link(hash_link, suffix, p2pool_data.BaseShare.gentx_before_refhash), duration)
+            generate = rate(lambda: p2pool_data.prefix_to_hash_link(prefix, p2pool_data.BaseShare.gentx_before_refhash), duration)
+            print '%-6s check_hash_link: %9.1f shares/s  prefix_to_hash_link: %9.1f shares/s' % (name, check, generate)
+    finally:
+        sha256.process_blocks = old
+
+if __name__ == '__main__':
+    main()
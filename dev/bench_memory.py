@@ -0,0 +1,183 @@
+'''
+Measures how much memory a full sharechain (2*CHAIN_LENGTH+10 shares of the
+bitcoin network) takes in
+
+  standard: OkayTracker holding the usual share objects
+  cold:     OkayTracker holding the ColdShares that ColdShareTier leaves in
+            place of shares it moved to the share store
+  compact:  a prototype with one __slots__ object per share that keeps only
+            the packed share plus the fields the tracker needs (the rest is
+            decoded from the packed bytes on access), and a tracker core
+            that maps hashes to dense slots with parent/height/work kept in
+            array columns
+
+Each design is built in its own process and measured by the growth of its
+resident set size.
+
+usage: python dev/bench_memory.py [SHARES]
+'''
+
+from __future__ import division
+
+import array
+import gc
+import os
+import random
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from p2pool import data as p2pool_data, networks
+from p2pool.bitcoin import data as bitcoin_data
+
+net = networks.nets['bitcoin']
+
+def get_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+def make_template():
+    tracker = p2pool_data.OkayTracker(net)
+    share_info, gentx, other_tx_hashes, get_share = p2pool_data.NewShare.generate_transaction(
+        tracker=tracker,
+        share_data=dict(
+            previous_share_hash=None,
+            coinbase='\x01\x02' + '\x00'*40,
+            nonce=0,
+            pubkey_hash=0,
+            subsidy=1250000000,
+            donation=655,
+            stale_info=None,
+            desired_version=17,
+        ),
+        block_target=2**200,
+        desired_timestamp=1500000000,
+        desired_target=2**240,
+        ref_merkle_link=dict(branch=[], index=0),
+        desired_other_transaction_hashes_and_fees=[],
+        net=net,
+        known_txs={},
+        base_subsidy=1250000000,
+    )
+    share_type = p2pool_data.NewShare.get_dynamic_types(net)['share_type']
+    return share_type.pack(dict(
+        min_header=dict(version=0x20000000, previous_block=2**200, timestamp=1500000000, bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**200), nonce=0),
+        share_info=share_info,
+        ref_merkle_link=dict(branch=[], index=0),
+        last_txout_nonce=0,
+        hash_link=p2pool_data.prefix_to_hash_link(bitcoin_data.tx_id_type.pack(gentx)[:-32-8-4], p2pool_data.NewShare.gentx_before_refhash),
+        merkle_link=bitcoin_data.calculate_merkle_link([None] + other_tx_hashes, 0),
+    )), share_type
+
+def generate_shares(count):
+    # yields (packed contents, share) for a chain of shares with a typical number of transaction references
+    template, share_type = make_template()
+    previous_hash = None
+    for i in xrange(count):
+        contents = share_type.unpack(template)
+        share_info = contents['share_info']
+        share_info['share_data']['previous_share_hash'] = previous_hash
+        share_info['share_data']['pubkey_hash'] = random.randrange(2**160)
+        new_count = random.randrange(20)
+        share_info['new_transaction_hashes'] = [random.randrange(2**256) for j in xrange(new_count)]
+        share_info['transaction_hash_refs'] = sum(([0, j] for j in xrange(new_count)), []) + sum(([random.randrange(1, 100), random.randrange(20)] for j in xrange(random.randrange(150))), [])
+        share_info['segwit_data']['txid_merkle_link']['branch'] = [random.randrange(2**256) for j in xrange(10)]
+        contents['merkle_link']['branch'] = [random.randrange(2**256) for j in xrange(10)]
+        contents['min_header']['nonce'] = i
+        share = p2pool_data.load_share(dict(type=p2pool_data.NewShare.VERSION, contents=None), net, None, contents=contents, checked_hashes=(random.randrange(2**256), 0))
+        yield share_type.pack(contents), share
+        previous_hash = share.hash
+
+class CompactShare(object):
+    __slots__ = ['hash', 'previous_hash', 'target', 'timestamp', 'time_seen', 'peer_addr', 'packed', '_contents']
+
+    share_type = None
+
+    def __init__(self, share, packed):
+        self.hash = share.hash
+        self.previous_hash = share.previous_hash
+        self.target = share.target
+        self.timestamp = share.timestamp
+        self.time_seen = share.time_seen
+        self.peer_addr = share.peer_addr
+        self.packed = packed
+        self._contents = None
+
+    @property
+    def contents(self):
+        if self._contents is None:
+            self._contents = self.share_type.unpack(self.packed)
+        return self._contents
+
+class CompactTracker(object):
+    # appends only, in chain order; enough to hold the chain and answer height/work/parent lookups
+
+    def __init__(self):
+        self.slots = {} # hash -> slot
+        self.items = [] # slot -> share
+        self.parent = array.array('l') # slot -> parent's slot or -1
+        self.height = array.array('l')
+        self.work = array.array('d') # cumulative, approximate
+
+    def add(self, share):
+        slot = len(self.items)
+        parent = self.slots.get(share.previous_hash, -1)
+        self.slots[share.hash] = slot
+        self.items.append(share)
+        self.parent.append(parent)
+        self.height.append(self.height[parent] + 1 if parent >= 0 else 1)
+        self.work.append((self.work[parent] if parent >= 0 else 0) + bitcoin_data.target_to_average_attempts(share.target))
+
+    def get_height(self, share_hash):
+        return self.height[self.slots[share_hash]]
+
+    def get_nth_parent_hash(self, share_hash, n):
+        slot = self.slots[share_hash]
+        for i in xrange(n):
+            slot = self.parent[slot]
+        return self.items[slot].hash
+
+def measure(design, count):
+    shares = generate_shares(count)
+    gc.collect()
+    start = get_rss()
+    if design == 'standard':
+        tracker = p2pool_data.OkayTracker(net)
+        for packed, share in shares:
+            tracker.add(share)
+            tracker.verified.add(share)
+        head = share.hash
+        tracker.get_height(head), tracker.verified.get_height(head), tracker.get_work(head)
+    elif design == 'cold':
+        tracker = p2pool_data.OkayTracker(net)
+        for packed, share in shares:
+            share = p2pool_data.ColdShare(share, None)
+            tracker.add(share)
+            tracker.verified.add(share)
+        head = share.hash
+        tracker.get_height(head), tracker.verified.get_height(head), tracker.get_work(head)
+    elif design == 'compact':
+        CompactShare.share_type = share_type = p2pool_data.NewShare.get_dynamic_types(net)['share_type']
+        tracker = CompactTracker()
+        for packed, share in shares:
+            tracker.add(CompactShare(share, packed))
+        head = share.hash
+        tracker.get_height(head)
+    else:
+        raise ValueError('unknown design %r' % (design,))
+    del share
+    gc.collect()
+    return get_rss() - start
+
+def main():
+    if len(sys.argv) > 2:
+        print measure(sys.argv[2], int(sys.argv[1]))
+        return
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2*net.CHAIN_LENGTH + 10
+    for design in ['standard', 'cold', 'compact']:
+        rss = int(subprocess.check_output([sys.executable, os.path.abspath(__file__), str(count), design]))
+        print '%-8s %6.1f MB for %i shares (%5.0f bytes/share)' % (design, rss/1e6, count, rss/count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+Measures how many pseudoshare submissions/s the got_response callback of
+WorkerBridge.get_work handles, with the header checked against the share,
+block and merged targets before anything else (as got_response does now)
+and with the gentx rebuilt for every submission (as it used to be, forced
+here through p2pool.DEBUG, which also makes it try to submit a block, so
+bitcoind and the p2p node are left out).
+
+Submissions use random header nonces and non-zero coinbase nonces, like a
+stratum miner's, against a target that none of them meet.
+
+usage: python dev/bench_submit.py [SUBMISSIONS] [TXS]
+'''
+
+from __future__ import division
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data, helper
+from p2pool.util import math
+
+import bench_get_work
+from bench_get_work import make_sharechain, make_worker_bridge
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    tx_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    tracker, best = make_sharechain(100)
+    bench_get_work.net.PARENT = math.Object(**dict(bench_get_work.net.PARENT.__dict__, SANE_TARGET_RANGE=(2**100, 2**256-1)))
+    bench_get_work.net.MAX_TARGET = 2**200 # shares too hard to hit by chance
+    wb = make_worker_bridge(tracker, best, tx_count)
+    wb.node.bitcoind_work.value['bits'] = bitcoin_data.FloatingInteger.from_target_upper_bound(2**200)
+    wb.node.bitcoind_work.set(dict(wb.node.bitcoind_work.value))
+    wb.node.factory = wb.node.bitcoind = None
+    helper.submit_block = lambda *args, **kwargs: None
+
+    res = {}
+    for name, debug in [('fast path', False), ('gentx rebuilt', True)]:
+        x, got_response = wb.get_work(random.randrange(2**160), None, None)
+        nonces = [os.urandom(wb.COINBASE_NONCE_LENGTH) for i in xrange(count)]
+        headers = [dict(
+            version=x['version'],
+            previous_block=x['previous_block'],
+            merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.hash256(x['coinb1'] + nonce + x['coinb2']), x['merkle_link']),
+            timestamp=x['timestamp'],
+            bits=x['bits'],
+            nonce=random.randrange(2**32),
+        ) for nonce in nonces]
+        p2pool.DEBUG = debug
+        start = time.time()
+        for header, nonce in zip(headers, nonces):
+            got_response(header, 'user', nonce, 2**256-1) # every submission is a valid pseudoshare
+        res[name] = count/(time.time() - start)
+    p2pool.DEBUG = False
+    print 'fast path %7.0f submissions/s  gentx rebuilt %7.0f submissions/s (%i-transaction block template)' % (
+        res['fast path'], res['gentx rebuilt'], tx_count)
+
+if __name__ == '__main__':
+    main()
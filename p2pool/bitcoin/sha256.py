@@ -35,6 +35,20 @@ def process(state, chunk):
     
     return struct.pack('>8I', *((x + y) % 2**32 for x, y in zip(start_state, [a, b, c, d, e, f, g, h])))
 
+def _process_blocks_python(state, data):
+    assert len(data) % 64 == 0
+    for i in xrange(0, len(data), 64):
+        state = process(state, data[i:i + 64])
+    return state
+
+try:
+    from sha256_midstate import process_blocks as _process_blocks_native
+except ImportError:
+    _process_blocks_native = None
+
+# runs the compression function over whole blocks; uses the C extension in sha256_midstate/ when it is installed
+process_blocks = _process_blocks_native if _process_blocks_native is not None else _process_blocks_python
+
 
 initial_state = struct.pack('>8I', 0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
 
@@ -47,15 +61,12 @@ class sha256(object):
         self.update(data)
     
     def update(self, data):
-        state = self.state
         buf = self.buf + data
         
-        chunks = [buf[i:i + self.block_size] for i in xrange(0, len(buf) + 1, self.block_size)]
-        for chunk in chunks[:-1]:
-            state = process(state, chunk)
-        
-        self.state = state
-        self.buf = chunks[-1]
+        split = len(buf) - len(buf) % self.block_size
+        if split:
+            self.state = process_blocks(self.state, buf[:split])
+        self.buf = buf[split:]
         
         self.length += 8*len(data)
     
@@ -63,13 +74,9 @@ class sha256(object):
         return self.__class__(data, (self.state, self.buf, self.length))
     
     def digest(self):
-        state = self.state
         buf = self.buf + '\x80' + '\x00'*((self.block_size - 9 - len(self.buf)) % self.block_size) + struct.pack('>Q', self.length)
         
-        for chunk in [buf[i:i + self.block_size] for i in xrange(0, len(buf), self.block_size)]:
-            state = process(state, chunk)
-        
-        return state
+        return process_blocks(self.state, buf)
     
     def hexdigest(self):
         return self.digest().encode('hex')
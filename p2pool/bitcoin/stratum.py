@@ -1,5 +1,10 @@
+from __future__ import division
+
+import json
+import math
 import random
 import sys
+import time
 
 from twisted.internet import protocol, reactor
 from twisted.python import log
@@ -8,23 +13,166 @@ from p2pool.bitcoin import data as bitcoin_data, getwork
 from p2pool.util import expiring_dict, jsonrpc, pack
 
 
+class StratumJobs(object):
+    # work handed out to stratum sessions. sessions asking for the same work during one work event share a job: one
+    # inner get_work result, and mining.set_difficulty/mining.notify lines serialized once and written to each of them
+    
+    def __init__(self, wb):
+        self.wb = wb
+        
+        self.handlers = expiring_dict.ExpiringDict(300) # job id -> x, handler
+        self._jobs = {} # get_work args -> job id, lines
+        self._times = None
+    
+    def get_job(self, args):
+        if self._times != self.wb.new_work_event.times:
+            self._jobs = {}
+            self._times = self.wb.new_work_event.times
+        
+        if args not in self._jobs:
+            x, handler = self.wb.get_shared_work(*args)
+            jobid = str(random.randrange(2**128))
+            self.handlers[jobid] = x, handler
+            self._jobs[args] = jobid, ''.join(json.dumps(dict(jsonrpc='2.0', method=method, params=params, id=None)) + '\n' for method, params in [
+                ('mining.set_difficulty', [bitcoin_data.target_to_difficulty(x['share_target'])]),
+                ('mining.notify', [
+                    jobid, # jobid
+                    getwork._swap4(pack.IntType(256).pack(x['previous_block'])).encode('hex'), # prevhash
+                    x['coinb1'].encode('hex'), # coinb1
+                    x['coinb2'].encode('hex'), # coinb2
+                    [pack.IntType(256).pack(s).encode('hex') for s in x['merkle_link']['branch']], # merkle_branch
+                    getwork._swap4(pack.IntType(32).pack(x['version'])).encode('hex'), # version
+                    getwork._swap4(pack.IntType(32).pack(x['bits'].bits)).encode('hex'), # nbits
+                    getwork._swap4(pack.IntType(32).pack(x['timestamp'])).encode('hex'), # ntime
+                    True, # clean_jobs
+                ]),
+            ])
+        return self._jobs[args]
+
+class NotifyScheduler(object):
+    # sends every session its new work after a work event, sessions with the most hash rate first. work on a new block
+    # is written to all of them at once, since anything mined on the old one is wasted; share chain updates are spread
+    # over the next WINDOW seconds in batches of BATCH_SIZE so that they don't hold up the reactor
+    WINDOW = 1
+    BATCH_SIZE = 50
+    
+    def __init__(self, wb):
+        self.wb = wb
+        
+        self.sessions = set()
+        self._watch_id = None
+        self._previous_block = None
+        self._queue = []
+        self._call = None
+    
+    def add(self, session):
+        if not self.sessions:
+            self._watch_id = self.wb.new_work_event.watch(self._new_work)
+        self.sessions.add(session)
+    
+    def remove(self, session):
+        self.sessions.discard(session)
+        if not self.sessions:
+            self.wb.new_work_event.unwatch(self._watch_id)
+            self._queue = []
+            if self._call is not None and self._call.active():
+                self._call.cancel()
+    
+    def _new_work(self):
+        event_time = time.time()
+        if self._call is not None and self._call.active():
+            self._call.cancel() # sessions still waiting for the last event's work get this one's instead
+        self._queue = sorted(self.sessions, key=lambda session: session.get_hash_rate(), reverse=True)
+        
+        x = None
+        while x is None and self._queue:
+            x = self._queue.pop(0)._send_work(event_time)
+        if x is None:
+            return
+        
+        if x['previous_block'] != self._previous_block:
+            self._previous_block = x['previous_block']
+            self._send_batch(event_time, len(self._queue), 0)
+        else:
+            self._send_batch(event_time, self.BATCH_SIZE, self.WINDOW*self.BATCH_SIZE/(len(self._queue) + 1))
+    
+    def _send_batch(self, event_time, count, delay):
+        batch, self._queue = self._queue[:count], self._queue[count:]
+        for session in batch:
+            if session in self.sessions:
+                session._send_work(event_time)
+        if self._queue:
+            self._call = reactor.callLater(delay, self._send_batch, event_time, count, delay)
+
+class VarDiff(object):
+    # a session's pseudoshare target, aiming for a submission every INTERVAL seconds. the hash rate is measured over
+    # RETARGET_SUBMISSIONS accepted submissions (or RETARGET_TIME seconds, if they take longer) and averaged with a time
+    # constant of SMOOTHING seconds. difficulties are rounded to powers of two so that similar sessions share jobs
+    INTERVAL = 5
+    RETARGET_SUBMISSIONS = 12
+    RETARGET_TIME = 60
+    SMOOTHING = 180
+    
+    def __init__(self):
+        self.target = None # until the first retarget, get_work picks one from the whole node's hash rate
+        self.hash_rate = None
+        
+        self._start = time.time()
+        self._work = 0
+        self._count = 0
+    
+    def got_submission(self, work):
+        self._work += work
+        self._count += 1
+    
+    def update(self):
+        # returns whether target changed
+        now = time.time()
+        dt = now - self._start
+        if dt <= 0 or (self._count < self.RETARGET_SUBMISSIONS and dt < self.RETARGET_TIME):
+            return False
+        
+        rate = self._work/dt
+        self.hash_rate = rate if self.hash_rate is None else self.hash_rate + (rate - self.hash_rate)*(1 - math.exp(-dt/self.SMOOTHING))
+        self._start, self._work, self._count = now, 0, 0
+        
+        difficulty = bitcoin_data.target_to_difficulty(bitcoin_data.average_attempts_to_target(max(1, self.hash_rate*self.INTERVAL)))
+        target = bitcoin_data.difficulty_to_target(2**round(math.log(difficulty, 2)))
+        if target == self.target:
+            return False
+        self.target = target
+        return True
+
 class StratumRPCMiningProvider(object):
-    def __init__(self, wb, other, transport):
+    def __init__(self, wb, other, transport, jobs=None, notifier=None):
         self.wb = wb
         self.other = other
         self.transport = transport
+        self.jobs = jobs if jobs is not None else StratumJobs(wb)
+        self.notifier = notifier if notifier is not None else NotifyScheduler(wb)
         
         self.username = None
-        self.handler_map = expiring_dict.ExpiringDict(300)
+        self.extranonce1 = self.wb.get_session_nonce()
+        self.vardiff = VarDiff()
+        self.target = None # the one the miner was last told
+        self.job_targets = {} # job id -> target when it was sent, for the latest job
+        self.x = None
         
-        self.watch_id = self.wb.new_work_event.watch(self._send_work)
+        self.notifier.add(self)
+        self.wb.stratum_sessions[self.extranonce1] = self
+    
+    def get_hash_rate(self):
+        return self.vardiff.hash_rate or 0
+    
+    def uses_vardiff(self):
+        return self.username is None or '+' not in self.username # otherwise the username asks for a difficulty itself
     
     def rpc_subscribe(self, miner_version=None, session_id=None):
         reactor.callLater(0, self._send_work)
         
         return [
             ["mining.notify", "ae6812eb4cd7735a302a8a9dd95cf71f"], # subscription details
-            "", # extranonce1
+            self.extranonce1.encode('hex'), # extranonce1
             self.wb.COINBASE_NONCE_LENGTH, # extranonce2_size
         ]
     
@@ -33,36 +181,43 @@ class StratumRPCMiningProvider(object):
         
         reactor.callLater(0, self._send_work)
     
-    def _send_work(self):
+    def _send_work(self, event_time=None):
+        self.vardiff.update()
         try:
-            x, got_response = self.wb.get_work(*self.wb.preprocess_request('' if self.username is None else self.username))
+            jobid, lines = self.jobs.get_job(self.wb.preprocess_request('' if self.username is None else self.username, self.vardiff.target))
         except:
             log.err()
             self.transport.loseConnection()
+            return None
+        self.transport.write(lines)
+        if event_time is not None:
+            self.wb.notify_latency.add(time.time() - event_time)
+        self.x = self.jobs.handlers[jobid][0]
+        self.target = self.x['share_target']
+        self.job_targets = {jobid: self.target} # older jobs were cleared by this one
+        return self.x
+    
+    def _retarget(self):
+        # a new difficulty for the work the miner already has, without making it drop that work
+        if not self.vardiff.update() or not self.uses_vardiff() or self.x is None:
             return
-        jobid = str(random.randrange(2**128))
-        self.other.svc_mining.rpc_set_difficulty(bitcoin_data.target_to_difficulty(x['share_target'])).addErrback(lambda err: None)
-        self.other.svc_mining.rpc_notify(
-            jobid, # jobid
-            getwork._swap4(pack.IntType(256).pack(x['previous_block'])).encode('hex'), # prevhash
-            x['coinb1'].encode('hex'), # coinb1
-            x['coinb2'].encode('hex'), # coinb2
-            [pack.IntType(256).pack(s).encode('hex') for s in x['merkle_link']['branch']], # merkle_branch
-            getwork._swap4(pack.IntType(32).pack(x['version'])).encode('hex'), # version
-            getwork._swap4(pack.IntType(32).pack(x['bits'].bits)).encode('hex'), # nbits
-            getwork._swap4(pack.IntType(32).pack(x['timestamp'])).encode('hex'), # ntime
-            True, # clean_jobs
-        ).addErrback(lambda err: None)
-        self.handler_map[jobid] = x, got_response
+        low, high = self.x['share_target_range']
+        target = min(max(self.vardiff.target, low), high)
+        if target == self.target:
+            return
+        self.target = target
+        self.transport.write(json.dumps(dict(jsonrpc='2.0', method='mining.set_difficulty', params=[bitcoin_data.target_to_difficulty(target)], id=None)) + '\n')
     
     def rpc_submit(self, worker_name, job_id, extranonce2, ntime, nonce):
-        if job_id not in self.handler_map:
+        if job_id not in self.jobs.handlers:
             print >>sys.stderr, '''Couldn't link returned work's job id with its handler. This should only happen if this process was recently restarted!'''
             return False
-        x, got_response = self.handler_map[job_id]
+        x, handler = self.jobs.handlers[job_id]
+        target = self.target if self.target is not None else x['share_target']
+        target = max(target, self.job_targets.get(job_id, target)) # work on a job from before a retarget may still be for its easier target
         coinb_nonce = extranonce2.decode('hex')
         assert len(coinb_nonce) == self.wb.COINBASE_NONCE_LENGTH
-        new_packed_gentx = x['coinb1'] + coinb_nonce + x['coinb2']
+        new_packed_gentx = x['coinb1'] + self.extranonce1 + coinb_nonce + x['coinb2']
         header = dict(
             version=x['version'],
             previous_block=x['previous_block'],
@@ -71,14 +226,18 @@ class StratumRPCMiningProvider(object):
             bits=x['bits'],
             nonce=pack.IntType(32).unpack(getwork._swap4(nonce.decode('hex'))),
         )
-        return got_response(header, worker_name, coinb_nonce)
+        try:
+            return handler(header, worker_name, self.extranonce1 + coinb_nonce, target, self.vardiff.got_submission)
+        finally:
+            self._retarget()
     
     def close(self):
-        self.wb.new_work_event.unwatch(self.watch_id)
+        self.notifier.remove(self)
+        self.wb.stratum_sessions.pop(self.extranonce1, None)
 
 class StratumProtocol(jsonrpc.LineBasedPeer):
     def connectionMade(self):
-        self.svc_mining = StratumRPCMiningProvider(self.factory.wb, self.other, self.transport)
+        self.svc_mining = StratumRPCMiningProvider(self.factory.wb, self.other, self.transport, self.factory.jobs, self.factory.notifier)
     
     def connectionLost(self, reason):
         self.svc_mining.close()
@@ -88,3 +247,5 @@ class StratumServerFactory(protocol.ServerFactory):
     
     def __init__(self, wb):
         self.wb = wb
+        self.jobs = StratumJobs(wb)
+        self.notifier = NotifyScheduler(wb)
@@ -1,6 +1,7 @@
 from __future__ import division
 
 import StringIO
+import itertools
 import json
 import random
 import sys
@@ -9,7 +10,7 @@ from twisted.internet import defer
 
 import p2pool
 from p2pool.bitcoin import data as bitcoin_data, getwork
-from p2pool.util import expiring_dict, jsonrpc, pack, variable
+from p2pool.util import expiring_dict, jsonrpc, math, pack, variable
 
 class _Provider(object):
     def __init__(self, parent, long_poll):
@@ -27,8 +28,10 @@ class _GETableServer(jsonrpc.HTTPServer):
 class WorkerBridge(object):
     def __init__(self):
         self.new_work_event = variable.Event()
+        self.notify_latency = math.Histogram([.001, .002, .005, .01, .02, .05, .1, .2, .5, 1, 2, 5]) # seconds from new_work_event to work sent to a worker
+        self.stratum_sessions = {} # extranonce1 -> StratumRPCMiningProvider
     
-    def preprocess_request(self, request):
+    def preprocess_request(self, request, desired_pseudoshare_target=None):
         return request, # *args to self.compute
     
     def get_work(self, request):
@@ -113,12 +116,24 @@ class CachingWorkerBridge(object):
         
         self.COINBASE_NONCE_LENGTH = (inner.COINBASE_NONCE_LENGTH+1)//2
         self.new_work_event = inner.new_work_event
+        self.notify_latency = inner.notify_latency
+        self.stratum_sessions = inner.stratum_sessions
         self.preprocess_request = inner.preprocess_request
         
         self._my_bits = (self._inner.COINBASE_NONCE_LENGTH - self.COINBASE_NONCE_LENGTH)*8
         
         self._cache = {}
         self._times = None
+        self._session_nonces = itertools.count(random.randrange(2**self._my_bits))
+    
+    def get_session_nonce(self):
+        # handed to each stratum session as its extranonce1
+        return pack.IntType(self._my_bits).pack(self._session_nonces.next() % 2**self._my_bits)
+    
+    def get_shared_work(self, *args):
+        # inner work without a nonce of its own appended to coinb1, for sharing between sessions that are told apart by
+        # their get_session_nonce instead. its handler takes the whole inner coinbase nonce, session nonce first
+        return self._inner.get_work(*args)
     
     def get_work(self, *args):
         if self._times != self.new_work_event.times:
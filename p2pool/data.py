@@ -1,16 +1,21 @@
 from __future__ import division
 
+import bisect
 import hashlib
+import heapq
+import mmap
 import os
 import random
+import struct
 import sys
 import time
+import zlib
 
-from twisted.python import log
+from twisted.python import failure, log
 
 import p2pool
 from p2pool.bitcoin import data as bitcoin_data, script, sha256
-from p2pool.util import math, forest, pack
+from p2pool.util import math, forest, memoize, pack
 
 def parse_bip0034(coinbase):
     _, opdata = script.parse(coinbase).next()
@@ -46,23 +51,60 @@ share_type = pack.ComposedType([
     ('contents', pack.VarStrType()),
 ])
 
-def load_share(share, net, peer_addr):
+def load_share(share, net, peer_addr, contents=None, checked_hashes=None):
+    # contents and checked_hashes, (gentx_hash, pow_hash), can come from an earlier load of the same share, to skip
+    # unpacking it and checking its hash_link and PoW again. the packed contents are kept so that relaying the share
+    # doesn't pack it again
     assert peer_addr is None or isinstance(peer_addr, tuple)
-    if share['type'] < Share.VERSION:
+    cls = get_share_class(share['type'])
+    if contents is None:
+        contents = cls.get_dynamic_types(net)['share_type'].unpack(share['contents'])
+    return cls(net, peer_addr, contents, checked_hashes=checked_hashes, packed_contents=share['contents'])
+
+def get_share_class(share_type):
+    if share_type < Share.VERSION:
         from p2pool import p2p
         raise p2p.PeerMisbehavingError('sent an obsolete share')
-    elif share['type'] == Share.VERSION:
-        return Share(net, peer_addr, Share.get_dynamic_types(net)['share_type'].unpack(share['contents']))
-    elif share['type'] == NewShare.VERSION:
-        return NewShare(net, peer_addr, NewShare.get_dynamic_types(net)['share_type'].unpack(share['contents']))
+    elif share_type == Share.VERSION:
+        return Share
+    elif share_type == NewShare.VERSION:
+        return NewShare
     else:
-        raise ValueError('unknown share type: %r' % (share['type'],))
+        raise ValueError('unknown share type: %r' % (share_type,))
+
+def get_share_hash(share, net):
+    # the hash load_share would give this wrapped share, found with sha256 alone: share_info is hashed as it was
+    # received rather than decoded, and nothing is checked, so only use this to recognize shares that are already known
+    cls = get_share_class(share['type'])
+    t = cls.get_dynamic_types(net)
+    data = share['contents']
+    min_header, file = cls.small_block_header_type.read((data, 0))
+    share_info_start = file[1]
+    segwit_data = None
+    for key, type_ in t['share_info_type'].fields:
+        if key == 'segwit_data':
+            segwit_data, file = type_.read(file)
+        else:
+            file = type_.skip(file)
+    share_info_end = file[1]
+    rest = {}
+    for key, type_ in t['share_type'].fields[2:]:
+        rest[key], file = type_.read(file)
+    if file[1] != len(data):
+        raise pack.LateEnd()
+    
+    ref_hash = pack.IntType(256).pack(bitcoin_data.check_merkle_link(bitcoin_data.hash256(net.IDENTIFIER + data[share_info_start:share_info_end]), rest['ref_merkle_link']))
+    gentx_hash = check_hash_link(rest['hash_link'], ref_hash + pack.IntType(64).pack(rest['last_txout_nonce']) + pack.IntType(32).pack(0), cls.gentx_before_refhash)
+    merkle_root = bitcoin_data.check_merkle_link(gentx_hash, segwit_data['txid_merkle_link'] if is_segwit_activated(cls.VERSION, net) else rest['merkle_link'])
+    return bitcoin_data.hash256(bitcoin_data.block_header_type.pack(dict(min_header, merkle_root=merkle_root)))
 
 def is_segwit_activated(version, net):
     assert not(version is None or net is None)
     segwit_activation_version = getattr(net, 'SEGWIT_ACTIVATION_VERSION', 0)
     return version >= segwit_activation_version and segwit_activation_version > 0
 
+WITNESS_RESERVED_VALUE_STR = '[P2Pool]'*4
+
 DONATION_SCRIPT = '4104ffd03de44a6e11b9917f3a29f9443283d9871c9d743ef30d5eddcd37094b64d1b3d8090496b53256786bf5c82932ec23c3b74d9f05a6f95a8b5529352656664bac'.decode('hex')
 
 class BaseShare(object):
@@ -80,13 +122,15 @@ class BaseShare(object):
         ('bits', bitcoin_data.FloatingIntegerType()),
         ('nonce', pack.IntType(32)),
     ])
-    share_info_type = None
-    share_type = None
-    ref_type = None
+    share_info_type = property(lambda self: self.get_dynamic_types(self.net)['share_info_type'])
+    share_type = property(lambda self: self.get_dynamic_types(self.net)['share_type'])
+    ref_type = property(lambda self: self.get_dynamic_types(self.net)['ref_type'])
+    share_class = property(lambda self: type(self)) # what ColdShare stands in for, for version checks
 
     gentx_before_refhash = pack.VarStrType().pack(DONATION_SCRIPT) + pack.IntType(64).pack(0) + pack.VarStrType().pack('\x6a\x28' + pack.IntType(256).pack(0) + pack.IntType(64).pack(0))[:3]
 
     @classmethod
+    @memoize.memoize # shared by every share, instead of each share building its own
     def get_dynamic_types(cls, net):
         t = dict(share_info_type=None, share_type=None, ref_type=None)
         segwit_data = ('segwit_data', pack.PossiblyNoneType(dict(txid_merkle_link=dict(branch=[], index=0), wtxid_merkle_root=2**256-1), pack.ComposedType([
@@ -137,32 +181,29 @@ class BaseShare(object):
         return t
 
     @classmethod
-    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, segwit_data=None):
-        previous_share = tracker.items[share_data['previous_share_hash']] if share_data['previous_share_hash'] is not None else None
+    def generate_template(cls, tracker, previous_share_hash, subsidy, block_target, desired_other_transaction_hashes_and_fees, net, known_txs=None, base_subsidy=None, segwit_data=None, chain_state=None):
+        # everything generate_transaction works out that doesn't depend on the miner: the target range, which
+        # transactions go in, the payout weights and the segwit commitment. WorkerBridge builds this once per
+        # piece of work and shares it between all the miners it hands that work to
+        chain = tracker if chain_state is None else chain_state # answers the window queries below
+        previous_share = tracker.items[previous_share_hash] if previous_share_hash is not None else None
         
-        height, last = tracker.get_height_and_last(share_data['previous_share_hash'])
+        height, last = tracker.get_height_and_last(previous_share_hash)
         assert height >= net.REAL_CHAIN_LENGTH or last is None
         if height < net.TARGET_LOOKBEHIND:
             pre_target3 = net.MAX_TARGET
         else:
-            attempts_per_second = get_pool_attempts_per_second(tracker, share_data['previous_share_hash'], net.TARGET_LOOKBEHIND, min_work=True, integer=True)
+            attempts_per_second = get_pool_attempts_per_second(tracker, previous_share_hash, net.TARGET_LOOKBEHIND, min_work=True, integer=True)
             pre_target = 2**256//(net.SHARE_PERIOD*attempts_per_second) - 1 if attempts_per_second else 2**256-1
             pre_target2 = math.clip(pre_target, (previous_share.max_target*9//10, previous_share.max_target*11//10))
             pre_target3 = math.clip(pre_target2, (net.MIN_TARGET, net.MAX_TARGET))
-        max_bits = bitcoin_data.FloatingInteger.from_target_upper_bound(pre_target3)
-        bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
         
         new_transaction_hashes = []
         new_transaction_size = 0
         transaction_hash_refs = []
         other_transaction_hashes = []
         
-        past_shares = list(tracker.get_chain(share_data['previous_share_hash'], min(height, 100)))
-        tx_hash_to_this = {}
-        for i, share in enumerate(past_shares):
-            for j, tx_hash in enumerate(share.new_transaction_hashes):
-                if tx_hash not in tx_hash_to_this:
-                    tx_hash_to_this[tx_hash] = [1+i, j] # share_count, tx_count
+        tx_hash_to_this = tracker.tx_refs.get_tx_hash_to_this(previous_share_hash, min(height, 100))
         for tx_hash, fee in desired_other_transaction_hashes_and_fees:
             if tx_hash in tx_hash_to_this:
                 this = tx_hash_to_this[tx_hash]
@@ -181,26 +222,23 @@ class BaseShare(object):
         removed_fees = [fee for tx_hash, fee in desired_other_transaction_hashes_and_fees if tx_hash not in included_transactions]
         definite_fees = sum(0 if fee is None else fee for tx_hash, fee in desired_other_transaction_hashes_and_fees if tx_hash in included_transactions)
         if None not in removed_fees:
-            share_data = dict(share_data, subsidy=share_data['subsidy'] - sum(removed_fees))
+            subsidy = subsidy - sum(removed_fees)
         else:
             assert base_subsidy is not None
-            share_data = dict(share_data, subsidy=base_subsidy + definite_fees)
+            subsidy = base_subsidy + definite_fees
         
-        weights, total_weight, donation_weight = tracker.get_cumulative_weights(previous_share.share_data['previous_share_hash'] if previous_share is not None else None,
+        weights, total_weight, donation_weight = chain.get_cumulative_weights(previous_share.share_data['previous_share_hash'] if previous_share is not None else None,
             max(0, min(height, net.REAL_CHAIN_LENGTH) - 1),
             65535*net.SPREAD*bitcoin_data.target_to_average_attempts(block_target),
         )
         assert total_weight == sum(weights.itervalues()) + donation_weight, (total_weight, sum(weights.itervalues()) + donation_weight)
         
-        amounts = dict((script, share_data['subsidy']*(199*weight)//(200*total_weight)) for script, weight in weights.iteritems()) # 99.5% goes according to weights prior to this share
-        this_script = bitcoin_data.pubkey_hash_to_script2(share_data['pubkey_hash'])
-        amounts[this_script] = amounts.get(this_script, 0) + share_data['subsidy']//200 # 0.5% goes to block finder
-        amounts[DONATION_SCRIPT] = amounts.get(DONATION_SCRIPT, 0) + share_data['subsidy'] - sum(amounts.itervalues()) # all that's left over is the donation weight and some extra satoshis due to rounding
+        amounts = dict((script, subsidy*(199*weight)//(200*total_weight)) for script, weight in weights.iteritems()) # 99.5% goes according to weights prior to this share
+        # all that's left over once the finder has been paid is the donation weight and some extra satoshis due to rounding
+        amounts[DONATION_SCRIPT] = amounts.get(DONATION_SCRIPT, 0) + subsidy - subsidy//200 - sum(amounts.itervalues())
         
-        if sum(amounts.itervalues()) != share_data['subsidy'] or any(x < 0 for x in amounts.itervalues()):
+        if any(x < 0 for x in amounts.itervalues()):
             raise ValueError()
-        
-        dests = sorted(amounts.iterkeys(), key=lambda script: (script == DONATION_SCRIPT, amounts[script], script))[-4000:] # block length limit, unlikely to ever be hit
 
         segwit_activated = is_segwit_activated(cls.VERSION, net)
         if segwit_data is None and known_txs is None:
@@ -210,27 +248,69 @@ class BaseShare(object):
         if segwit_activated and known_txs is not None:
             share_txs = [(known_txs[h], bitcoin_data.get_txid(known_txs[h]), h) for h in other_transaction_hashes]
             segwit_data = dict(txid_merkle_link=bitcoin_data.calculate_merkle_link([None] + [tx[1] for tx in share_txs], 0), wtxid_merkle_root=bitcoin_data.merkle_hash([0] + [bitcoin_data.get_wtxid(tx[0], tx[1], tx[2]) for tx in share_txs]))
+        commitment_tx_outs = []
         if segwit_activated and segwit_data is not None:
-            witness_reserved_value_str = '[P2Pool]'*4
-            witness_reserved_value = pack.IntType(256).unpack(witness_reserved_value_str)
-            witness_commitment_hash = bitcoin_data.get_witness_commitment_hash(segwit_data['wtxid_merkle_root'], witness_reserved_value)
+            witness_commitment_hash = bitcoin_data.get_witness_commitment_hash(segwit_data['wtxid_merkle_root'], pack.IntType(256).unpack(WITNESS_RESERVED_VALUE_STR))
+            commitment_tx_outs.append(dict(value=0, script='\x6a\x24\xaa\x21\xa9\xed' + pack.IntType(256).pack(witness_commitment_hash)))
 
-        share_info = dict(
+        share_info_fields = dict(
+            far_share_hash=None if last is None and height < 99 else chain.get_nth_parent_hash(previous_share_hash, 99),
+            max_bits=bitcoin_data.FloatingInteger.from_target_upper_bound(pre_target3),
+            new_transaction_hashes=new_transaction_hashes,
+            transaction_hash_refs=transaction_hash_refs,
+        )
+        if segwit_activated:
+            share_info_fields['segwit_data'] = segwit_data
+        
+        return dict(
+            previous_share_hash=previous_share_hash,
+            previous_share=previous_share,
+            subsidy=subsidy,
+            pre_target3=pre_target3,
+            share_info_fields=share_info_fields,
+            # packed once here rather than every time get_ref_hash packs a share_info
+            packed_share_info_fields=dict((k, type_.pack(share_info_fields[k])) for k, type_ in cls.get_dynamic_types(net)['share_info_type'].fields if k in share_info_fields),
+            other_transaction_hashes=other_transaction_hashes,
+            amounts=amounts,
+            # payout order with the finder left out; each miner's own output is merged in by generate_transaction
+            dest_keys=sorted((script == DONATION_SCRIPT, amount, script) for script, amount in amounts.iteritems()),
+            segwit_activated=segwit_activated,
+            segwit_data=segwit_data,
+            commitment_tx_outs=commitment_tx_outs,
+        )
+    
+    @classmethod
+    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, segwit_data=None, chain_state=None, template=None):
+        if template is None:
+            template = cls.generate_template(tracker, share_data['previous_share_hash'], share_data['subsidy'], block_target, desired_other_transaction_hashes_and_fees, net,
+                known_txs=known_txs, base_subsidy=base_subsidy, segwit_data=segwit_data, chain_state=chain_state)
+        assert template['previous_share_hash'] == share_data['previous_share_hash']
+        previous_share = template['previous_share']
+        share_data = dict(share_data, subsidy=template['subsidy'])
+        other_transaction_hashes = template['other_transaction_hashes']
+        
+        pre_target3 = template['pre_target3']
+        bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
+        
+        amounts = template['amounts']
+        this_script = bitcoin_data.pubkey_hash_to_script2(share_data['pubkey_hash'])
+        this_amount = amounts.get(this_script, 0) + share_data['subsidy']//200 # 0.5% goes to block finder
+        dest_keys = list(template['dest_keys'])
+        if this_script in amounts:
+            del dest_keys[bisect.bisect_left(dest_keys, (this_script == DONATION_SCRIPT, amounts[this_script], this_script))]
+        bisect.insort(dest_keys, (this_script == DONATION_SCRIPT, this_amount, this_script))
+        dest_outs = [(amount, script) for is_donation, amount, script in dest_keys[-4000:] if amount or is_donation] # block length limit, unlikely to ever be hit
+        
+        share_info = dict(template['share_info_fields'],
             share_data=share_data,
-            far_share_hash=None if last is None and height < 99 else tracker.get_nth_parent_hash(share_data['previous_share_hash'], 99),
-            max_bits=max_bits,
             bits=bits,
             timestamp=math.clip(desired_timestamp, (
                 (previous_share.timestamp + net.SHARE_PERIOD) - (net.SHARE_PERIOD - 1), # = previous_share.timestamp + 1
                 (previous_share.timestamp + net.SHARE_PERIOD) + (net.SHARE_PERIOD - 1),
             )) if previous_share is not None else desired_timestamp,
-            new_transaction_hashes=new_transaction_hashes,
-            transaction_hash_refs=transaction_hash_refs,
             absheight=((previous_share.absheight if previous_share is not None else 0) + 1) % 2**32,
             abswork=((previous_share.abswork if previous_share is not None else 0) + bitcoin_data.target_to_average_attempts(bits.target)) % 2**128,
         )
-        if segwit_activated:
-            share_info['segwit_data'] = segwit_data
         
         gentx = dict(
             version=1,
@@ -239,15 +319,15 @@ class BaseShare(object):
                 sequence=None,
                 script=share_data['coinbase'],
             )],
-            tx_outs=([dict(value=0, script='\x6a\x24\xaa\x21\xa9\xed' + pack.IntType(256).pack(witness_commitment_hash))] if segwit_activated else []) +
-                [dict(value=amounts[script], script=script) for script in dests if amounts[script] or script == DONATION_SCRIPT] +
-                [dict(value=0, script='\x6a\x28' + cls.get_ref_hash(net, share_info, ref_merkle_link) + pack.IntType(64).pack(last_txout_nonce))],
+            tx_outs=template['commitment_tx_outs'] +
+                [dict(value=amount, script=script) for amount, script in dest_outs] +
+                [dict(value=0, script='\x6a\x28' + cls.get_ref_hash(net, share_info, ref_merkle_link, template['packed_share_info_fields']) + pack.IntType(64).pack(last_txout_nonce))],
             lock_time=0,
         )
-        if segwit_activated:
+        if template['segwit_activated']:
             gentx['marker'] = 0
             gentx['flag'] = 1
-            gentx['witness'] = [[witness_reserved_value_str]]
+            gentx['witness'] = [[WITNESS_RESERVED_VALUE_STR]]
         
         def get_share(header, last_txout_nonce=last_txout_nonce):
             min_header = dict(header); del min_header['merkle_root']
@@ -265,23 +345,24 @@ class BaseShare(object):
         return share_info, gentx, other_transaction_hashes, get_share
     
     @classmethod
-    def get_ref_hash(cls, net, share_info, ref_merkle_link):
-        return pack.IntType(256).pack(bitcoin_data.check_merkle_link(bitcoin_data.hash256(cls.get_dynamic_types(net)['ref_type'].pack(dict(
-            identifier=net.IDENTIFIER,
-            share_info=share_info,
-        ))), ref_merkle_link))
+    def get_ref_hash(cls, net, share_info, ref_merkle_link, packed_share_info_fields={}):
+        if packed_share_info_fields: # same bytes as ref_type.pack, with some of share_info's fields already packed
+            packed_ref = net.IDENTIFIER + ''.join(packed_share_info_fields[k] if k in packed_share_info_fields else type_.pack(share_info[k])
+                for k, type_ in cls.get_dynamic_types(net)['share_info_type'].fields)
+        else:
+            packed_ref = cls.get_dynamic_types(net)['ref_type'].pack(dict(
+                identifier=net.IDENTIFIER,
+                share_info=share_info,
+            ))
+        return pack.IntType(256).pack(bitcoin_data.check_merkle_link(bitcoin_data.hash256(packed_ref), ref_merkle_link))
     
-    __slots__ = 'net peer_addr contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen absheight abswork'.split(' ')
+    __slots__ = 'net peer_addr contents packed_contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen absheight abswork tx_sizes'.split(' ')
     
-    def __init__(self, net, peer_addr, contents):
-        dynamic_types = self.get_dynamic_types(net)
-        self.share_info_type = dynamic_types['share_info_type']
-        self.share_type = dynamic_types['share_type']
-        self.ref_type = dynamic_types['ref_type']
-
+    def __init__(self, net, peer_addr, contents, checked_hashes=None, packed_contents=None):
         self.net = net
         self.peer_addr = peer_addr
         self.contents = contents
+        self.packed_contents = packed_contents # share_type.pack(contents), filled in by as_share if not given
         
         self.min_header = contents['min_header']
         self.share_info = contents['share_info']
@@ -315,14 +396,18 @@ class BaseShare(object):
                 n.add(tx_count)
         assert n == set(range(len(self.share_info['new_transaction_hashes'])))
         
-        self.gentx_hash = check_hash_link(
-            self.hash_link,
-            self.get_ref_hash(net, self.share_info, contents['ref_merkle_link']) + pack.IntType(64).pack(self.contents['last_txout_nonce']) + pack.IntType(32).pack(0),
-            self.gentx_before_refhash,
-        )
+        if checked_hashes is not None: # already computed from these contents in a worker process
+            self.gentx_hash, self.pow_hash = checked_hashes
+        else:
+            self.gentx_hash = check_hash_link(
+                self.hash_link,
+                self.get_ref_hash(net, self.share_info, contents['ref_merkle_link']) + pack.IntType(64).pack(self.contents['last_txout_nonce']) + pack.IntType(32).pack(0),
+                self.gentx_before_refhash,
+            )
         merkle_root = bitcoin_data.check_merkle_link(self.gentx_hash, self.share_info['segwit_data']['txid_merkle_link'] if segwit_activated else self.merkle_link)
         self.header = dict(self.min_header, merkle_root=merkle_root)
-        self.pow_hash = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(self.header))
+        if checked_hashes is None:
+            self.pow_hash = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(self.header))
         self.hash = self.header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(self.header))
         
         if self.target > net.MAX_TARGET:
@@ -334,6 +419,7 @@ class BaseShare(object):
             raise p2p.PeerMisbehavingError('share PoW invalid')
         
         self.new_transaction_hashes = self.share_info['new_transaction_hashes']
+        self.tx_sizes = None # see get_tx_sizes
         
         # XXX eww
         self.time_seen = time.time()
@@ -342,34 +428,43 @@ class BaseShare(object):
         return 'Share' + repr((self.net, self.peer_addr, self.contents))
     
     def as_share(self):
-        return dict(type=self.VERSION, contents=self.share_type.pack(self.contents))
+        if self.packed_contents is None:
+            self.packed_contents = self.share_type.pack(self.contents)
+        return dict(type=self.VERSION, contents=self.packed_contents)
     
     def iter_transaction_hash_refs(self):
         return zip(self.share_info['transaction_hash_refs'][::2], self.share_info['transaction_hash_refs'][1::2])
     
-    def check(self, tracker, other_txs=None):
+    def check(self, tracker, other_txs=None, chain_state=None):
         from p2pool import p2p
+        chain = tracker if chain_state is None else chain_state
         counts = None
         if self.share_data['previous_share_hash'] is not None:
             previous_share = tracker.items[self.share_data['previous_share_hash']]
             if tracker.get_height(self.share_data['previous_share_hash']) >= self.net.CHAIN_LENGTH:
-                counts = get_desired_version_counts(tracker, tracker.get_nth_parent_hash(previous_share.hash, self.net.CHAIN_LENGTH*9//10), self.net.CHAIN_LENGTH//10)
-                if type(self) is type(previous_share):
+                version_window_start = chain.get_nth_parent_hash(previous_share.hash, self.net.CHAIN_LENGTH*9//10)
+                if chain_state is not None:
+                    counts = chain_state.get_desired_version_counts(version_window_start, self.net.CHAIN_LENGTH//10)
+                else:
+                    counts = get_desired_version_counts(tracker, version_window_start, self.net.CHAIN_LENGTH//10)
+                if type(self) is previous_share.share_class:
                     pass
-                elif type(self) is type(previous_share).SUCCESSOR:
+                elif type(self) is previous_share.share_class.SUCCESSOR:
                     # switch only valid if 60% of hashes in [self.net.CHAIN_LENGTH*9//10, self.net.CHAIN_LENGTH] for new version
                     if counts.get(self.VERSION, 0) < sum(counts.itervalues())*60//100:
                         raise p2p.PeerMisbehavingError('switch without enough hash power upgraded')
                 else:
-                    raise p2p.PeerMisbehavingError('''%s can't follow %s''' % (type(self).__name__, type(previous_share).__name__))
-            elif type(self) is type(previous_share).SUCCESSOR:
+                    raise p2p.PeerMisbehavingError('''%s can't follow %s''' % (type(self).__name__, previous_share.share_class.__name__))
+            elif type(self) is previous_share.share_class.SUCCESSOR:
                 raise p2p.PeerMisbehavingError('switch without enough history')
         
-        other_tx_hashes = [tracker.items[tracker.get_nth_parent_hash(self.hash, share_count)].share_info['new_transaction_hashes'][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs()]
+        other_tx_hashes = tracker.tx_refs.get_tx_hashes(self.hash, self.iter_transaction_hash_refs())
+        if other_tx_hashes is None:
+            raise ValueError('missing shares referenced by transaction_hash_refs')
         if other_txs is not None and not isinstance(other_txs, dict): other_txs = dict((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx) for tx in other_txs)
         
         share_info, gentx, other_tx_hashes2, get_share = self.generate_transaction(tracker, self.share_info['share_data'], self.header['bits'].target, self.share_info['timestamp'], self.share_info['bits'].target, self.contents['ref_merkle_link'], [(h, None) for h in other_tx_hashes], self.net,
-            known_txs=other_txs, last_txout_nonce=self.contents['last_txout_nonce'], segwit_data=self.share_info.get('segwit_data', None))
+            known_txs=other_txs, last_txout_nonce=self.contents['last_txout_nonce'], segwit_data=self.share_info.get('segwit_data', None), chain_state=chain_state)
         
         assert other_tx_hashes2 == other_tx_hashes
         if share_info != self.share_info:
@@ -384,12 +479,7 @@ class BaseShare(object):
         return gentx # only used by as_block
     
     def get_other_tx_hashes(self, tracker):
-        parents_needed = max(share_count for share_count, tx_count in self.iter_transaction_hash_refs()) if self.share_info['transaction_hash_refs'] else 0
-        parents = tracker.get_height(self.hash) - 1
-        if parents < parents_needed:
-            return None
-        last_shares = list(tracker.get_chain(self.hash, parents_needed + 1))
-        return [last_shares[share_count].share_info['new_transaction_hashes'][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs()]
+        return tracker.tx_refs.get_tx_hashes(self.hash, self.iter_transaction_hash_refs())
     
     def _get_other_txs(self, tracker, known_txs):
         other_tx_hashes = self.get_other_tx_hashes(tracker)
@@ -401,6 +491,20 @@ class BaseShare(object):
         
         return [known_txs[tx_hash] for tx_hash in other_tx_hashes]
     
+    def get_tx_sizes(self, tracker, known_txs):
+        # returns (size, stripped size) of the other txs and the size of the new txs, or None while some of them aren't
+        # known. tx hashes commit to the whole tx, so this only depends on the share and is worked out once
+        if self.tx_sizes is None:
+            other_txs = self._get_other_txs(tracker, known_txs)
+            if other_txs is None:
+                return None
+            self.tx_sizes = (
+                sum(bitcoin_data.tx_type.packed_size(tx) for tx in other_txs),
+                sum(bitcoin_data.tx_id_type.packed_size(tx) for tx in other_txs),
+                sum(bitcoin_data.tx_type.packed_size(known_txs[tx_hash]) for tx_hash in self.new_transaction_hashes),
+            )
+        return self.tx_sizes
+    
     def should_punish_reason(self, previous_block, bits, tracker, known_txs):
         if (self.header['previous_block'], self.header['bits']) != (previous_block, bits) and self.header_hash != previous_block and self.peer_addr is not None:
             return True, 'Block-stale detected! height(%x) < height(%x) or %08x != %08x' % (self.header['previous_block'], previous_block, self.header['bits'].bits, bits.bits)
@@ -408,16 +512,14 @@ class BaseShare(object):
         if self.pow_hash <= self.header['bits'].target:
             return -1, 'block solution'
         
-        other_txs = self._get_other_txs(tracker, known_txs)
-        if other_txs is None:
+        tx_sizes = self.get_tx_sizes(tracker, known_txs)
+        if tx_sizes is None:
             pass
         else:
-            all_txs_size = sum(bitcoin_data.tx_type.packed_size(tx) for tx in other_txs)
-            stripped_txs_size = sum(bitcoin_data.tx_id_type.packed_size(tx) for tx in other_txs)
+            all_txs_size, stripped_txs_size, new_txs_size = tx_sizes
             if all_txs_size + 3 * stripped_txs_size > self.MAX_BLOCK_WEIGHT:
                 return True, 'txs over block size limit'
             
-            new_txs_size = sum(bitcoin_data.tx_type.packed_size(known_txs[tx_hash]) for tx_hash in self.share_info['new_transaction_hashes'])
             if new_txs_size > self.MAX_NEW_TXS_SIZE:
                 return True, 'new txs over limit'
         
@@ -430,12 +532,16 @@ class BaseShare(object):
         return dict(header=self.header, txs=[self.check(tracker, other_txs)] + other_txs)
 
 class NewShare(BaseShare):
+    __slots__ = ()
+    
     VERSION = 17
     VOTING_VERSION = 17
     SUCCESSOR = None
     MAX_NEW_TXS_SIZE = 100000
 
 class Share(BaseShare):
+    __slots__ = ()
+    
     VERSION = 16
     VOTING_VERSION = 16
     SUCCESSOR = NewShare
@@ -478,7 +584,547 @@ class WeightsSkipList(forest.TrackerSkipList):
         assert share_count == max_shares or total_weight == desired_weight
         return math.add_dicts(*math.flatten_linked_list(weights_list)), total_weight, total_donation_weight
 
+class PayoutWeightIndex(object):
+    # answers the same queries as WeightsSkipList, with identical results, using running totals. every share whose hash is
+    # a multiple of CHECKPOINT_SPACING stores the weight of each script over it and all of its ancestors down to its base's
+    # bottom, so the weights over a window are the difference of two of those plus the shares between the window's ends
+    # and the nearest checkpoints. where a window stops is found with the tracker's work totals and ancestor index, so the
+    # tracker's deltas need 'work'
+    CHECKPOINT_SPACING = 128
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        # share hash -> (checkpoint below it or None, shares from it down to that, {script: weight}, donation weight, base)
+        # a base is [parent base or None, {script: weight}, donation weight, bottom share hash]. the bottom is the tail the
+        # base's totals were taken down to; once shares arrive below it, the base gets a parent along with the totals that
+        # turn its totals into the parent's, so nothing above has to be recomputed
+        self.checkpoints = {}
+        self.tracker.removed.watch_weakref(self, lambda self, share: self.checkpoints.pop(share.hash, None))
+    
+    def _is_checkpoint(self, share_hash):
+        return share_hash % self.CHECKPOINT_SPACING == 0
+    
+    def _add_share(self, share_hash, weights, donation_weight):
+        # returns the new donation weight
+        share = self.tracker.items[share_hash]
+        att = bitcoin_data.target_to_average_attempts(share.target)
+        weights[share.new_script] = weights.get(share.new_script, 0) + att*(65535-share.share_data['donation'])
+        return donation_weight + att*share.share_data['donation']
+    
+    def _add_segment(self, share_hash):
+        # returns (next checkpoint below or None, shares added, {script: weight}, donation weight, last share added) for the
+        # shares from share_hash down to just above the next checkpoint or the tail
+        weights, donation_weight, length = {}, 0, 0
+        below = share_hash
+        while True:
+            donation_weight = self._add_share(below, weights, donation_weight)
+            length += 1
+            bottom, below = below, self.tracker.items[below].previous_hash
+            if below not in self.tracker.items:
+                return None, length, weights, donation_weight, bottom
+            if self._is_checkpoint(below):
+                return below, length, weights, donation_weight, bottom
+    
+    def _resolve(self, base):
+        # returns (root base, {script: weight}, donation weight) to add to totals taken against base to get them against root
+        weights, donation_weight, root = {}, 0, base
+        while root[0] is not None:
+            weights = math.add_dicts(weights, root[1])
+            donation_weight += root[2]
+            root = root[0]
+        if base[0] is not None and base[0] is not root:
+            base[:] = [root, weights, donation_weight, base[3]]
+        return root, weights, donation_weight
+    
+    def _get_checkpoint(self, share_hash):
+        if share_hash in self.checkpoints:
+            return self.checkpoints[share_hash]
+        
+        segments = [] # (checkpoint, next checkpoint below or None, shares between, {script: weight}, donation weight, bottom), newest first
+        pos = share_hash
+        while pos not in self.checkpoints:
+            segments.append((pos,) + self._add_segment(pos))
+            pos = segments[-1][1]
+            if pos is None:
+                break
+        
+        for pos, below, length, weights, donation_weight, bottom in reversed(segments):
+            if below is not None:
+                below_below, below_length, below_weights, below_donation_weight, base = self.checkpoints[below]
+                weights = math.add_dicts(below_weights, weights)
+                donation_weight += below_donation_weight
+            else:
+                base = [None, None, 0, bottom]
+            self.checkpoints[pos] = below, length, weights, donation_weight, base
+        return self.checkpoints[share_hash]
+    
+    def _extend(self, share_hash):
+        # shares arrived below the bottom of the lowest checkpoint share_hash's segment. link its base to totals over them
+        # instead of throwing away the checkpoints above. returns False if there is nothing below
+        below, length, weights, donation_weight, base = self.checkpoints[share_hash]
+        root, root_weights, root_donation_weight = self._resolve(base)
+        if root[3] not in self.tracker.items or self.tracker.items[root[3]].previous_hash not in self.tracker.items:
+            return False
+        below, extra_length, extra_weights, extra_donation_weight, bottom = self._add_segment(self.tracker.items[root[3]].previous_hash)
+        if below is None:
+            root[:] = [[None, None, 0, bottom], extra_weights, extra_donation_weight, root[3]]
+        else:
+            below_below, below_length, below_weights, below_donation_weight, below_base = self._get_checkpoint(below)
+            root[:] = [below_base, math.add_dicts(below_weights, extra_weights), below_donation_weight + extra_donation_weight, root[3]]
+        self.checkpoints[share_hash] = below, length + extra_length, weights, donation_weight, base
+        return True
+    
+    def _get_weights(self, start, count, retry=True):
+        # returns ({script: weight} with zero weights left out, donation weight) over count shares from start
+        weights, donation_weight = {}, 0
+        pos, total_count = start, count
+        while count and not self._is_checkpoint(pos):
+            donation_weight = self._add_share(pos, weights, donation_weight)
+            pos = self.tracker.items[pos].previous_hash
+            count -= 1
+        if not count:
+            return math.add_dicts(weights), donation_weight
+        
+        # pos is a checkpoint in the window. find the oldest one, then take the difference between the two's totals
+        top = pos
+        below, length, top_weights, top_donation_weight, top_base = self._get_checkpoint(top)
+        bottom_weights, bottom_donation_weight, bottom_base = top_weights, top_donation_weight, top_base
+        while length < count:
+            if below is None:
+                if not self._extend(pos):
+                    break
+                below, length = self.checkpoints[pos][:2]
+                continue
+            count -= length
+            pos = below
+            below, length, bottom_weights, bottom_donation_weight, bottom_base = self._get_checkpoint(pos)
+        top_root, top_offset_weights, top_offset_donation_weight = self._resolve(top_base)
+        bottom_root, bottom_offset_weights, bottom_offset_donation_weight = self._resolve(bottom_base)
+        if top_root is not bottom_root or length < count:
+            # a checkpoint or base bottom was removed from the tracker and then added back, so totals on either side of it
+            # can't be related anymore. rare enough to just start over
+            assert retry
+            self.checkpoints.clear()
+            return self._get_weights(start, total_count, False)
+        if pos != top:
+            top_weights = math.add_dicts(top_weights, top_offset_weights)
+            bottom_weights = math.add_dicts(bottom_weights, bottom_offset_weights)
+            weights = math.add_dicts(weights, dict((script, weight - bottom_weights.get(script, 0)) for script, weight in top_weights.iteritems()))
+            donation_weight += top_donation_weight + top_offset_donation_weight - bottom_donation_weight - bottom_offset_donation_weight
+        
+        for i in xrange(count):
+            donation_weight = self._add_share(pos, weights, donation_weight)
+            pos = self.tracker.items[pos].previous_hash
+        return math.add_dicts(weights), donation_weight
+    
+    def __call__(self, start, max_shares, desired_weight):
+        assert desired_weight % 65535 == 0, divmod(desired_weight, 65535)
+        if max_shares == 0 or desired_weight == 0:
+            return {}, 0, 0
+        
+        # find the longest run of whole shares from start that fits in both limits
+        height = self.tracker.get_height(start)
+        start_work = self.tracker.get_work(start)
+        limit = min(max_shares, height)
+        pos, count, total_weight = start, 0, 0
+        for level in reversed(xrange(len(bin(limit)) - 2)):
+            if count + 2**level > limit:
+                continue
+            candidate = self.tracker.get_nth_parent_hash(pos, 2**level)
+            candidate_weight = (start_work - self.tracker.get_work(candidate))*65535
+            if candidate_weight <= desired_weight:
+                pos, count, total_weight = candidate, count + 2**level, candidate_weight
+        
+        weights, donation_weight = self._get_weights(start, count)
+        if count == max_shares or total_weight == desired_weight:
+            return weights, total_weight, donation_weight
+        
+        # the next share only partly fits (or is missing, which WeightsSkipList also fails on)
+        share = self.tracker.items[pos]
+        att = bitcoin_data.target_to_average_attempts(share.target)
+        weights = math.add_dicts(weights, {share.new_script: (desired_weight - total_weight)//65535*(att*(65535-share.share_data['donation']))//att})
+        donation_weight += (desired_weight - total_weight)//65535*(att*share.share_data['donation'])//att
+        return weights, desired_weight, donation_weight
+
+class _TxRefView(object):
+    # looks like the tx_hash_to_this dict built in generate_transaction, for count shares ending at the index's tip. only
+    # good until the index moves
+    
+    def __init__(self, index, count):
+        self._txs, self._tip_pos, self._count = index._txs, index._get_tip_pos(), count
+    
+    def __contains__(self, tx_hash):
+        return tx_hash in self._txs and self._txs[tx_hash][-1][0] > self._tip_pos - self._count
+    
+    def __getitem__(self, tx_hash):
+        entries = self._txs[tx_hash]
+        i = len(entries) - 1
+        while i and entries[i - 1][0] == entries[-1][0]: # first listing within the newest share that has it
+            i -= 1
+        pos, tx_count = entries[i]
+        if pos <= self._tip_pos - self._count:
+            raise KeyError(tx_hash)
+        return [1 + self._tip_pos - pos, tx_count] # share_count, tx_count
+
+class TxRefIndex(object):
+    # the new_transaction_hashes of the last WINDOW shares of one chain, for resolving transaction_hash_refs in O(1) both
+    # ways: tx hash -> newest share that introduced it, and (share_count, tx_count) -> tx hash. the window follows
+    # whichever share was asked about last, moving incrementally, so that checking shares in chain order and making work
+    # on the best share each only add or drop a share or two
+    WINDOW = 110 # transaction_hash_refs reach at most this many shares back
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self._clear()
+        self.tracker.added.watch_weakref(self, lambda self, share: self._share_added(share))
+        self.tracker.removed.watch_weakref(self, lambda self, share: self._share_removed(share))
+    
+    def _clear(self):
+        self.tip = None
+        self._shares = [] # oldest first
+        self._first_pos = 0 # position of _shares[0]. positions only mean something within the current window
+        self._pos = {} # share hash -> position
+        self._txs = {} # tx hash -> [(position, tx_count)] of the shares in the window that introduced it, oldest first
+    
+    def _get_tip_pos(self):
+        return self._first_pos + len(self._shares) - 1
+    
+    def _share_added(self, share):
+        if self._shares and share.hash == self._shares[0].previous_hash:
+            self.tip = None # the window can now reach further back
+    
+    def _share_removed(self, share):
+        if share.hash in self._pos:
+            self._clear()
+    
+    def _push(self, share):
+        pos = self._get_tip_pos() + 1
+        self._shares.append(share)
+        self._pos[share.hash] = pos
+        for tx_count, tx_hash in enumerate(share.new_transaction_hashes):
+            self._txs.setdefault(tx_hash, []).append((pos, tx_count))
+    
+    def _pop(self):
+        share = self._shares.pop()
+        del self._pos[share.hash]
+        for tx_hash in share.new_transaction_hashes:
+            entries = self._txs[tx_hash]
+            entries.pop()
+            if not entries:
+                del self._txs[tx_hash]
+    
+    def _shift(self):
+        share = self._shares.pop(0)
+        self._first_pos += 1
+        del self._pos[share.hash]
+        for tx_hash in share.new_transaction_hashes:
+            entries = self._txs[tx_hash]
+            entries.pop(0)
+            if not entries:
+                del self._txs[tx_hash]
+    
+    def _unshift(self, share):
+        self._first_pos -= 1
+        self._shares.insert(0, share)
+        self._pos[share.hash] = self._first_pos
+        for tx_count, tx_hash in reversed(list(enumerate(share.new_transaction_hashes))):
+            self._txs.setdefault(tx_hash, []).insert(0, (self._first_pos, tx_count))
+    
+    def _move_to(self, share_hash):
+        if share_hash == self.tip:
+            return
+        
+        path = [] # shares not in the window, newest first
+        pos_hash = share_hash
+        while pos_hash not in self._pos and len(path) < self.WINDOW and pos_hash in self.tracker.items:
+            path.append(self.tracker.items[pos_hash])
+            pos_hash = path[-1].previous_hash
+        if not path and pos_hash not in self._pos:
+            raise KeyError(share_hash)
+        if pos_hash in self._pos:
+            while self._shares[-1].hash != pos_hash:
+                self._pop()
+        else:
+            self._clear()
+        for share in reversed(path):
+            self._push(share)
+        while len(self._shares) > self.WINDOW:
+            self._shift()
+        while len(self._shares) < self.WINDOW and self._shares[0].previous_hash in self.tracker.items:
+            self._unshift(self.tracker.items[self._shares[0].previous_hash])
+        self.tip = share_hash
+    
+    def get_tx_hashes(self, share_hash, refs):
+        # returns new_transaction_hashes[tx_count] of share_hash's share_count'th ancestor (0 being itself) for each
+        # (share_count, tx_count) in refs, or None if some of those shares aren't in the tracker
+        if share_hash not in self.tracker.items:
+            return None
+        self._move_to(share_hash)
+        tip = len(self._shares) - 1
+        res = []
+        for share_count, tx_count in refs:
+            if share_count > tip:
+                return None
+            res.append(self._shares[tip - share_count].new_transaction_hashes[tx_count])
+        return res
+    
+    def get_tx_hash_to_this(self, previous_share_hash, count):
+        # returns what generate_transaction needs to reference txs introduced by the count shares ending at
+        # previous_share_hash
+        if previous_share_hash is None or not count:
+            return {}
+        assert count <= self.WINDOW
+        self._move_to(previous_share_hash)
+        return _TxRefView(self, count)
+
+class _ChainWindow(object):
+    # contiguous range [lo, hi] of positions in a ForwardChainState's chain, kept up to date through add/remove callbacks
+    
+    def __init__(self, add, remove):
+        self._add, self._remove = add, remove
+        self.lo, self.hi = 0, -1
+    
+    def move_to(self, lo, hi):
+        if hi < self.hi: # only ever slides forwards, so start over
+            for pos in xrange(self.lo, self.hi + 1):
+                self._remove(pos)
+            self.lo, self.hi = 0, -1
+        while self.lo < lo and self.lo <= self.hi:
+            self._remove(self.lo)
+            self.lo += 1
+        if self.lo > self.hi:
+            self.lo, self.hi = lo, lo - 1
+        while self.hi < hi:
+            self.hi += 1
+            self._add(self.hi)
+        while self.lo > lo:
+            self.lo -= 1
+            self._add(self.lo)
+
+class ForwardChainState(object):
+    # answers BaseShare.check's window queries while checking a connected run of shares from oldest to newest.
+    # payout weights and desired version counts are kept as sliding windows, so each further share costs O(1) amortised
+    # instead of another walk back through the chain. anything outside the chain known here goes to the tracker, so
+    # results are identical to a plain check.
+    
+    def __init__(self, tracker, oldest_share_hash):
+        self.tracker = tracker
+        net = tracker.net
+        
+        lookbehind = min(tracker.get_height(tracker.items[oldest_share_hash].previous_hash), max(net.REAL_CHAIN_LENGTH, net.CHAIN_LENGTH, 110) + 2)
+        self._chain = list(tracker.get_chain(tracker.items[oldest_share_hash].previous_hash, lookbehind))[::-1] if lookbehind else []
+        self._pos = dict((share.hash, i) for i, share in enumerate(self._chain))
+        
+        self._weights, self._total_weight, self._donation_weight = {}, 0, 0
+        self._weights_window = _ChainWindow(self._add_weight, self._remove_weight)
+        self._version_counts = {}
+        self._version_window = _ChainWindow(self._add_version, self._remove_version)
+    
+    def advance(self, share):
+        if self._chain:
+            assert share.previous_hash == self._chain[-1].hash
+        self._pos[share.hash] = len(self._chain)
+        self._chain.append(share)
+    
+    def _add_weight(self, pos):
+        share = self._chain[pos]
+        att = bitcoin_data.target_to_average_attempts(share.target)
+        weight = att*(65535-share.share_data['donation'])
+        if weight:
+            self._weights[share.new_script] = self._weights.get(share.new_script, 0) + weight
+        self._total_weight += att*65535
+        self._donation_weight += att*share.share_data['donation']
+    
+    def _remove_weight(self, pos):
+        share = self._chain[pos]
+        att = bitcoin_data.target_to_average_attempts(share.target)
+        weight = att*(65535-share.share_data['donation'])
+        if weight:
+            self._weights[share.new_script] -= weight
+            if not self._weights[share.new_script]:
+                del self._weights[share.new_script]
+        self._total_weight -= att*65535
+        self._donation_weight -= att*share.share_data['donation']
+    
+    def _add_version(self, pos):
+        share = self._chain[pos]
+        self._version_counts[share.desired_version] = self._version_counts.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    
+    def _remove_version(self, pos):
+        share = self._chain[pos]
+        self._version_counts[share.desired_version] -= bitcoin_data.target_to_average_attempts(share.target)
+        if not self._version_counts[share.desired_version]:
+            del self._version_counts[share.desired_version]
+    
+    def get_nth_parent_hash(self, item_hash, n):
+        pos = self._pos.get(item_hash)
+        if pos is None or pos < n:
+            return self.tracker.get_nth_parent_hash(item_hash, n)
+        return self._chain[pos - n].hash
+    
+    def get_cumulative_weights(self, start, max_shares, desired_weight):
+        pos = self._pos.get(start)
+        if pos is None or pos + 1 < max_shares:
+            return self.tracker.get_cumulative_weights(start, max_shares, desired_weight)
+        self._weights_window.move_to(pos - max_shares + 1, pos)
+        if self._total_weight > desired_weight:
+            return self.tracker.get_cumulative_weights(start, max_shares, desired_weight) # desired_weight cuts the window short
+        return self._weights, self._total_weight, self._donation_weight
+    
+    def get_desired_version_counts(self, best_share_hash, dist):
+        pos = self._pos.get(best_share_hash)
+        if pos is None or pos + 1 < dist:
+            return get_desired_version_counts(self.tracker, best_share_hash, dist)
+        self._version_window.move_to(pos - dist + 1, pos)
+        return dict(self._version_counts)
+
+class Counts(dict):
+    # {key: amount} that adds and subtracts key by key, leaving out zeros, so that it can be a delta attribute (whose
+    # starting value is 0). never modified once made
+    
+    def __add__(self, other):
+        if not other:
+            return self
+        res = Counts(self)
+        for k, v in other.iteritems():
+            x = res.get(k, 0) + v
+            if x:
+                res[k] = x
+            else:
+                res.pop(k, None)
+        return res
+    __radd__ = __add__
+    
+    def __neg__(self):
+        return Counts((k, -v) for k, v in self.iteritems())
+    
+    def __sub__(self, other):
+        return self + -other if other else self
+    
+    def __rsub__(self, other):
+        return -self + other
+
+ShareStatsDelta = forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+    work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
+    stale_shares=lambda share: int(share.share_data['stale_info'] is not None),
+    stale_work=lambda share: Counts({share.share_data['stale_info']: bitcoin_data.target_to_average_attempts(share.target)}) if share.share_data['stale_info'] is not None else 0,
+    desired_version_work=lambda share: Counts({share.desired_version: bitcoin_data.target_to_average_attempts(share.target)}),
+))
+
+class UserStatsWindow(object):
+    # pubkey_hash -> [shares, stale shares] over a run of shares of one chain. the window remembers its ends and slides
+    # from them to the next one asked for, so following the best share costs only the shares that enter or leave it. a
+    # tracker view can't do this without storing a dict as big as the set of users for every share
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self._clear()
+        self.tracker.removed.watch_weakref(self, lambda self, share: self._share_removed(share))
+    
+    def _clear(self):
+        self.top = self.bottom = None
+        self.counts = {}
+    
+    def _share_removed(self, share):
+        if share.hash in (self.top, self.bottom): # the window can't be walked from its ends anymore
+            self._clear()
+    
+    def _add(self, share_hash, length, sign):
+        for share in self.tracker.get_chain(share_hash, length):
+            counts = self.counts.setdefault(share.share_data['pubkey_hash'], [0, 0])
+            counts[0] += sign
+            counts[1] += sign*(share.share_data['stale_info'] is not None)
+            if not counts[0]:
+                del self.counts[share.share_data['pubkey_hash']]
+    
+    def _offset(self, share_hash, other_hash):
+        # returns how many shares share_hash is above other_hash (negative if below), or None if they aren't on one chain
+        dist = self.tracker.get_height(share_hash) - self.tracker.get_height(other_hash)
+        if dist >= 0:
+            return dist if self.tracker.get_nth_parent_hash(share_hash, dist) == other_hash else None
+        return dist if self.tracker.get_nth_parent_hash(other_hash, -dist) == share_hash else None
+    
+    def get(self, share_hash, length):
+        # returns {pubkey_hash: [shares, stale shares]} over length shares starting at share_hash, the same as counting
+        # get_chain(share_hash, length). not to be modified
+        if not length:
+            return {}
+        bottom = self.tracker.get_nth_parent_hash(share_hash, length - 1)
+        top_dist = bottom_dist = None
+        if self.top is not None:
+            top_dist = self._offset(share_hash, self.top)
+            bottom_dist = self._offset(bottom, self.bottom)
+        if top_dist is None or bottom_dist is None or abs(top_dist) + abs(bottom_dist) >= length: # no overlap worth sliding
+            self.counts = {}
+            self._add(share_hash, length, 1)
+        else:
+            if top_dist > 0:
+                self._add(share_hash, top_dist, 1)
+            elif top_dist < 0:
+                self._add(self.top, -top_dist, -1)
+            if bottom_dist > 0:
+                self._add(self.tracker.items[bottom].previous_hash, bottom_dist, -1)
+            elif bottom_dist < 0:
+                self._add(self.tracker.items[self.bottom].previous_hash, -bottom_dist, 1)
+        self.top, self.bottom = share_hash, bottom
+        return self.counts
+
+class EvictionIndex(object):
+    # Node.clean_tracker's candidates, kept ordered so that it doesn't have to scan every head and tail: heads by when they
+    # were seen, and tails by how tall the chain above them is. entries are only hints that get checked when they come
+    # out; anything that can become prunable is pushed again from the tracker's added and removed events
+    
+    def __init__(self, tracker, max_height):
+        self.tracker = tracker
+        self.max_height = max_height # chains above a tail are trimmed to below this
+        self.heads = [] # heap of (time_seen, share hash)
+        self.tails = [] # heap of (-height, tail hash)
+        for share_hash in tracker.heads:
+            self.push_head(share_hash)
+        for tail_hash, heads in tracker.tails.iteritems():
+            heapq.heappush(self.tails, (-min(tracker.get_height(head_hash) for head_hash in heads), tail_hash))
+        self.tracker.added.watch_weakref(self, lambda self, share: self._share_added(share))
+        self.tracker.removed.watch_weakref(self, lambda self, share: self._share_removed(share))
+    
+    def _share_added(self, share):
+        if share.hash in self.tracker.heads:
+            self.push_head(share.hash)
+        height, last = self.tracker.get_height_and_last(share.hash)
+        if height >= self.max_height or share.hash in self.tracker.reverse: # otherwise the chain above last can't be tall enough
+            heapq.heappush(self.tails, (-height, last))
+    
+    def _share_removed(self, share):
+        if share.previous_hash in self.tracker.heads:
+            self.push_head(share.previous_hash)
+        if share.hash in self.tracker.tails:
+            heapq.heappush(self.tails, (-min(self.tracker.get_height(head_hash) for head_hash in self.tracker.tails[share.hash]), share.hash))
+        elif share.previous_hash in self.tracker.items: # removing a short head can leave only tall ones
+            height, last = self.tracker.get_height_and_last(share.previous_hash)
+            heapq.heappush(self.tails, (-height, last))
+    
+    def push_head(self, share_hash):
+        heapq.heappush(self.heads, (self.tracker.items[share_hash].time_seen, share_hash))
+    
+    def pop_head(self, cutoff):
+        # returns the longest-seen head that was seen at or before cutoff, or None. the same head can come out more than once
+        while self.heads and self.heads[0][0] <= cutoff:
+            time_seen, share_hash = heapq.heappop(self.heads)
+            if share_hash in self.tracker.heads:
+                return share_hash
+        return None
+    
+    def pop_tail(self):
+        # returns a tail whose heads are all at least max_height above it, tallest first, or None
+        while self.tails:
+            neg_height, tail_hash = heapq.heappop(self.tails)
+            if tail_hash in self.tracker.tails and min(self.tracker.get_height(head_hash) for head_hash in self.tracker.tails[tail_hash]) >= self.max_height:
+                return tail_hash
+        return None
+
 class OkayTracker(forest.Tracker):
+    BULK_VERIFY_THRESHOLD = 10 # shorter runs aren't worth setting up a ForwardChainState for
+    BLOCK_HEIGHT_CACHE_TIME = 10 # seconds. heights of blocks bitcoind hasn't told us about yet can change before the best block does
+    
     def __init__(self, net):
         forest.Tracker.__init__(self, delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
             work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
@@ -488,7 +1134,134 @@ class OkayTracker(forest.Tracker):
         self.verified = forest.SubsetTracker(delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
             work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
         )), subset_of=self)
-        self.get_cumulative_weights = WeightsSkipList(self)
+        self.get_cumulative_weights = PayoutWeightIndex(self)
+        self.tx_refs = TxRefIndex(self)
+        self.share_stats = forest.TrackerView(self, ShareStatsDelta)
+        self.user_stats = UserStatsWindow(self)
+        
+        self.unverified_heads = set()
+        self.added.watch(self._update_unverified_heads)
+        self.removed.watch(self._update_unverified_heads)
+        self.verified.added.watch(self._update_unverified_heads)
+        self.verified.removed.watch(self._update_unverified_heads)
+        
+        # think's ordering of verified heads, kept up to date instead of being rebuilt every time
+        self._head_block = None # (previous_block, bits) that the cached keys are for
+        self._head_punish = {} # verified head hash -> (punish, known_txs it was computed with or None if it doesn't depend on them)
+        self._head_keys = {} # verified head hash -> (sort key, tail hash)
+        self._sorted_heads = {} # verified tail hash -> sorted list of (sort key, head hash)
+        self._heads_awaiting_txs = set() # heads in _head_keys whose punishment depends on which txs are known
+        self.verified.added.watch(self._verified_added)
+        self.verified.removed.watch(self._verified_removed)
+        
+        self._block_heights_key = None # (block_rel_height_func, previous_block) that _block_heights is for
+        self._block_heights_expiry = 0
+        self._block_heights = {} # block hash -> block_rel_height_func(block hash)
+        self._tail_scores = {} # verified tail hash -> (head hash, score), for scores that use _block_heights
+    
+    def get_window(self, view, share_hash, length):
+        # returns view's delta over length shares starting at share_hash, the same as adding up get_chain(share_hash, length)
+        return view.get_delta(share_hash, self.get_nth_parent_hash(share_hash, length))
+    
+    def _update_unverified_heads(self, share):
+        for share_hash in [share.hash, share.previous_hash]:
+            if share_hash in self.heads and share_hash not in self.verified.heads:
+                self.unverified_heads.add(share_hash)
+            else:
+                self.unverified_heads.discard(share_hash)
+    
+    def _verified_added(self, share):
+        self._forget_tail(share.hash) # extending a chain downwards changes the work of everything above it
+        self._forget_head(share.previous_hash)
+    
+    def _verified_removed(self, share):
+        self._forget_tail(share.previous_hash) # so does dropping its tail
+        self._forget_head(share.hash)
+    
+    def _forget_tail(self, tail_hash):
+        for key, head_hash in self._sorted_heads.pop(tail_hash, []):
+            del self._head_keys[head_hash]
+            self._heads_awaiting_txs.discard(head_hash)
+    
+    def _forget_head(self, head_hash):
+        self._head_punish.pop(head_hash, None)
+        self._forget_head_key(head_hash)
+    
+    def _forget_head_key(self, head_hash):
+        if head_hash in self._head_keys:
+            key, tail_hash = self._head_keys.pop(head_hash)
+            decorated = self._sorted_heads[tail_hash]
+            decorated.pop(bisect.bisect_left(decorated, (key, head_hash)))
+            if not decorated:
+                del self._sorted_heads[tail_hash]
+            self._heads_awaiting_txs.discard(head_hash)
+    
+    def _get_head_punish(self, head_hash, previous_block, bits, known_txs):
+        if head_hash in self._head_punish:
+            punish, txs = self._head_punish[head_hash]
+            if txs is None or txs is known_txs:
+                return punish
+        share = self.items[head_hash]
+        punish = share.should_punish_reason(previous_block, bits, self, known_txs)[0]
+        # a verdict reached without all of the share's txs may change once they arrive
+        depends_on_txs = punish is False and share.get_tx_sizes(self, known_txs) is None
+        self._head_punish[head_hash] = punish, known_txs if depends_on_txs else None
+        return punish
+    
+    def _insert_head(self, head_hash, tail_hash, previous_block, bits, known_txs):
+        key = (
+            self.verified.get_work(self.verified.get_nth_parent_hash(head_hash, min(5, self.verified.get_height(head_hash)))),
+            #self.items[head_hash].peer_addr is None,
+            -self._get_head_punish(head_hash, previous_block, bits, known_txs),
+            -self.items[head_hash].time_seen,
+        )
+        self._head_keys[head_hash] = key, tail_hash
+        bisect.insort(self._sorted_heads.setdefault(tail_hash, []), (key, head_hash))
+        if self._head_punish[head_hash][1] is not None:
+            self._heads_awaiting_txs.add(head_hash)
+    
+    def get_decorated_heads(self, tail_hash, previous_block, bits, known_txs):
+        # returns the verified heads under tail_hash as a sorted list of ((work of 5th parent, -punish, -time_seen), head hash)
+        if (previous_block, bits) != self._head_block:
+            self._head_block = previous_block, bits
+            self._head_punish.clear()
+            self._head_keys.clear()
+            self._sorted_heads.clear()
+            self._heads_awaiting_txs.clear()
+        
+        for head_hash in list(self._heads_awaiting_txs):
+            key, head_tail_hash = self._head_keys[head_hash]
+            if head_tail_hash == tail_hash and self._get_head_punish(head_hash, previous_block, bits, known_txs) != -key[1]:
+                self._forget_head_key(head_hash)
+        
+        heads = self.verified.tails.get(tail_hash, set())
+        if len(self._sorted_heads.get(tail_hash, [])) != len(heads):
+            for head_hash in heads:
+                if head_hash not in self._head_keys:
+                    self._insert_head(head_hash, tail_hash, previous_block, bits, known_txs)
+        return list(self._sorted_heads.get(tail_hash, []))
+    
+    def _get_block_rel_height_func(self, block_rel_height_func, previous_block):
+        if (block_rel_height_func, previous_block) != self._block_heights_key or time.time() >= self._block_heights_expiry:
+            self._block_heights_key = block_rel_height_func, previous_block
+            self._block_heights_expiry = time.time() + self.BLOCK_HEIGHT_CACHE_TIME
+            self._block_heights = {}
+            self._tail_scores = {}
+        block_heights = self._block_heights
+        def cached_block_rel_height_func(block_hash):
+            if block_hash not in block_heights:
+                block_heights[block_hash] = block_rel_height_func(block_hash)
+            return block_heights[block_hash]
+        return cached_block_rel_height_func
+    
+    def _score_tail(self, tail_hash, block_rel_height_func):
+        head_hash = max(self.verified.tails[tail_hash], key=self.verified.get_work)
+        if tail_hash in self._tail_scores and self._tail_scores[tail_hash][0] == head_hash:
+            return self._tail_scores[tail_hash][1]
+        score = self.score(head_hash, block_rel_height_func)
+        if score[1] is not None: # otherwise it depends on the chain's height, which can still change
+            self._tail_scores[tail_hash] = head_hash, score
+        return score
     
     def attempt_verify(self, share):
         if share.hash in self.verified.items:
@@ -505,17 +1278,46 @@ class OkayTracker(forest.Tracker):
             self.verified.add(share)
             return True
     
+    def attempt_verify_chain(self, shares):
+        # shares is a connected run, newest first, as from get_chain. verifies the longest prefix of it that checks out,
+        # stopping at the first failure the same way a loop over attempt_verify would.
+        if len(shares) < self.BULK_VERIFY_THRESHOLD:
+            for share in shares:
+                if not self.attempt_verify(share):
+                    break
+            return
+        
+        state = ForwardChainState(self, shares[-1].hash)
+        bad = None # (index, failure) of the newest share that failed
+        for i in reversed(xrange(len(shares))):
+            share = shares[i]
+            height, last = self.get_height_and_last(share.hash)
+            if height < self.net.CHAIN_LENGTH + 1 and last is not None:
+                raise AssertionError()
+            state.advance(share)
+            if share.hash in self.verified.items:
+                continue
+            try:
+                share.check(self, chain_state=state)
+            except:
+                bad = i, failure.Failure()
+        
+        for share in shares[:bad[0] if bad is not None else len(shares)]:
+            if share.hash not in self.verified.items:
+                self.verified.add(share)
+        if bad is not None:
+            i, fail = bad
+            log.err(fail, 'Share check failed: %064x -> %064x' % (shares[i].hash, shares[i].previous_hash if shares[i].previous_hash is not None else 0))
+    
     def think(self, block_rel_height_func, previous_block, bits, known_txs):
         desired = set()
         bad_peer_addresses = set()
         
-        # O(len(self.heads))
-        #   make 'unverified heads' set?
         # for each overall head, attempt verification
         # if it fails, attempt on parent, and repeat
         # if no successful verification because of lack of parents, request parent
         bads = []
-        for head in set(self.heads) - set(self.verified.heads):
+        for head in list(self.unverified_heads):
             head_height, last = self.get_height_and_last(head)
             
             for share in self.get_chain(head, head_height if last is None else min(5, max(0, head_height - self.net.CHAIN_LENGTH))):
@@ -552,9 +1354,7 @@ class OkayTracker(forest.Tracker):
             can = max(last_height - 1 - self.net.CHAIN_LENGTH, 0) if last_last_hash is not None else last_height
             get = min(want, can)
             #print 'Z', head_height, last_hash is None, last_height, last_last_hash is None, want, can, get
-            for share in self.get_chain(last_hash, get):
-                if not self.attempt_verify(share):
-                    break
+            self.attempt_verify_chain(list(self.get_chain(last_hash, get)))
             if head_height < self.net.CHAIN_LENGTH and last_last_hash is not None:
                 desired.add((
                     self.items[random.choice(list(self.verified.reverse[last_hash]))].peer_addr,
@@ -564,7 +1364,8 @@ class OkayTracker(forest.Tracker):
                 ))
         
         # decide best tree
-        decorated_tails = sorted((self.score(max(self.verified.tails[tail_hash], key=self.verified.get_work), block_rel_height_func), tail_hash) for tail_hash in self.verified.tails)
+        block_rel_height_func = self._get_block_rel_height_func(block_rel_height_func, previous_block)
+        decorated_tails = sorted((self._score_tail(tail_hash, block_rel_height_func), tail_hash) for tail_hash in self.verified.tails)
         if p2pool.DEBUG:
             print len(decorated_tails), 'tails:'
             for score, tail_hash in decorated_tails:
@@ -572,12 +1373,7 @@ class OkayTracker(forest.Tracker):
         best_tail_score, best_tail = decorated_tails[-1] if decorated_tails else (None, None)
         
         # decide best verified head
-        decorated_heads = sorted(((
-            self.verified.get_work(self.verified.get_nth_parent_hash(h, min(5, self.verified.get_height(h)))),
-            #self.items[h].peer_addr is None,
-            -self.items[h].should_punish_reason(previous_block, bits, self, known_txs)[0],
-            -self.items[h].time_seen,
-        ), h) for h in self.verified.tails.get(best_tail, []))
+        decorated_heads = self.get_decorated_heads(best_tail, previous_block, bits, known_txs)
         if p2pool.DEBUG:
             print len(decorated_heads), 'heads. Top 10:'
             for score, head_hash in decorated_heads[-10:]:
@@ -639,31 +1435,23 @@ def get_pool_attempts_per_second(tracker, previous_share_hash, dist, min_work=Fa
     return attempts/time
 
 def get_average_stale_prop(tracker, share_hash, lookbehind):
-    stales = sum(1 for share in tracker.get_chain(share_hash, lookbehind) if share.share_data['stale_info'] is not None)
+    stales = tracker.get_window(tracker.share_stats, share_hash, lookbehind).stale_shares
     return stales/(lookbehind + stales)
 
 def get_stale_counts(tracker, share_hash, lookbehind, rates=False):
     res = {}
-    for share in tracker.get_chain(share_hash, lookbehind - 1):
-        res['good'] = res.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
-        s = share.share_data['stale_info']
-        if s is not None:
-            res[s] = res.get(s, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    if lookbehind > 1:
+        window = tracker.get_window(tracker.share_stats, share_hash, lookbehind - 1)
+        res['good'] = window.work
+        res.update(window.stale_work or {})
     if rates:
         dt = tracker.items[share_hash].timestamp - tracker.items[tracker.get_nth_parent_hash(share_hash, lookbehind - 1)].timestamp
         res = dict((k, v/dt) for k, v in res.iteritems())
     return res
 
 def get_user_stale_props(tracker, share_hash, lookbehind):
-    res = {}
-    for share in tracker.get_chain(share_hash, lookbehind - 1):
-        stale, total = res.get(share.share_data['pubkey_hash'], (0, 0))
-        total += 1
-        if share.share_data['stale_info'] is not None:
-            stale += 1
-            total += 1
-        res[share.share_data['pubkey_hash']] = stale, total
-    return dict((pubkey_hash, stale/total) for pubkey_hash, (stale, total) in res.iteritems())
+    counts = tracker.user_stats.get(share_hash, max(0, lookbehind - 1))
+    return dict((pubkey_hash, stale/(count + stale)) for pubkey_hash, (count, stale) in counts.iteritems())
 
 def get_expected_payouts(tracker, best_share_hash, block_target, subsidy, net):
     weights, total_weight, donation_weight = tracker.get_cumulative_weights(best_share_hash, min(tracker.get_height(best_share_hash), net.REAL_CHAIN_LENGTH), 65535*net.SPREAD*bitcoin_data.target_to_average_attempts(block_target))
@@ -672,10 +1460,7 @@ def get_expected_payouts(tracker, best_share_hash, block_target, subsidy, net):
     return res
 
 def get_desired_version_counts(tracker, best_share_hash, dist):
-    res = {}
-    for share in tracker.get_chain(best_share_hash, dist):
-        res[share.desired_version] = res.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
-    return res
+    return dict(tracker.get_window(tracker.share_stats, best_share_hash, dist).desired_version_work or {})
 
 def get_warnings(tracker, best_share, net, bitcoind_getinfo, bitcoind_work_value):
     res = []
@@ -706,102 +1491,435 @@ def format_hash(x):
         return 'xxxxxxxx'
     return '%08x' % (x % 2**32)
 
+snapshot_magic = 'p2pool tracker snapshot v1\n'
+snapshot_entry = struct.Struct('<32s32s32s') # hash, gentx_hash, pow_hash
+
+def write_tracker_snapshot(filename, tracker, net):
+    # saves the hashes that are expensive to recompute for the verified shares, see read_tracker_snapshot
+    data = snapshot_magic + net.IDENTIFIER + ''.join(snapshot_entry.pack(*[pack.IntType(256).pack(x) for x in (share.hash, share.gentx_hash, share.pow_hash)])
+        for share in tracker.verified.items.itervalues())
+    data += hashlib.sha256(data).digest()
+    with open(filename + '.new', 'wb') as f:
+        f.write(data)
+    try:
+        os.rename(filename + '.new', filename)
+    except: # XXX windows can't overwrite
+        os.remove(filename)
+        os.rename(filename + '.new', filename)
+
+def read_tracker_snapshot(filename, net):
+    # returns share hash -> (gentx_hash, pow_hash), or {} if the snapshot is missing, damaged or from another network
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return {}
+    header = snapshot_magic + net.IDENTIFIER
+    body, digest = data[:-32], data[-32:]
+    if not body.startswith(header) or (len(body) - len(header)) % snapshot_entry.size or hashlib.sha256(body).digest() != digest:
+        print >>sys.stderr, 'Tracker snapshot %s failed its integrity check, ignoring it' % (filename,)
+        return {}
+    res = {}
+    for pos in xrange(len(header), len(body), snapshot_entry.size):
+        share_hash, gentx_hash, pow_hash = [pack.IntType(256).unpack(x) for x in snapshot_entry.unpack_from(body, pos)]
+        res[share_hash] = gentx_hash, pow_hash
+    return res
+
+def read_text_share_file(filename):
+    # reader for the hex text lines ("5 <hex>", "2 <hex>") that ShareStore used to write, yields (type_id, data)
+    with open(filename, 'rb') as f:
+        for line in f:
+            try:
+                type_id_str, data_hex = line.strip().split(' ')
+                type_id = int(type_id_str)
+                if type_id == 0:
+                    pass
+                elif type_id == 1:
+                    pass
+                elif type_id == 2:
+                    yield type_id, int(data_hex, 16)
+                elif type_id == 5:
+                    yield type_id, data_hex.decode('hex')
+                else:
+                    raise NotImplementedError("share type %i" % (type_id,))
+            except Exception:
+                log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+
 class ShareStore(object):
-    def __init__(self, prefix, net, share_cb, verified_hash_cb):
+    # shares (type 5) and verified hashes (type 2) are appended as checksummed records to segment files named
+    # prefix + 'seg' + N, and an index file (prefix + 'index') says where each one is, so that shares can be read
+    # through mmap without parsing everything. files in the old text format (prefix + N) are converted on startup.
+    
+    record_header = struct.Struct('<BII') # type, payload length, crc32 of payload
+    index_entry = struct.Struct('<B32sII') # type, hash, segment, offset of record
+    max_segment_size = 10e6
+    
+    def __init__(self, prefix, net, share_cb, verified_hash_cb, checked_hashes={}):
+        # checked_hashes, share hash -> (gentx_hash, pow_hash), e.g. from read_tracker_snapshot, lets shares be loaded
+        # without checking their hash_link and PoW again
         self.dirname = os.path.dirname(os.path.abspath(prefix))
         self.filename = os.path.basename(os.path.abspath(prefix))
         self.net = net
+        self.checked_hashes = checked_hashes
+        self.index_filename = os.path.join(self.dirname, self.filename + 'index')
+        
+        self.maps = {} # segment -> mmap of it
+        self.locations = {} # (type, hash) -> (segment, offset)
+        self.record_sizes = {} # (type, hash) -> size of record, including header
+        self.desired = set() # (type, hash) of records that are still wanted
+        self.live_counts = {} # segment -> number of wanted records in it
+        self.live_bytes = {} # segment -> total size of wanted records in it
+        self.compacting = None # (segment, keys of records left to move out of it)
+        self.compaction_stats = dict(segments=0, bytes_copied=0, bytes_reclaimed=0)
+        self._load_index()
+        self._migrate_text_files()
         
-        known = {}
+        for segment in self.get_segments():
+            self.live_counts.setdefault(segment, 0)
+            self.live_bytes.setdefault(segment, 0)
+        for (type_id, hash), (segment, offset) in sorted(self.locations.iteritems(), key=lambda (k, v): v):
+            if type_id == 2:
+                verified_hash_cb(hash)
+            elif type_id == 5:
+                try:
+                    share = self._read_share(segment, offset, hash)
+                except Exception:
+                    log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+                    share = None
+                if share is None or share.hash != hash:
+                    del self.locations[type_id, hash] # so that it's written again if it comes up
+                    continue
+                share_cb(share)
+            self._want((type_id, hash))
+    
+    def get_segment_filename(self, segment):
+        return os.path.join(self.dirname, self.filename + 'seg' + str(segment))
+    
+    def get_segments(self):
+        prefix = self.filename + 'seg'
+        return sorted(int(x[len(prefix):]) for x in os.listdir(self.dirname) if x.startswith(prefix) and x[len(prefix):].isdigit())
+    
+    def _get_map(self, segment, end):
+        m = self.maps.get(segment)
+        if m is None or len(m) < end:
+            if m is not None:
+                m.close()
+            with open(self.get_segment_filename(segment), 'rb') as f:
+                m = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m
+    
+    def _close_map(self, segment):
+        m = self.maps.pop(segment, None)
+        if m is not None:
+            m.close()
+    
+    def _read_record(self, segment, offset):
+        m = self._get_map(segment, offset + self.record_header.size)
+        type_id, length, crc = self.record_header.unpack_from(m, offset)
+        start = offset + self.record_header.size
+        m = self._get_map(segment, start + length)
+        payload = m[start:start + length]
+        if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+            raise ValueError('corrupt record at %s:%i' % (self.get_segment_filename(segment), offset))
+        return type_id, payload
+    
+    def _read_share(self, segment, offset, share_hash=None, checked_hashes=None):
+        # returns None for shares of obsolete versions
+        type_id, payload = self._read_record(segment, offset)
+        assert type_id == 5
+        raw_share = share_type.unpack(payload)
+        if raw_share['type'] < Share.VERSION:
+            return None
+        if checked_hashes is None:
+            checked_hashes = self.checked_hashes.get(share_hash)
+        if checked_hashes is not None:
+            share = load_share(raw_share, self.net, None, checked_hashes=checked_hashes)
+            if share.hash == share_hash:
+                return share
+        return load_share(raw_share, self.net, None)
+    
+    def has_share(self, share_hash):
+        return (5, share_hash) in self.locations
+    
+    def get_share(self, share_hash, checked_hashes=None):
+        # loads a single share from disk, or returns None if it isn't stored
+        if (5, share_hash) not in self.locations:
+            return None
+        segment, offset = self.locations[5, share_hash]
+        return self._read_share(segment, offset, share_hash, checked_hashes)
+    
+    def get_raw_share(self, share_hash):
+        # returns the stored share as it would be sent to peers, without loading it, or None if it isn't stored
+        if (5, share_hash) not in self.locations:
+            return None
+        type_id, payload = self._read_record(*self.locations[5, share_hash])
+        return share_type.unpack(payload)
+    
+    def _load_index(self):
+        segments = set(self.get_segments())
+        changed = False
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'rb') as f:
+                data = f.read()
+            for pos in xrange(0, len(data) - self.index_entry.size + 1, self.index_entry.size):
+                type_id, hash_str, segment, offset = self.index_entry.unpack_from(data, pos)
+                if segment in segments:
+                    self.locations[type_id, pack.IntType(256).unpack(hash_str)] = segment, offset
+                else: # segment was removed, so don't let a new segment with the same number inherit this
+                    changed = True
+        
+        # records written after the last index entry that made it to disk (e.g. when killed in between) are found by
+        # scanning the ends of the segments, and anything cut off is dropped
+        ends = {}
+        for (type_id, hash), (segment, offset) in self.locations.items():
+            try:
+                _, length, _ = self.record_header.unpack_from(self._get_map(segment, offset + self.record_header.size), offset)
+            except Exception:
+                del self.locations[type_id, hash]
+                changed = True
+                continue
+            self.record_sizes[type_id, hash] = self.record_header.size + length
+            ends[segment] = max(ends.get(segment, 0), offset + self.record_header.size + length)
+        for segment in sorted(segments):
+            pos, size = ends.get(segment, 0), os.path.getsize(self.get_segment_filename(segment))
+            while pos < size:
+                try:
+                    type_id, payload = self._read_record(segment, pos)
+                    if type_id == 2:
+                        hash = pack.IntType(256).unpack(payload)
+                    else:
+                        share = self._read_share(segment, pos)
+                        hash = share.hash if share is not None else None
+                except Exception:
+                    log.err(None, "HARMLESS error while reading saved shares, dropping the rest of %s:" % (self.get_segment_filename(segment),))
+                    self._close_map(segment)
+                    with open(self.get_segment_filename(segment), 'r+b') as f:
+                        f.truncate(pos)
+                    break
+                if hash is not None:
+                    self.locations[type_id, hash] = segment, pos
+                    self.record_sizes[type_id, hash] = self.record_header.size + len(payload)
+                pos += self.record_header.size + len(payload)
+            changed = changed or pos != ends.get(segment, 0)
+        if changed:
+            self._write_index()
+    
+    def _write_index(self):
+        data = ''.join(self.index_entry.pack(type_id, pack.IntType(256).pack(hash), segment, offset)
+            for (type_id, hash), (segment, offset) in sorted(self.locations.iteritems(), key=lambda (k, v): v))
+        with open(self.index_filename + '.new', 'wb') as f:
+            f.write(data)
+        try:
+            os.rename(self.index_filename + '.new', self.index_filename)
+        except: # XXX windows can't overwrite
+            os.remove(self.index_filename)
+            os.rename(self.index_filename + '.new', self.index_filename)
+    
+    def _migrate_text_files(self):
         filenames, next = self.get_filenames_and_next()
+        if not filenames:
+            return
+        print 'Converting %i share files to the binary format...' % (len(filenames),)
         for filename in filenames:
-            share_hashes, verified_hashes = known.setdefault(filename, (set(), set()))
-            with open(filename, 'rb') as f:
-                for line in f:
-                    try:
-                        type_id_str, data_hex = line.strip().split(' ')
-                        type_id = int(type_id_str)
-                        if type_id == 0:
-                            pass
-                        elif type_id == 1:
-                            pass
-                        elif type_id == 2:
-                            verified_hash = int(data_hex, 16)
-                            verified_hash_cb(verified_hash)
-                            verified_hashes.add(verified_hash)
-                        elif type_id == 5:
-                            raw_share = share_type.unpack(data_hex.decode('hex'))
-                            if raw_share['type'] < Share.VERSION:
-                                continue
-                            share = load_share(raw_share, self.net, None)
-                            share_cb(share)
-                            share_hashes.add(share.hash)
-                        else:
-                            raise NotImplementedError("share type %i" % (type_id,))
-                    except Exception:
-                        log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
-        
-        self.known = known # filename -> (set of share hashes, set of verified hashes)
-        self.known_desired = dict((k, (set(a), set(b))) for k, (a, b) in known.iteritems())
-    
-    def _add_line(self, line):
-        filenames, next = self.get_filenames_and_next()
-        if filenames and os.path.getsize(filenames[-1]) < 10e6:
-            filename = filenames[-1]
+            for type_id, data in read_text_share_file(filename):
+                try:
+                    if type_id == 2:
+                        if (2, data) not in self.locations:
+                            self._add_record(2, data, pack.IntType(256).pack(data))
+                    elif type_id == 5:
+                        raw_share = share_type.unpack(data)
+                        if raw_share['type'] < Share.VERSION:
+                            continue
+                        share = load_share(raw_share, self.net, None)
+                        if (5, share.hash) not in self.locations:
+                            self._add_record(5, share.hash, data)
+                except Exception:
+                    log.err(None, "HARMLESS error while converting saved shares, continuing where left off:")
+            os.remove(filename)
+        print '    ...done!'
+    
+    def _add_record(self, type_id, hash, payload):
+        segments = self.get_segments()
+        if segments and os.path.getsize(self.get_segment_filename(segments[-1])) < self.max_segment_size:
+            segment = segments[-1]
         else:
-            filename = next
+            segment = segments[-1] + 1 if segments else 0
         
-        with open(filename, 'ab') as f:
-            f.write(line + '\n')
+        wanted = (type_id, hash) in self.desired
+        if wanted: # being moved by compact
+            self._unwant((type_id, hash), check=False)
         
-        return filename
+        with open(self.get_segment_filename(segment), 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(self.record_header.pack(type_id, len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+        with open(self.index_filename, 'ab') as f:
+            f.write(self.index_entry.pack(type_id, pack.IntType(256).pack(hash), segment, offset))
+        self.locations[type_id, hash] = segment, offset
+        self.record_sizes[type_id, hash] = self.record_header.size + len(payload)
+        self.live_counts.setdefault(segment, 0)
+        self.live_bytes.setdefault(segment, 0)
+        
+        if wanted:
+            self._want((type_id, hash))
+    
+    def _want(self, key):
+        if key not in self.desired:
+            self.desired.add(key)
+            segment = self.locations[key][0]
+            self.live_counts[segment] += 1
+            self.live_bytes[segment] += self.record_sizes[key]
+    
+    def _unwant(self, key, check=True):
+        if key in self.desired:
+            self.desired.remove(key)
+            segment = self.locations[key][0]
+            self.live_counts[segment] -= 1
+            self.live_bytes[segment] -= self.record_sizes[key]
+            if check and not self.live_counts[segment]:
+                self.check_remove()
     
     def add_share(self, share):
-        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
-            if share.hash in share_hashes:
-                break
-        else:
-            filename = self._add_line("%i %s" % (5, share_type.pack(share.as_share()).encode('hex')))
-            share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
-            share_hashes.add(share.hash)
-        share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
-        share_hashes.add(share.hash)
+        if (5, share.hash) not in self.locations:
+            self._add_record(5, share.hash, share_type.pack(share.as_share()))
+        self._want((5, share.hash))
     
     def add_verified_hash(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
-            if share_hash in verified_hashes:
-                break
-        else:
-            filename = self._add_line("%i %x" % (2, share_hash))
-            share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
-            verified_hashes.add(share_hash)
-        share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
-        verified_hashes.add(share_hash)
+        if (2, share_hash) not in self.locations:
+            self._add_record(2, share_hash, pack.IntType(256).pack(share_hash))
+        self._want((2, share_hash))
     
     def get_filenames_and_next(self):
+        # old text format files
         suffixes = sorted(int(x[len(self.filename):]) for x in os.listdir(self.dirname) if x.startswith(self.filename) and x[len(self.filename):].isdigit())
         return [os.path.join(self.dirname, self.filename + str(suffix)) for suffix in suffixes], os.path.join(self.dirname, self.filename + (str(suffixes[-1] + 1) if suffixes else str(0)))
     
     def forget_share(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            if share_hash in share_hashes:
-                share_hashes.remove(share_hash)
-        self.check_remove()
+        self._unwant((5, share_hash))
     
     def forget_verified_share(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            if share_hash in verified_hashes:
-                verified_hashes.remove(share_hash)
-        self.check_remove()
+        self._unwant((2, share_hash))
     
     def check_remove(self):
-        to_remove = set()
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            #print filename, len(share_hashes) + len(verified_hashes)
-            if not share_hashes and not verified_hashes:
-                to_remove.add(filename)
-        for filename in to_remove:
-            self.known.pop(filename)
-            self.known_desired.pop(filename)
+        to_remove = set(segment for segment, count in self.live_counts.iteritems() if not count)
+        for segment in to_remove:
+            filename = self.get_segment_filename(segment)
+            if self.compacting is not None and self.compacting[0] == segment:
+                self.compaction_stats['bytes_reclaimed'] += os.path.getsize(filename)
+                self.compaction_stats['segments'] += 1
+                self.compacting = None
+                print 'Compacted %s (%i bytes reclaimed and %i copied over %i segments so far)' % (filename,
+                    self.compaction_stats['bytes_reclaimed'], self.compaction_stats['bytes_copied'], self.compaction_stats['segments'])
+            del self.live_counts[segment]
+            del self.live_bytes[segment]
+            self._close_map(segment)
             os.remove(filename)
             print "REMOVED", filename
+        if to_remove:
+            self.locations = dict((k, v) for k, v in self.locations.iteritems() if v[0] not in to_remove)
+            self.record_sizes = dict((k, v) for k, v in self.record_sizes.iteritems() if k in self.locations)
+            self._write_index()
+    
+    def compact(self, max_bytes, min_live_ratio=0.5):
+        # moves up to max_bytes of wanted records out of the segment with the smallest wanted fraction, if that's
+        # below min_live_ratio, into the segment being appended to. once a segment has nothing wanted left,
+        # check_remove deletes it. returns the number of bytes copied
+        if self.compacting is None:
+            segments = self.get_segments()[:-1] # never the one being appended to
+            ratios = [(self.live_bytes[segment]/max(1, os.path.getsize(self.get_segment_filename(segment))), segment) for segment in segments]
+            ratios = [(ratio, segment) for ratio, segment in ratios if ratio < min_live_ratio]
+            if not ratios:
+                return 0
+            ratio, segment = min(ratios)
+            self.compacting = segment, sorted((key for key in self.desired if self.locations[key][0] == segment), key=lambda key: self.locations[key][1])
+        
+        segment, keys = self.compacting
+        copied = 0
+        while keys and copied < max_bytes:
+            key = keys.pop()
+            if key not in self.desired or self.locations[key][0] != segment:
+                continue
+            try:
+                type_id, payload = self._read_record(*self.locations[key])
+            except Exception:
+                log.err(None, "HARMLESS error while compacting saved shares, dropping record:")
+                self._unwant(key, check=False)
+                continue
+            self._add_record(key[0], key[1], payload)
+            copied += self.record_sizes[key]
+        self.compaction_stats['bytes_copied'] += copied
+        if not keys:
+            if self.live_counts.get(segment): # something in it was wanted again in the meantime; it'll be picked again
+                self.compacting = None
+            else:
+                self.check_remove()
+        return copied
+
+class ColdShare(object):
+    # stands in for a share that ColdShareTier moved out of memory. it keeps what the tracker's deltas and indexes, think
+    # and the web stats read, and anything else is read back from the share store through the tier, which keeps the last
+    # few shares it read
+    kept = 'VERSION net peer_addr hash previous_hash share_data header target max_target timestamp time_seen new_script desired_version absheight abswork gentx_hash pow_hash header_hash'.split(' ')
+    __slots__ = kept + ['share_class', 'tier']
+    
+    def __init__(self, share, tier):
+        for name in self.kept:
+            setattr(self, name, getattr(share, name))
+        self.share_class = share.share_class
+        self.tier = tier
+    
+    def __repr__(self):
+        return 'ColdShare(%s)' % (format_hash(self.hash),)
+    
+    def load(self):
+        share = self.tier.loaded.get(self.hash)
+        if share is None:
+            share = self.tier.store.get_share(self.hash, checked_hashes=(self.gentx_hash, self.pow_hash))
+            if share is None:
+                raise ValueError('cold share %064x missing from share store' % (self.hash,))
+            share.peer_addr, share.time_seen = self.peer_addr, self.time_seen
+            self.tier.loaded[self.hash] = share
+        return share
+    
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+    
+    def as_share(self):
+        return self.tier.store.get_raw_share(self.hash)
+
+class ColdShareTier(object):
+    # keeps only the newest depth shares of the best chain fully in memory. older ones that are in the share store are
+    # replaced in the tracker by ColdShares, so heights, work and the tracker's views stay exact while most of each share
+    # lives on disk, where handle_get_shares and the web interface can still get at it by hash
+    MIN_DEPTH = 120 # forget_old_txs and transaction_hash_refs read whole shares this far back from the best share
+    LOADED_SHARES = 100 # shares read back from disk that are kept around
+    
+    @classmethod
+    def get_min_depth(cls, net):
+        return max(net.REAL_CHAIN_LENGTH, cls.MIN_DEPTH)
+    
+    def __init__(self, tracker, store, depth):
+        if depth < self.get_min_depth(tracker.net):
+            raise ValueError('cold share depth must be at least %i' % (self.get_min_depth(tracker.net),))
+        self.tracker = tracker
+        self.store = store
+        self.depth = depth
+        self.evicted = 0
+        self.loaded = memoize.LRUDict(self.LOADED_SHARES)
+    
+    def evict(self, best_share_hash):
+        if best_share_hash is None or self.tracker.get_height(best_share_hash) <= self.depth:
+            return
+        # everything below a ColdShare was evicted before
+        share_hash = self.tracker.get_nth_parent_hash(best_share_hash, self.depth)
+        while share_hash in self.tracker.items and not isinstance(self.tracker.items[share_hash], ColdShare):
+            share = self.tracker.items[share_hash]
+            if self.store.has_share(share_hash):
+                cold_share = ColdShare(share, self)
+                self.tracker.items[share_hash] = cold_share
+                if share_hash in self.tracker.verified.items:
+                    self.tracker.verified.items[share_hash] = cold_share
+                self.evicted += 1
+            share_hash = share.previous_hash
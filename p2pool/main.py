@@ -22,7 +22,7 @@ from nattraverso import portmapper, ipdiscover
 import bitcoin.p2p as bitcoin_p2p, bitcoin.data as bitcoin_data
 from bitcoin import stratum, worker_interface, helper
 from util import fixargparse, jsonrpc, variable, deferral, math, logging, switchprotocol
-from . import networks, web, work
+from . import networks, validation, web, work
 import p2pool, p2pool.data as p2pool_data, p2pool.node as p2pool_node
 
 class keypool():
@@ -72,7 +72,7 @@ class keypool():
         return self.payouttotal
 
 @defer.inlineCallbacks
-def main(args, net, datadir_path, merged_urls, worker_endpoint):
+def main(args, net, datadir_path, merged_urls, worker_endpoint, share_validator):
     try:
         print 'p2pool (version %s)' % (p2pool.__version__,)
         print
@@ -177,14 +177,16 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
             shares[share.hash] = share
             if len(shares) % 1000 == 0 and shares:
                 print "    %i" % (len(shares),)
-        ss = p2pool_data.ShareStore(os.path.join(datadir_path, 'shares.'), net, share_cb, known_verified.add)
+        snapshot_filename = os.path.join(datadir_path, 'tracker_snapshot')
+        ss = p2pool_data.ShareStore(os.path.join(datadir_path, 'shares.'), net, share_cb, known_verified.add,
+            checked_hashes=p2pool_data.read_tracker_snapshot(snapshot_filename, net))
         print "    ...done loading %i shares (%i verified)!" % (len(shares), len(known_verified))
         print
         
         
         print 'Initializing work...'
         
-        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net)
+        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net, think_delay=args.think_delay)
         yield node.start()
         
         for share_hash in shares:
@@ -196,12 +198,41 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         node.tracker.removed.watch(lambda share: ss.forget_share(share.hash))
         node.tracker.verified.removed.watch(lambda share: ss.forget_verified_share(share.hash))
         
+        # shares (and verified hashes) that haven't been saved yet. they're saved once they're within 2*CHAIN_LENGTH of
+        # the best share, so ones on other chains stay here until the tracker drops them
+        unsaved_shares = set(node.tracker.items)
+        unsaved_verified = set(node.tracker.verified.items)
+        node.tracker.added.watch(lambda share: unsaved_shares.add(share.hash))
+        node.tracker.verified.added.watch(lambda share: unsaved_verified.add(share.hash))
+        node.tracker.removed.watch(lambda share: unsaved_shares.discard(share.hash))
+        node.tracker.verified.removed.watch(lambda share: unsaved_verified.discard(share.hash))
         def save_shares():
-            for share in node.tracker.get_chain(node.best_share_var.value, min(node.tracker.get_height(node.best_share_var.value), 2*net.CHAIN_LENGTH)):
-                ss.add_share(share)
-                if share.hash in node.tracker.verified.items:
-                    ss.add_verified_hash(share.hash)
+            best = node.best_share_var.value
+            if best is None:
+                return
+            best_height = node.tracker.get_height(best)
+            def should_save(share_hash):
+                dist = best_height - node.tracker.get_height(share_hash)
+                return 0 <= dist < min(best_height, 2*net.CHAIN_LENGTH) and node.tracker.get_nth_parent_hash(best, dist) == share_hash
+            for share_hash in [h for h in unsaved_shares if should_save(h)]:
+                ss.add_share(node.tracker.items[share_hash])
+                unsaved_shares.remove(share_hash)
+            for share_hash in [h for h in unsaved_verified if h not in unsaved_shares and should_save(h)]:
+                ss.add_verified_hash(share_hash)
+                unsaved_verified.remove(share_hash)
         deferral.RobustLoopingCall(save_shares).start(60)
+        cold_share_depth = args.cold_share_depth if args.cold_share_depth is not None else max(net.CHAIN_LENGTH + 10, p2pool_data.ColdShareTier.get_min_depth(net))
+        if cold_share_depth:
+            # keeps only the newest shares fully in memory, the rest are read from the share store when needed
+            cold_tier = p2pool_data.ColdShareTier(node.tracker, ss, cold_share_depth)
+            deferral.RobustLoopingCall(lambda: cold_tier.evict(node.best_share_var.value)).start(60)
+        # lets the next start skip checking the PoW of verified shares again
+        save_snapshot = lambda: p2pool_data.write_tracker_snapshot(snapshot_filename, node.tracker, net)
+        deferral.RobustLoopingCall(save_snapshot).start(600)
+        reactor.addSystemEventTrigger('before', 'shutdown', save_snapshot)
+        
+        # rewrites mostly-dead share files a little at a time, at most 256 kB/s
+        deferral.RobustLoopingCall(ss.compact, 64e3).start(.25)
 
         if len(shares) > net.CHAIN_LENGTH:
             best_share = shares[node.best_share_var.value]
@@ -253,6 +284,7 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
             desired_outgoing_conns=args.p2pool_outgoing_conns,
             advertise_ip=args.advertise_ip,
             external_ip=args.p2pool_external_ip,
+            share_validator=share_validator,
         )
         node.p2p_node.start()
         
@@ -506,6 +538,15 @@ def run():
     p2pool_group.add_argument('--external-ip', metavar='ADDR[:PORT]',
         help='specify your own public IP address instead of asking peers to discover it, useful for running dual WAN or asymmetric routing',
         type=str, action='store', default=None, dest='p2pool_external_ip')
+    p2pool_group.add_argument('--share-validation-workers', metavar='WORKERS',
+        help='number of worker processes used to check the proof of work of shares received from peers, keeping big batches of shares from stalling miners. 0 checks them in the main process (default: 0)',
+        type=int, action='store', default=0, dest='share_validation_workers')
+    p2pool_group.add_argument('--think-delay', metavar='SECONDS',
+        help='how long to collect new shares and work changes for before choosing the best share again. new blocks are always handled immediately (default: 0.1)',
+        type=float, action='store', default=0.1, dest='think_delay')
+    p2pool_group.add_argument('--cold-share-depth', metavar='SHARES',
+        help='keep only this many of the newest shares of the best chain fully in memory; older ones are read back from the share files when peers or the web interface ask for them. 0 keeps all of them in memory, anything else has to be at least the real chain length and 120 (default: chain length + 10)',
+        type=int, action='store', default=None, dest='cold_share_depth')
     parser.add_argument('--disable-advertise',
         help='''don't advertise local IP address as being available for incoming connections. useful for running a dark node, along with multiple -n ADDR's and --outgoing-conns 0''',
         action='store_false', default=True, dest='advertise_ip')
@@ -604,6 +645,9 @@ def run():
     if args.p2pool_outgoing_conns > 10:
         parser.error('''--outgoing-conns can't be more than 10''')
     
+    if args.cold_share_depth and args.cold_share_depth < p2pool_data.ColdShareTier.get_min_depth(net):
+        parser.error('--cold-share-depth must be 0 or at least %i' % (p2pool_data.ColdShareTier.get_min_depth(net),))
+    
     if args.worker_endpoint is None:
         worker_endpoint = '', net.WORKER_PORT
     elif ':' not in args.worker_endpoint:
@@ -671,5 +715,9 @@ def run():
     if not args.no_bugreport:
         log.addObserver(ErrorReporter().emit)
     
-    reactor.callWhenRunning(main, args, net, datadir_path, merged_urls, worker_endpoint)
+    # started before the reactor so that no other threads exist when the worker processes are forked
+    share_validator = validation.ShareValidator(net, workers=args.share_validation_workers)
+    reactor.addSystemEventTrigger('before', 'shutdown', share_validator.stop)
+    
+    reactor.callWhenRunning(main, args, net, datadir_path, merged_urls, worker_endpoint, share_validator)
     reactor.run()
@@ -20,11 +20,15 @@ class P2PNode(p2p.Node):
             mining_txs_var=node.mining_txs_var,
         **kwargs)
     
+    def is_share_known(self, share_hash):
+        return share_hash in self.node.tracker.items
+    
     def handle_shares(self, shares, peer):
         if len(shares) > 5:
             print 'Processing %i shares from %s...' % (len(shares), '%s:%i' % peer.addr if peer is not None else None)
         
         new_count = 0
+        block_count = 0
         all_new_txs = {}
         for share, new_txs in shares:
             if new_txs is not None:
@@ -35,6 +39,8 @@ class P2PNode(p2p.Node):
                 continue
             
             new_count += 1
+            if share.pow_hash <= share.header['bits'].target:
+                block_count += 1
             
             #print 'Received share %s from %r' % (p2pool_data.format_hash(share.hash), share.peer_addr)
             
@@ -45,7 +51,7 @@ class P2PNode(p2p.Node):
         self.node.known_txs_var.set(new_known_txs)
         
         if new_count:
-            self.node.set_best_share()
+            self.node.set_best_share(immediate=block_count > 0)
         
         if len(shares) > 5:
             print '... done processing %i shares. New: %i Have: %i/~%i' % (len(shares), new_count, len(self.node.tracker.items), 2*self.node.net.CHAIN_LENGTH)
@@ -157,10 +163,18 @@ class P2PNode(p2p.Node):
         
 
 class Node(object):
-    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net):
+    CLEAN_TRACKER_BUDGET = 1000 # shares clean_tracker removes at most per call; the rest wait for the next one
+    
+    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net, think_delay=0):
         self.factory = factory
         self.bitcoind = bitcoind
         self.net = net
+        self.think_delay = think_delay # seconds over which set_best_share calls are coalesced into one think
+        
+        self._think_call = None
+        self._think_block = None # previous_block that the last think was done with
+        self.think_requests = 0
+        self.thinks = 0
         
         self.tracker = p2pool_data.OkayTracker(self.net)
         
@@ -171,6 +185,8 @@ class Node(object):
             if share_hash in self.tracker.items:
                 self.tracker.verified.add(self.tracker.items[share_hash])
         
+        self.eviction_index = p2pool_data.EvictionIndex(self.tracker, 2*self.net.CHAIN_LENGTH + 10)
+        
         self.p2p_node = None # overwritten externally
     
     @defer.inlineCallbacks
@@ -296,8 +312,30 @@ class Node(object):
         t = deferral.RobustLoopingCall(self.clean_tracker)
         t.start(5)
         stop_signal.watch(t.stop)
+        
+        @stop_signal.watch
+        def _():
+            if self._think_call is not None:
+                self._think_call.cancel()
+                self._think_call = None
     
-    def set_best_share(self):
+    def set_best_share(self, immediate=False):
+        # thinks within think_delay seconds, so that a burst of calls is handled by one think. a new block is handled right
+        # away, as is anything the caller marks immediate (shares that solve a block, our own shares)
+        self.think_requests += 1
+        if immediate or not self.think_delay or self.bitcoind_work.value['previous_block'] != self._think_block:
+            self._think()
+        elif self._think_call is None:
+            self._think_call = reactor.callLater(self.think_delay, self._think)
+    
+    def _think(self):
+        if self._think_call is not None:
+            if self._think_call.active():
+                self._think_call.cancel()
+            self._think_call = None
+        self.thinks += 1
+        self._think_block = self.bitcoind_work.value['previous_block']
+        
         best, desired, decorated_heads, bad_peer_addresses = self.tracker.think(self.get_height_rel_highest, self.bitcoind_work.value['previous_block'], self.bitcoind_work.value['bits'], self.known_txs_var.value)
         
         self.best_share_var.set(best)
@@ -316,48 +354,38 @@ class Node(object):
     def clean_tracker(self):
         best, desired, decorated_heads, bad_peer_addresses = self.tracker.think(self.get_height_rel_highest, self.bitcoind_work.value['previous_block'], self.bitcoind_work.value['bits'], self.known_txs_var.value)
         
-        # eat away at heads
+        budget = self.CLEAN_TRACKER_BUDGET
+        
+        # eat away at heads, longest-seen first
         if decorated_heads:
-            for i in xrange(1000):
-                to_remove = set()
-                for share_hash, tail in self.tracker.heads.iteritems():
-                    if share_hash in [head_hash for score, head_hash in decorated_heads[-5:]]:
-                        #print 1
-                        continue
-                    if self.tracker.items[share_hash].time_seen > time.time() - 300:
-                        #print 2
-                        continue
-                    if share_hash not in self.tracker.verified.items and max(self.tracker.items[after_tail_hash].time_seen for after_tail_hash in self.tracker.reverse.get(tail)) > time.time() - 120: # XXX stupid
-                        #print 3
-                        continue
-                    to_remove.add(share_hash)
-                if not to_remove:
+            best_heads = set(head_hash for score, head_hash in decorated_heads[-5:])
+            kept = set()
+            while budget:
+                share_hash = self.eviction_index.pop_head(time.time() - 300)
+                if share_hash is None:
                     break
-                for share_hash in to_remove:
-                    if share_hash in self.tracker.verified.items:
-                        self.tracker.verified.remove(share_hash)
-                    self.tracker.remove(share_hash)
-                #print "_________", to_remove
-        
-        # drop tails
-        for i in xrange(1000):
-            to_remove = set()
-            for tail, heads in self.tracker.tails.iteritems():
-                if min(self.tracker.get_height(head) for head in heads) < 2*self.tracker.net.CHAIN_LENGTH + 10:
+                if share_hash in kept:
                     continue
-                to_remove.update(self.tracker.reverse.get(tail, set()))
-            if not to_remove:
+                if share_hash in best_heads or share_hash not in self.tracker.verified.items and max(self.tracker.items[after_tail_hash].time_seen for after_tail_hash in self.tracker.reverse.get(self.tracker.heads[share_hash])) > time.time() - 120: # XXX stupid
+                    kept.add(share_hash)
+                    continue
+                if share_hash in self.tracker.verified.items:
+                    self.tracker.verified.remove(share_hash)
+                self.tracker.remove(share_hash)
+                budget -= 1
+            for share_hash in kept:
+                self.eviction_index.push_head(share_hash)
+        
+        # drop tails, tallest chains first
+        while budget > 0:
+            tail = self.eviction_index.pop_tail()
+            if tail is None:
                 break
             # if removed from this, it must be removed from verified
-            #start = time.time()
-            for aftertail in to_remove:
-                if self.tracker.items[aftertail].previous_hash not in self.tracker.tails:
-                    print "erk", aftertail, self.tracker.items[aftertail].previous_hash
-                    continue
+            for aftertail in list(self.tracker.reverse[tail]):
                 if aftertail in self.tracker.verified.items:
                     self.tracker.verified.remove(aftertail)
                 self.tracker.remove(aftertail)
-            #end = time.time()
-            #print "removed! %i %f" % (len(to_remove), (end - start)/len(to_remove))
+                budget -= 1
         
         self.set_best_share()
@@ -9,7 +9,7 @@ from twisted.internet import defer, protocol, reactor
 from twisted.python import failure, log
 
 import p2pool
-from p2pool import data as p2pool_data
+from p2pool import data as p2pool_data, validation
 from p2pool.bitcoin import data as bitcoin_data
 from p2pool.util import deferral, p2protocol, pack, variable
 
@@ -78,6 +78,8 @@ class Protocol(p2protocol.Protocol):
         self.remembered_txs = {} # view of peer's mining_txs
         self.remembered_txs_size = 0
         self.known_txs_cache = {}
+        
+        self.paused_for_share_validator = False
     
     def _connect_timeout(self):
         self.timeout_delayed = None
@@ -281,17 +283,43 @@ class Protocol(p2protocol.Protocol):
         ('shares', pack.ListType(p2pool_data.share_type)),
     ])
     def handle_shares(self, shares):
+        shares = self._drop_known_shares([wrappedshare for wrappedshare in shares if wrappedshare['type'] >= p2pool_data.Share.VERSION])
+        # later messages (forget_tx, new work) can change these before the shares come back from the validator
+        known_txs = self.node.known_txs_var.value
+        known_txs_caches = self.known_txs_cache.values()
+        d = self.node.share_validator.load_shares(shares, self.addr, self)
+        d.addCallback(self._got_shares, shares, known_txs, known_txs_caches)
+        d.addErrback(self._share_loading_failed)
+        self._wait_for_share_validator()
+    
+    def _drop_known_shares(self, shares):
+        # peers often resend shares we already have, so recognize those before paying for their PoW and full decoding
+        stats = self.node.known_share_stats
+        res = []
+        for share in shares:
+            stats['checked'] += 1
+            try:
+                share_hash = p2pool_data.get_share_hash(share, self.node.net)
+            except Exception:
+                res.append(share) # load_share will report what's wrong with it
+                continue
+            if self.node.is_share_known(share_hash):
+                stats['dropped'] += 1
+                stats['dropped_bytes'] += len(share['contents'])
+                continue
+            res.append(share)
+        return res
+    
+    def _got_shares(self, loaded_shares, shares, known_txs, known_txs_caches):
         result = []
-        for wrappedshare in shares:
-            if wrappedshare['type'] < p2pool_data.Share.VERSION: continue
-            share = p2pool_data.load_share(wrappedshare, self.node.net, self.addr)
+        for wrappedshare, share in zip(shares, loaded_shares):
             if wrappedshare['type'] >= 13:
                 txs = []
-                for tx_hash in share.share_info['new_transaction_hashes']:
-                    if tx_hash in self.node.known_txs_var.value:
-                        tx = self.node.known_txs_var.value[tx_hash]
+                for tx_hash in share.new_transaction_hashes:
+                    if tx_hash in known_txs:
+                        tx = known_txs[tx_hash]
                     else:
-                        for cache in self.known_txs_cache.itervalues():
+                        for cache in known_txs_caches:
                             if tx_hash in cache:
                                 tx = cache[tx_hash]
                                 print 'Transaction %064x rescued from peer latency cache!' % (tx_hash,)
@@ -308,12 +336,34 @@ class Protocol(p2protocol.Protocol):
             
         self.node.handle_shares(result, self)
     
+    def _share_loading_failed(self, fail):
+        if fail.check(PeerMisbehavingError):
+            print 'Peer %s:%i misbehaving, will drop and ban. Reason:' % self.addr, fail.value.message
+            self.badPeerHappened()
+            return
+        log.err(fail, 'Error handling shares from %s:' % ('%s:%i' % self.addr,))
+        self.disconnect()
+    
+    def _wait_for_share_validator(self):
+        # stop reading from this peer while the validator is backed up
+        if self.paused_for_share_validator or not self.node.share_validator.is_full():
+            return
+        self.paused_for_share_validator = True
+        self.transport.pauseProducing()
+        def resume(_):
+            self.paused_for_share_validator = False
+            if self.node.share_validator.is_full():
+                self._wait_for_share_validator()
+            elif self.connected:
+                self.transport.resumeProducing()
+        self.node.share_validator.wait_for_room().addCallback(resume)
+    
     def sendShares(self, shares, tracker, known_txs, include_txs_with=[]):
         tx_hashes = set()
         for share in shares:
             if share.VERSION >= 13:
                 # send full transaction for every new_transaction_hash that peer does not know
-                for tx_hash in share.share_info['new_transaction_hashes']:
+                for tx_hash in share.new_transaction_hashes:
                     assert tx_hash in known_txs, 'tried to broadcast share without knowing all its new transactions'
                     if tx_hash not in self.remote_tx_hashes:
                         tx_hashes.add(tx_hash)
@@ -360,10 +410,15 @@ class Protocol(p2protocol.Protocol):
     class ShareReplyError(Exception): pass
     def handle_sharereply(self, id, result, shares):
         if result == 'good':
-            res = [p2pool_data.load_share(share, self.node.net, self.addr) for share in shares if share['type'] >= p2pool_data.Share.VERSION]
+            d = self.node.share_validator.load_shares(self._drop_known_shares([share for share in shares if share['type'] >= p2pool_data.Share.VERSION]), self.addr, self)
+            d.addCallback(lambda res: self.get_shares.got_response(id, res))
+            @d.addErrback
+            def _(fail):
+                self.get_shares.got_response(id, fail) # so the request doesn't have to wait for its timeout
+                self._share_loading_failed(fail)
+            self._wait_for_share_validator()
         else:
-            res = failure.Failure(self.ShareReplyError(result))
-        self.get_shares.got_response(id, res)
+            self.get_shares.got_response(id, failure.Failure(self.ShareReplyError(result)))
     
     
     message_bestblock = pack.ComposedType([
@@ -609,7 +664,7 @@ class SingleClientFactory(protocol.ReconnectingClientFactory):
         self.node.lost_conn(proto, reason)
 
 class Node(object):
-    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=variable.Variable({}), mining_txs_var=variable.Variable({}), advertise_ip=True, external_ip=None):
+    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=variable.Variable({}), mining_txs_var=variable.Variable({}), advertise_ip=True, external_ip=None, share_validator=None):
         self.best_share_hash_func = best_share_hash_func
         self.port = port
         self.net = net
@@ -620,6 +675,8 @@ class Node(object):
         self.mining_txs_var = mining_txs_var
         self.advertise_ip = advertise_ip
         self.external_ip = external_ip
+        self.share_validator = share_validator if share_validator is not None else validation.ShareValidator(net)
+        self.known_share_stats = dict(checked=0, dropped=0, dropped_bytes=0) # shares received, and those recognized before loading
         
         self.traffic_happened = variable.Event()
         self.nonce = random.randrange(2**64)
@@ -690,6 +747,9 @@ class Node(object):
             if len(self.addr_store) < 10000:
                 self.addr_store[host, port] = services, timestamp, timestamp
     
+    def is_share_known(self, share_hash):
+        return False
+    
     def handle_shares(self, shares, peer):
         print 'handle_shares', (shares, peer)
     
@@ -35,3 +35,11 @@ class Test(unittest.TestCase):
             b.update(test2)
             b = b.hexdigest()
             assert a == b
+    
+    def test_process_blocks(self):
+        if sha256._process_blocks_native is None:
+            raise unittest.SkipTest('sha256_midstate extension not installed')
+        for i in xrange(100):
+            state = ''.join(chr(random.randrange(256)) for i in xrange(32))
+            data = ''.join(chr(random.randrange(256)) for i in xrange(64*random.randrange(10)))
+            assert sha256._process_blocks_native(state, data) == sha256._process_blocks_python(state, data)
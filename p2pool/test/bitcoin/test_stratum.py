@@ -0,0 +1,172 @@
+import json
+import time
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool.bitcoin import data as bitcoin_data, stratum, worker_interface
+from p2pool.util import deferral
+
+class FakeWorkerBridge(worker_interface.WorkerBridge):
+    COINBASE_NONCE_LENGTH = 8
+    net = None
+    
+    def __init__(self):
+        worker_interface.WorkerBridge.__init__(self)
+        self.submitted = []
+        self.seen = set()
+        self.get_work_count = 0
+        self.previous_block = 2**200
+    
+    def preprocess_request(self, user, desired_pseudoshare_target=None):
+        return user, desired_pseudoshare_target
+    
+    def get_work(self, user, desired_pseudoshare_target):
+        self.get_work_count += 1
+        return dict(
+            version=0x20000000,
+            previous_block=self.previous_block,
+            merkle_link=dict(branch=[3, 4], index=0),
+            coinb1='coinb1' + user,
+            coinb2='coinb2',
+            timestamp=1400000000,
+            bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**240),
+            share_target=desired_pseudoshare_target or 2**224,
+            share_target_range=(2**216, 2**240),
+        ), self.got_response
+    
+    def got_response(self, header, user, coinbase_nonce, pseudoshare_target=None, got_pseudoshare=None):
+        self.submitted.append((header, user, coinbase_nonce, pseudoshare_target))
+        key = bitcoin_data.block_header_type.pack(header)
+        if key in self.seen: # a duplicate, which doesn't count
+            return False
+        self.seen.add(key)
+        if got_pseudoshare is not None:
+            got_pseudoshare(bitcoin_data.target_to_average_attempts(pseudoshare_target))
+        return True
+
+class FakeTransport(object):
+    def __init__(self):
+        self.data = ''
+    
+    def write(self, data):
+        self.data += data
+    
+    def loseConnection(self):
+        pass
+
+class Test(unittest.TestCase):
+    def test_shared_notify(self):
+        inner = FakeWorkerBridge()
+        wb = worker_interface.CachingWorkerBridge(inner)
+        jobs = stratum.StratumJobs(wb)
+        providers = [stratum.StratumRPCMiningProvider(wb, None, FakeTransport(), jobs) for i in xrange(3)]
+        providers[2].username = 'other'
+        
+        extranonce1s = [p.extranonce1.encode('hex') for p in providers]
+        assert len(set(extranonce1s)) == 3
+        assert all(len(e.decode('hex')) + wb.COINBASE_NONCE_LENGTH == inner.COINBASE_NONCE_LENGTH for e in extranonce1s)
+        
+        for p in providers:
+            p._send_work()
+        assert inner.get_work_count == 2
+        assert providers[0].transport.data == providers[1].transport.data != providers[2].transport.data
+        lines = [json.loads(line) for line in providers[0].transport.data.splitlines()]
+        assert [line['method'] for line in lines] == ['mining.set_difficulty', 'mining.notify']
+        jobid = lines[1]['params'][0]
+        
+        for p in providers[:2]:
+            p.rpc_submit('worker', jobid, '01020304', '00000000', '00000000')
+        (header1, user1, nonce1, target1), (header2, user2, nonce2, target2) = inner.submitted
+        assert (nonce1, nonce2) == (providers[0].extranonce1 + '\x01\x02\x03\x04', providers[1].extranonce1 + '\x01\x02\x03\x04')
+        assert header1['merkle_root'] == bitcoin_data.check_merkle_link(bitcoin_data.hash256('coinb1' + nonce1 + 'coinb2'), dict(branch=[3, 4], index=0))
+        assert header1['merkle_root'] != header2['merkle_root']
+        
+        inner.new_work_event.happened()
+        assert inner.get_work_count == 4
+        assert providers[0].transport.data.count('mining.notify') == 2
+        assert json.loads(providers[0].transport.data.splitlines()[-1])['params'][0] != jobid
+        
+        for p in providers:
+            p.close()
+    
+    @defer.inlineCallbacks
+    def test_notify_scheduler(self):
+        inner = FakeWorkerBridge()
+        wb = worker_interface.CachingWorkerBridge(inner)
+        jobs = stratum.StratumJobs(wb)
+        notifier = stratum.NotifyScheduler(wb)
+        notifier.WINDOW = .2
+        notifier.BATCH_SIZE = 10
+        providers = [stratum.StratumRPCMiningProvider(wb, None, FakeTransport(), jobs, notifier) for i in xrange(100)]
+        for i, p in enumerate(providers):
+            p.username = str(i)
+            p.get_hash_rate = lambda i=i: i
+        def notified():
+            return [p for p in providers if p.transport.data.count('mining.notify') == inner.new_work_event.times]
+        
+        inner.new_work_event.happened() # first work seen counts as a new block
+        assert len(notified()) == 100
+        
+        inner.new_work_event.happened() # same block: the biggest session, whose work shows the block didn't change, and a batch go first
+        assert notified() == providers[-11:]
+        yield deferral.sleep(.5)
+        assert len(notified()) == 100
+        
+        inner.previous_block += 1 # new block: everyone at once
+        inner.new_work_event.happened()
+        assert len(notified()) == 100
+        assert wb.notify_latency.get_count() == 300
+        
+        for p in providers[:50]:
+            p.close()
+        inner.new_work_event.happened()
+        yield deferral.sleep(.5)
+        assert notified() == providers[50:]
+        for p in providers[50:]:
+            p.close()
+        assert not notifier.sessions
+    
+    def test_vardiff(self):
+        vardiff = stratum.VarDiff()
+        for i in xrange(vardiff.RETARGET_SUBMISSIONS - 1):
+            vardiff.got_submission(2**32)
+        assert not vardiff.update() and vardiff.target is None # not enough submissions yet
+        vardiff.got_submission(2**32)
+        vardiff._start = time.time() - vardiff.RETARGET_SUBMISSIONS*vardiff.INTERVAL
+        assert vardiff.update() # one submission of difficulty 1 every INTERVAL
+        assert bitcoin_data.target_to_difficulty(vardiff.target) == 1
+        
+        vardiff._start = time.time() - 5*vardiff.RETARGET_TIME # minutes without submissions
+        assert vardiff.update()
+        assert bitcoin_data.target_to_difficulty(vardiff.target) < 1
+    
+    def test_vardiff_retarget(self):
+        inner = FakeWorkerBridge()
+        wb = worker_interface.CachingWorkerBridge(inner)
+        p = stratum.StratumRPCMiningProvider(wb, None, FakeTransport())
+        p.username = 'user'
+        p._send_work()
+        jobid = json.loads(p.transport.data.splitlines()[-1])['params'][0]
+        assert p.target == 2**224 and wb.stratum_sessions[p.extranonce1] is p
+        
+        for i in xrange(p.vardiff.RETARGET_SUBMISSIONS):
+            p.rpc_submit('user', jobid, '00000000', '00000000', '00000000')
+        assert p.vardiff.target is None # all but the first were duplicates
+        
+        for i in xrange(1, p.vardiff.RETARGET_SUBMISSIONS): # far more often than once every INTERVAL
+            p.rpc_submit('user', jobid, '00000000', '00000000', '%08x' % i)
+        lines = p.transport.data.splitlines()
+        assert [json.loads(line)['method'] for line in lines] == ['mining.set_difficulty', 'mining.notify', 'mining.set_difficulty'] # no new job
+        assert p.vardiff.target < 2**216 and p.target == 2**216 # as hard as this job allows
+        assert set(target for header, user, nonce, target in inner.submitted) == set([2**224])
+        p.rpc_submit('user', jobid, '00000000', '00000000', 'ffffffff')
+        assert inner.submitted[-1][3] == 2**224 # work on this job may still be for the difficulty it came with
+        
+        p._send_work() # jobs from now on come with the new difficulty
+        assert p.x['share_target'] == p.target
+        jobid = json.loads(p.transport.data.splitlines()[-1])['params'][0]
+        p.rpc_submit('user', jobid, '00000000', '00000000', '00000000')
+        assert inner.submitted[-1][3] == p.target
+        p.close()
+        assert not wb.stratum_sessions
@@ -1,14 +1,80 @@
+from __future__ import division
+
+import os
 import random
-import unittest
+import shutil
+import tempfile
+
+from twisted.trial import unittest
 
-from p2pool import data
-from p2pool.bitcoin import data as bitcoin_data
+from p2pool import data, p2p
+from p2pool.bitcoin import data as bitcoin_data, networks
 from p2pool.test.util import test_forest
-from p2pool.util import forest
+from p2pool.util import forest, math
 
 def random_bytes(length):
     return ''.join(chr(random.randrange(2**8)) for i in xrange(length))
 
+net = math.Object(
+    PARENT=networks.nets['bitcoin'],
+    SHARE_PERIOD=30,
+    CHAIN_LENGTH=30,
+    REAL_CHAIN_LENGTH=30,
+    TARGET_LOOKBEHIND=10,
+    SPREAD=3,
+    IDENTIFIER='cca5e24ec6408b1e'.decode('hex'),
+    MIN_TARGET=0,
+    MAX_TARGET=2**256-1,
+)
+
+def make_share(tracker, net, previous_share_hash, i, known_txs):
+    txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=n, script='x'*(n%50))], lock_time=n) for n in (random.randrange(200) for j in xrange(random.randrange(4)))] # small pool so that refs repeat
+    tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in txs]
+    known_txs.update(zip(tx_hashes, txs))
+    share_info, gentx, other_tx_hashes, get_share = data.Share.generate_transaction(
+        tracker=tracker,
+        share_data=dict(
+            previous_share_hash=previous_share_hash,
+            coinbase='\x01\x02',
+            nonce=i,
+            pubkey_hash=random.randrange(5),
+            subsidy=5000000000,
+            donation=random.choice([0, 655, 65535]),
+            stale_info=random.choice([None, 'orphan', 'doa']),
+            desired_version=random.choice([16, 17]),
+        ),
+        block_target=2**240,
+        desired_timestamp=1400000000 + 30*i,
+        desired_target=2**256-1,
+        ref_merkle_link=dict(branch=[], index=0),
+        desired_other_transaction_hashes_and_fees=[(h, None) for h in tx_hashes],
+        net=net,
+        known_txs=known_txs,
+        base_subsidy=5000000000,
+    )
+    for nonce in xrange(i, 2**32, 2**20): # the share target lets about 1 in 65536 hashes fail
+        try:
+            return get_share(dict(
+                version=0x20000000,
+                previous_block=1234,
+                timestamp=1400000000 + 30*i,
+                bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**240),
+                nonce=nonce,
+                merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.hash256(bitcoin_data.tx_id_type.pack(gentx)), bitcoin_data.calculate_merkle_link([None] + other_tx_hashes, 0)),
+            ))
+        except p2p.PeerMisbehavingError:
+            pass
+
+def make_sharechain(net, length):
+    tracker = data.OkayTracker(net)
+    known_txs = {}
+    previous_share_hash = None
+    for i in xrange(length):
+        share = make_share(tracker, net, previous_share_hash, i, known_txs)
+        tracker.add(share)
+        previous_share_hash = share.hash
+    return tracker
+
 class Test(unittest.TestCase):
     def test_hashlink1(self):
         for i in xrange(100):
@@ -39,3 +105,515 @@ class Test(unittest.TestCase):
         for i in xrange(200):
             a = random.randrange(200)
             d(a, random.randrange(a + 1), 1000000*65535)[1]
+    
+    def test_payout_weight_index(self):
+        t = data.OkayTracker(net)
+        index = data.PayoutWeightIndex(t)
+        index.CHECKPOINT_SPACING = 4
+        skip_list = data.WeightsSkipList(t)
+        
+        def make_share(previous_hash):
+            target = random.choice([2**240, 2**241, 2**249 + random.randrange(2**200)])
+            return test_forest.FakeShare(hash=random.randrange(2**256), previous_hash=previous_hash, target=target, max_target=target,
+                new_script=random.randrange(5), share_data=dict(donation=random.choice([0, 1, 655, 65535]), stale_info=None, pubkey_hash=0), desired_version=16)
+        shares = [make_share(None)]
+        for i in xrange(300):
+            shares.append(make_share(random.choice(shares[-3:]).hash))
+        
+        def check():
+            for i in xrange(50):
+                start = random.choice(t.items.keys())
+                max_shares = random.randrange(t.get_height(start) + 1)
+                desired_weight = 65535*random.choice([2**256, random.randrange(100*2**16)])
+                assert index(start, max_shares, desired_weight) == skip_list(start, max_shares, desired_weight)
+        
+        for share in shares[150:]:
+            t.add(share)
+        check()
+        for share in reversed(shares[:150]): # added below checkpoints that were already computed
+            t.add(share)
+        check()
+        for share in shares[:100]:
+            t.remove(share.hash)
+        check()
+        for share in reversed(shares[50:100]):
+            t.add(share)
+        check()
+    
+    def test_payout_weight_index_backwards(self):
+        # shares arriving oldest-last, as in the initial download, extend the checkpoints instead of rebuilding them
+        t = data.OkayTracker(net)
+        index = data.PayoutWeightIndex(t)
+        index.CHECKPOINT_SPACING = 4
+        skip_list = data.WeightsSkipList(t)
+        
+        shares = [test_forest.FakeShare(hash=i, previous_hash=i - 1 if i else None, target=2**249, max_target=2**249,
+            new_script=random.randrange(5), share_data=dict(donation=random.choice([0, 655]), stale_info=None, pubkey_hash=0), desired_version=16) for i in xrange(200)]
+        computed = {}
+        for i in reversed(xrange(0, 200, 20)):
+            for share in reversed(shares[i:i + 20]):
+                t.add(share)
+            for start in [199, random.randrange(i, 200)]:
+                assert index(start, t.get_height(start), 65535*2**256) == skip_list(start, t.get_height(start), 65535*2**256)
+            for share_hash, weights in computed.iteritems():
+                assert index.checkpoints[share_hash][2] is weights
+            computed = dict((share_hash, entry[2]) for share_hash, entry in index.checkpoints.iteritems())
+        assert len(computed) == 50
+    
+    def test_user_stats_window(self):
+        t = data.OkayTracker(net)
+        shares = [test_forest.FakeShare(hash=0, previous_hash=None, target=2**249, max_target=2**249, share_data=dict(pubkey_hash=0, stale_info=None), desired_version=16)]
+        for i in xrange(1, 300):
+            shares.append(test_forest.FakeShare(hash=i, previous_hash=random.choice(shares[-3:]).hash, target=2**249, max_target=2**249,
+                share_data=dict(pubkey_hash=random.randrange(20), stale_info=random.choice([None, None, 'orphan', 'doa'])), desired_version=16))
+        for share in shares:
+            t.add(share)
+        
+        def check(share_hash, length):
+            counts = {}
+            for share in t.get_chain(share_hash, length):
+                c = counts.setdefault(share.share_data['pubkey_hash'], [0, 0])
+                c[0] += 1
+                c[1] += share.share_data['stale_info'] is not None
+            assert t.user_stats.get(share_hash, length) == counts
+        
+        for share in shares: # following a growing chain, as the web interface does with the best share
+            check(share.hash, t.get_height(share.hash))
+        for i in xrange(200): # jumping around between forks
+            share_hash = random.choice(shares).hash
+            check(share_hash, random.randrange(t.get_height(share_hash) + 1))
+        for share in shares[:50]:
+            t.remove(share.hash)
+        for share in shares[50:]:
+            check(share.hash, min(30, t.get_height(share.hash)))
+    
+    def test_window_stats(self):
+        tracker = make_sharechain(net, 60)
+        head = tracker.heads.keys()[0]
+        for i in xrange(100):
+            share_hash = tracker.get_nth_parent_hash(head, random.randrange(30))
+            n = random.randrange(1, tracker.get_height(share_hash) + 1)
+            shares = list(tracker.get_chain(share_hash, n))
+            
+            stales = sum(1 for share in shares if share.share_data['stale_info'] is not None)
+            assert data.get_average_stale_prop(tracker, share_hash, n) == stales/(n + stales)
+            
+            counts = {}
+            for share in shares[:-1]:
+                counts['good'] = counts.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
+                if share.share_data['stale_info'] is not None:
+                    counts[share.share_data['stale_info']] = counts.get(share.share_data['stale_info'], 0) + bitcoin_data.target_to_average_attempts(share.target)
+            assert data.get_stale_counts(tracker, share_hash, n) == counts
+            
+            props = {}
+            for share in shares[:-1]:
+                stale, total = props.get(share.share_data['pubkey_hash'], (0, 0))
+                stale += share.share_data['stale_info'] is not None
+                props[share.share_data['pubkey_hash']] = stale, total + 1 + (share.share_data['stale_info'] is not None)
+            assert data.get_user_stale_props(tracker, share_hash, n) == dict((k, stale/total) for k, (stale, total) in props.iteritems())
+            
+            versions = {}
+            for share in shares:
+                versions[share.desired_version] = versions.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
+            assert data.get_desired_version_counts(tracker, share_hash, n) == versions
+    
+    def test_forward_chain_state(self):
+        tracker = make_sharechain(net, 120)
+        shares = list(tracker.get_chain(tracker.heads.keys()[0], 120 - net.CHAIN_LENGTH - 1))[::-1]
+        
+        state = data.ForwardChainState(tracker, shares[0].hash)
+        for share in shares:
+            state.advance(share)
+            assert share.check(tracker, chain_state=state) == share.check(tracker)
+            for n in [1, 20, min(60, tracker.get_height(share.hash))]:
+                for desired_weight in [65535*5, 65535*1000]: # the first is cut short and goes to the tracker
+                    assert state.get_cumulative_weights(share.hash, n, desired_weight) == tracker.get_cumulative_weights(share.hash, n, desired_weight)
+                assert state.get_desired_version_counts(share.hash, n) == data.get_desired_version_counts(tracker, share.hash, n)
+        
+        tracker.attempt_verify_chain(shares[::-1])
+        assert set(tracker.verified.items) == set(share.hash for share in shares)
+    
+    def test_tx_ref_index(self):
+        tracker = make_sharechain(net, 150)
+        known_txs = {}
+        chain = list(tracker.get_chain(tracker.heads.keys()[0], 150))
+        for fork_point in [chain[3], chain[40], chain[130]]:
+            previous_share_hash = fork_point.hash
+            for i in xrange(5):
+                share = make_share(tracker, net, previous_share_hash, 1000 + i, known_txs)
+                tracker.add(share)
+                previous_share_hash = share.hash
+        
+        def check(share_hash):
+            past_shares = list(tracker.get_chain(share_hash, min(tracker.get_height(share_hash), 110)))
+            share = tracker.items[share_hash]
+            refs = share.iter_transaction_hash_refs()
+            if max([share_count for share_count, tx_count in refs] + [0]) < len(past_shares):
+                assert share.get_other_tx_hashes(tracker) == [past_shares[share_count].new_transaction_hashes[tx_count] for share_count, tx_count in refs]
+            for count in [1, 50, 100]:
+                count = min(count, len(past_shares))
+                tx_hash_to_this = {}
+                for i, past_share in enumerate(past_shares[:count]):
+                    for j, tx_hash in enumerate(past_share.new_transaction_hashes):
+                        if tx_hash not in tx_hash_to_this:
+                            tx_hash_to_this[tx_hash] = [1+i, j]
+                view = tracker.tx_refs.get_tx_hash_to_this(share_hash, count)
+                for tx_hash in known_txs:
+                    assert (tx_hash in view) == (tx_hash in tx_hash_to_this)
+                    if tx_hash in tx_hash_to_this:
+                        assert view[tx_hash] == tx_hash_to_this[tx_hash]
+        
+        hashes = list(tracker.items)
+        for share_hash in [chain[0].hash, chain[1].hash, chain[0].hash] + [random.choice(hashes) for i in xrange(50)]:
+            check(share_hash)
+        
+        # dropping shares out of the window and adding them back
+        tail = chain[-1]
+        tracker.remove(tail.hash)
+        check(chain[-2].hash)
+        tracker.add(tail)
+        check(chain[-2].hash)
+        for share_hash in [random.choice(hashes) for i in xrange(20)]:
+            check(share_hash)
+    
+    def test_generate_template(self):
+        tracker = make_sharechain(net, 40)
+        best = tracker.heads.keys()[0]
+        txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=n, script='y'*n)], lock_time=n) for n in xrange(5)]
+        known_txs = dict((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx) for tx in txs)
+        args = dict(
+            tracker=tracker,
+            block_target=2**240,
+            desired_other_transaction_hashes_and_fees=[(h, 1000) for h in known_txs],
+            net=net,
+            known_txs=known_txs,
+            base_subsidy=5000000000,
+        )
+        template = data.Share.generate_template(previous_share_hash=best, subsidy=5000000000 + 5000, **args)
+        for pubkey_hash in range(5) + [2**160-1]: # both miners already in the payouts and a new one
+            def generate(**extra):
+                share_info, gentx, other_tx_hashes, get_share = data.Share.generate_transaction(
+                    share_data=dict(
+                        previous_share_hash=best,
+                        coinbase='\x01\x02',
+                        nonce=0,
+                        pubkey_hash=pubkey_hash,
+                        subsidy=5000000000 + 5000,
+                        donation=655,
+                        stale_info=None,
+                        desired_version=17,
+                    ),
+                    desired_timestamp=1400000000 + 30*41,
+                    desired_target=2**256//(pubkey_hash + 1),
+                    ref_merkle_link=dict(branch=[], index=0),
+                    **dict(args, **extra)
+                )
+                return share_info, gentx, other_tx_hashes
+            assert generate(template=template) == generate()
+    
+    def test_eviction_index(self):
+        tracker = make_sharechain(net, 40)
+        chain = list(tracker.get_chain(tracker.heads.keys()[0], 40))
+        for i, share in enumerate(chain):
+            share.time_seen = 1000 - i
+        index = data.EvictionIndex(tracker, 30)
+        
+        # a fork that's seen later
+        known_txs = {}
+        previous_share_hash = chain[20].hash
+        for i in xrange(3):
+            share = make_share(tracker, net, previous_share_hash, 100 + i, known_txs)
+            share.time_seen = 2000 + i
+            tracker.add(share)
+            previous_share_hash = share.hash
+        
+        assert index.pop_head(999) is None
+        assert index.pop_head(1000) == chain[0].hash
+        assert index.pop_head(1000) is None
+        tracker.remove(chain[0].hash)
+        assert index.pop_head(1000) == chain[1].hash
+        assert index.pop_head(3000) == previous_share_hash
+        
+        # the fork's head is only 22 above the tail
+        assert index.pop_tail() is None
+        for share in list(tracker.get_chain(previous_share_hash, 3)):
+            tracker.remove(share.hash)
+        for i in xrange(10):
+            assert index.pop_tail() == chain[-1 - i].previous_hash
+            tracker.remove(chain[-1 - i].hash)
+        assert index.pop_tail() is None
+        assert tracker.get_height(chain[1].hash) == 29
+    
+    def test_tx_sizes(self):
+        tracker = data.OkayTracker(net)
+        known_txs = {}
+        previous_share_hash = None
+        for i in xrange(20):
+            share = make_share(tracker, net, previous_share_hash, i, known_txs)
+            tracker.add(share)
+            previous_share_hash = share.hash
+        
+        for share in tracker.items.itervalues():
+            other_txs = [known_txs[tx_hash] for tx_hash in share.get_other_tx_hashes(tracker)]
+            if not other_txs:
+                continue
+            assert share.get_tx_sizes(tracker, {}) is None
+            assert share.tx_sizes is None
+            sizes = share.get_tx_sizes(tracker, known_txs)
+            assert sizes == (
+                sum(len(bitcoin_data.tx_type.pack(tx)) for tx in other_txs),
+                sum(len(bitcoin_data.tx_id_type.pack(tx)) for tx in other_txs),
+                sum(len(bitcoin_data.tx_type.pack(known_txs[tx_hash])) for tx_hash in share.new_transaction_hashes),
+            )
+            assert share.get_tx_sizes(tracker, {}) is sizes # worked out once
+    
+    def test_decorated_heads(self):
+        tracker = make_sharechain(net, 60)
+        known_txs = {}
+        for share in list(tracker.get_chain(tracker.heads.keys()[0], 60))[::-1]:
+            tracker.verified.add(share)
+        
+        def check(previous_block, known_txs):
+            assert tracker.unverified_heads == set(tracker.heads) - set(tracker.verified.heads)
+            for tail_hash in tracker.verified.tails:
+                assert tracker.get_decorated_heads(tail_hash, previous_block, bits, known_txs) == sorted(((
+                    tracker.verified.get_work(tracker.verified.get_nth_parent_hash(h, min(5, tracker.verified.get_height(h)))),
+                    -tracker.items[h].should_punish_reason(previous_block, bits, tracker, known_txs)[0],
+                    -tracker.items[h].time_seen,
+                ), h) for h in tracker.verified.tails[tail_hash])
+        
+        bits = tracker.items[tracker.heads.keys()[0]].header['bits']
+        for i in xrange(100, 160):
+            action = random.randrange(4)
+            if action == 0 and len(tracker.verified.heads) > 1:
+                head_hash = random.choice(list(tracker.verified.heads))
+                if head_hash not in tracker.heads:
+                    continue
+                tracker.verified.remove(head_hash)
+                tracker.remove(head_hash)
+            elif action == 1 and i >= 140: # new shares can't be made on top of a dropped tail, so this comes last
+                # drop the oldest share
+                tail_hash = random.choice(list(tracker.verified.tails))
+                share_hash = random.choice(list(tracker.verified.reverse[tail_hash]))
+                if share_hash not in tracker.verified.heads:
+                    tracker.verified.remove(share_hash)
+                    tracker.remove(share_hash)
+            elif action >= 2:
+                parent_hash = random.choice(list(tracker.verified.items))
+                height, last = tracker.get_height_and_last(parent_hash)
+                if last is not None:
+                    continue
+                share = make_share(tracker, net, parent_hash, i, known_txs)
+                share.peer_addr = random.choice([None, ('127.0.0.1', 9333)])
+                tracker.add(share)
+                if action == 2:
+                    tracker.verified.add(share)
+            check(random.choice([1234, 4321]), random.choice([known_txs, {}]))
+    
+    def test_think_block_heights(self):
+        tracker = make_sharechain(net, 40)
+        for share in list(tracker.get_chain(tracker.heads.keys()[0], 40))[::-1]:
+            tracker.verified.add(share)
+        bits = tracker.items[tracker.heads.keys()[0]].header['bits']
+        
+        calls = []
+        def block_rel_height_func(block_hash):
+            calls.append(block_hash)
+            return -(len(calls) % 3)
+        best = tracker.think(block_rel_height_func, 1234, bits, {})[0]
+        assert best == tracker.heads.keys()[0]
+        assert len(calls) == 1
+        tracker.think(block_rel_height_func, 1234, bits, {})
+        assert len(calls) == 1
+        tracker.think(block_rel_height_func, 4321, bits, {})
+        assert len(calls) == 2
+        assert tracker._score_tail(tracker.verified.tails.keys()[0], block_rel_height_func) == tracker.score(best, lambda block_hash: -2)
+    
+    def test_packed_contents(self):
+        tracker = make_sharechain(net, 5)
+        for share in tracker.items.itervalues():
+            wrapped = share.as_share()
+            assert share.as_share()['contents'] is wrapped['contents'] # packed once
+            assert data.Share.get_dynamic_types(net)['share_type'].unpack(wrapped['contents']) == share.contents
+            
+            loaded = data.load_share(data.share_type.unpack(data.share_type.pack(wrapped)), net, None)
+            assert loaded.hash == share.hash
+            assert loaded.as_share() == wrapped
+            
+            # relaying a loaded share hands back the bytes it came in as
+            packed = loaded.as_share()['contents']
+            loaded.contents = None
+            assert loaded.as_share()['contents'] is packed
+    
+    def test_get_share_hash(self):
+        tracker = make_sharechain(net, 5)
+        for share in tracker.items.itervalues():
+            wrapped = share.as_share()
+            assert data.get_share_hash(wrapped, net) == share.hash
+            self.assertRaises(Exception, data.get_share_hash, dict(wrapped, contents=wrapped['contents'][:-1]), net)
+            self.assertRaises(Exception, data.get_share_hash, dict(wrapped, contents=wrapped['contents'] + '\x00'), net)
+    
+    def test_sharestore(self):
+        tracker = make_sharechain(net, 20)
+        shares = list(tracker.get_chain(tracker.heads.keys()[0], 20))
+        datadir = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(datadir, 'shares.')
+            def load():
+                loaded, verified = {}, set()
+                ss = data.ShareStore(prefix, net, lambda share: loaded.__setitem__(share.hash, share), verified.add)
+                return ss, loaded, verified
+            
+            # old text format gets converted
+            with open(prefix + '0', 'wb') as f:
+                for share in shares[:10]:
+                    f.write('%i %s\n' % (5, data.share_type.pack(share.as_share()).encode('hex')))
+                f.write('%i %x\n' % (2, shares[0].hash))
+            ss, loaded, verified = load()
+            assert set(loaded) == set(share.hash for share in shares[:10])
+            assert verified == set([shares[0].hash])
+            assert not os.path.exists(prefix + '0')
+            
+            for share in shares:
+                ss.add_share(share)
+                ss.add_verified_hash(share.hash)
+            assert ss.get_share(shares[15].hash).as_share() == shares[15].as_share()
+            assert ss.get_share(2**255) is None
+            ss, loaded, verified = load()
+            assert set(loaded) == verified == set(share.hash for share in shares)
+            
+            # index lost, and a record cut off while being written
+            os.remove(prefix + 'index')
+            with open(prefix + 'seg0', 'ab') as f:
+                f.write(ss.record_header.pack(5, 1000, 0) + 'x'*10)
+            ss, loaded, verified = load()
+            assert len(self.flushLoggedErrors(ValueError)) == 1
+            assert set(loaded) == verified == set(share.hash for share in shares)
+            ss.add_share(shares[0])
+            
+            for share in shares:
+                ss.forget_share(share.hash)
+                assert sum(ss.live_counts.itervalues()) == len(ss.desired)
+                ss.forget_verified_share(share.hash)
+            assert not ss.get_segments()
+            ss, loaded, verified = load()
+            assert not loaded and not verified
+        finally:
+            shutil.rmtree(datadir)
+    
+    def test_cold_share_tier(self):
+        tracker = make_sharechain(net, 160)
+        head = tracker.heads.keys()[0]
+        shares = list(tracker.get_chain(head, 160))
+        for share in shares[::-1]:
+            tracker.verified.add(share)
+        before = dict(
+            heights=[(tracker.get_height_and_last(share.hash), tracker.verified.get_height(share.hash), tracker.get_work(share.hash)) for share in shares],
+            weights=tracker.get_cumulative_weights(head, 155, 65535*1000),
+            stats=[getattr(tracker.get_window(tracker.share_stats, head, 160), k) for k in data.ShareStatsDelta.attrs],
+            packed=[share.as_share() for share in shares],
+        )
+        datadir = tempfile.mkdtemp()
+        try:
+            ss = data.ShareStore(os.path.join(datadir, 'shares.'), net, lambda share: None, lambda share_hash: None)
+            for share in shares[:155]: # the oldest 5 aren't saved
+                ss.add_share(share)
+            
+            self.assertRaises(ValueError, data.ColdShareTier, tracker, ss, 119) # would put the last 120 shares' txs on disk
+            tier = data.ColdShareTier(tracker, ss, 120)
+            tier.evict(head)
+            assert tier.evicted == 35
+            for i, share in enumerate(shares):
+                assert isinstance(tracker.items[share.hash], data.ColdShare) == (120 <= i < 155)
+                assert tracker.verified.items[share.hash] is tracker.items[share.hash]
+            tier.evict(head)
+            assert tier.evicted == 35
+            
+            assert [(tracker.get_height_and_last(share.hash), tracker.verified.get_height(share.hash), tracker.get_work(share.hash)) for share in shares] == before['heights']
+            tracker.get_cumulative_weights.checkpoints.clear()
+            assert tracker.get_cumulative_weights(head, 155, 65535*1000) == before['weights']
+            assert [getattr(tracker.get_window(tracker.share_stats, head, 160), k) for k in data.ShareStatsDelta.attrs] == before['stats']
+            assert [share.as_share() for share in tracker.get_chain(head, 160)] == before['packed']
+            
+            cold_share = tracker.items[shares[130].hash]
+            assert cold_share.contents == shares[130].contents # read back from disk
+            assert cold_share.load().hash == shares[130].hash
+            assert cold_share.load() is cold_share.load() # and kept for a while
+            assert cold_share.share_class is type(shares[130])
+            shares[119].check(tracker) # its parent is cold
+            
+            tracker.verified.remove(shares[-1].hash)
+            tracker.remove(shares[-1].hash)
+            assert tracker.get_height(head) == 159
+        finally:
+            shutil.rmtree(datadir)
+    
+    def test_sharestore_compaction(self):
+        tracker = make_sharechain(net, 40)
+        shares = list(tracker.get_chain(tracker.heads.keys()[0], 40))
+        datadir = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(datadir, 'shares.')
+            ss = data.ShareStore(prefix, net, lambda share: None, lambda share_hash: None)
+            ss.max_segment_size = 2000
+            for share in shares:
+                ss.add_share(share)
+                ss.add_verified_hash(share.hash)
+            segments = ss.get_segments()
+            assert len(segments) > 3
+            
+            # keep every fourth share, so that most segments are mostly dead but not deleted
+            kept = set(share.hash for share in shares[::4])
+            for share in shares:
+                if share.hash not in kept:
+                    ss.forget_share(share.hash)
+                ss.forget_verified_share(share.hash)
+            segments = ss.get_segments()
+            size_before = sum(os.path.getsize(ss.get_segment_filename(segment)) for segment in segments)
+            
+            while ss.compact(1000):
+                pass
+            assert ss.compaction_stats['segments'] >= len(segments) - 2
+            assert sum(os.path.getsize(ss.get_segment_filename(segment)) for segment in ss.get_segments()) < size_before/2
+            assert sum(ss.live_bytes.itervalues()) == sum(ss.record_sizes[key] for key in ss.desired)
+            
+            loaded = set()
+            data.ShareStore(prefix, net, lambda share: loaded.add(share.hash), lambda share_hash: None)
+            assert loaded.issuperset(kept) # dead records in segments that weren't worth compacting come back too
+        finally:
+            shutil.rmtree(datadir)
+    
+    def test_tracker_snapshot(self):
+        tracker = make_sharechain(net, 10)
+        for share in tracker.items.itervalues():
+            tracker.verified.add(share)
+        datadir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(datadir, 'tracker_snapshot')
+            assert data.read_tracker_snapshot(filename, net) == {}
+            data.write_tracker_snapshot(filename, tracker, net)
+            checked_hashes = data.read_tracker_snapshot(filename, net)
+            assert checked_hashes == dict((share.hash, (share.gentx_hash, share.pow_hash)) for share in tracker.items.itervalues())
+            
+            prefix = os.path.join(datadir, 'shares.')
+            ss = data.ShareStore(prefix, net, lambda share: None, lambda share_hash: None)
+            for share in tracker.items.itervalues():
+                ss.add_share(share)
+            
+            # loading with the snapshot doesn't recompute the PoW
+            old_pow_func = net.PARENT.POW_FUNC
+            net.PARENT.POW_FUNC = None
+            try:
+                loaded = {}
+                data.ShareStore(prefix, net, lambda share: loaded.__setitem__(share.hash, share), lambda share_hash: None, checked_hashes=checked_hashes)
+            finally:
+                net.PARENT.POW_FUNC = old_pow_func
+            assert set(loaded) == set(tracker.items)
+            assert all(loaded[h].pow_hash == tracker.items[h].pow_hash for h in loaded)
+            
+            with open(filename, 'r+b') as f:
+                f.seek(40)
+                f.write('x')
+            assert data.read_tracker_snapshot(filename, net) == {}
+        finally:
+            shutil.rmtree(datadir)
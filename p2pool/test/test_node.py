@@ -278,3 +278,37 @@ class Test(unittest.TestCase):
         
         yield deferral.sleep(20) # waiting for work_poller to exit
     test_nodes.timeout = 300
+    
+    @defer.inlineCallbacks
+    def test_think_scheduler(self):
+        n = node.Node(None, None, [], [], mynet, think_delay=.1)
+        n.bitcoind_work = variable.Variable(dict(previous_block=1, bits=None))
+        n.known_txs_var = variable.Variable({})
+        n.best_share_var = variable.Variable(None)
+        n.desired_var = variable.Variable(None)
+        n.get_height_rel_highest = lambda share_hash: 0
+        seen_blocks = []
+        def think(get_height_rel_highest, previous_block, bits, known_txs):
+            seen_blocks.append(previous_block)
+            return None, [], [], []
+        n.tracker.think = think
+        
+        n.set_best_share() # first think is for a block not thought about yet
+        assert seen_blocks == [1]
+        
+        for i in xrange(10):
+            n.set_best_share()
+        assert seen_blocks == [1] # coalesced into one think, think_delay from now
+        yield deferral.sleep(.2)
+        assert seen_blocks == [1, 1]
+        assert (n.think_requests, n.thinks) == (11, 2)
+        
+        n.set_best_share()
+        n.bitcoind_work.set(dict(previous_block=2, bits=None))
+        n.set_best_share() # new block: right away, taking the pending think with it
+        assert seen_blocks == [1, 1, 2]
+        n.set_best_share(immediate=True)
+        assert seen_blocks == [1, 1, 2, 2]
+        yield deferral.sleep(.2)
+        assert seen_blocks == [1, 1, 2, 2]
+        assert (n.think_requests, n.thinks) == (14, 4)
@@ -0,0 +1,116 @@
+import pickle
+import struct
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool import networks, p2p, validation
+from p2pool.bitcoin import data as bitcoin_data, networks as bitcoin_networks
+from p2pool.test.test_data import make_sharechain
+from p2pool.util import math, variable
+
+net = math.Object(
+    NAME='validation_test',
+    PARENT=bitcoin_networks.nets['bitcoin'],
+    SHARE_PERIOD=30,
+    CHAIN_LENGTH=30,
+    REAL_CHAIN_LENGTH=30,
+    TARGET_LOOKBEHIND=10,
+    SPREAD=3,
+    IDENTIFIER='cca5e24ec6408b1e'.decode('hex'),
+    MIN_TARGET=0,
+    MAX_TARGET=2**256-1,
+    PREFIX='a1ef0b5a8c3f6d27'.decode('hex'),
+)
+
+def make_bad_pow_share(share):
+    # the share with its nonce changed to one whose PoW doesn't meet its target
+    header = bitcoin_data.block_header_type.pack(share.header)
+    for nonce in xrange(share.header['nonce'] + 1, 2**32):
+        if bitcoin_data.hash256(header[:-4] + struct.pack('<I', nonce)) > share.target:
+            break
+    contents = dict(share.contents, min_header=dict(share.contents['min_header'], nonce=nonce))
+    return dict(type=share.VERSION, contents=share.share_type.pack(contents))
+
+class FakeTransport(object):
+    def __init__(self):
+        self.aborted = False
+
+    def getPeer(self):
+        return math.Object(host='10.0.0.2', port=9333)
+
+    def abortConnection(self):
+        self.aborted = True
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        networks.nets[net.NAME] = net # worker processes look the net up by name
+        tracker = make_sharechain(net, 40)
+        self.shares = list(tracker.get_chain(tracker.heads.keys()[0], 40))
+
+    def tearDown(self):
+        del networks.nets[net.NAME]
+
+    @defer.inlineCallbacks
+    def check_validator(self, validator):
+        wrapped = [share.as_share() for share in self.shares]
+        dfs = [validator.load_shares(wrapped[i:i+7], ('127.0.0.1', 9333), key=i % 2) for i in xrange(0, len(wrapped), 7)]
+        bad_df = validator.load_shares([wrapped[0], dict(type=99, contents='')], None, key=0)
+        bad_pow_df = validator.load_shares([make_bad_pow_share(self.shares[3])], None, key=1)
+
+        res = []
+        for df in dfs:
+            res.extend((yield df))
+        assert [share.hash for share in res] == [share.hash for share in self.shares]
+        assert [share.pow_hash for share in res] == [share.pow_hash for share in self.shares]
+        assert all(share.peer_addr == ('127.0.0.1', 9333) for share in res)
+
+        try:
+            yield bad_df
+        except ValueError:
+            pass
+        else:
+            assert False, 'unknown share type accepted'
+        try:
+            yield bad_pow_df
+        except p2p.PeerMisbehavingError:
+            pass
+        else:
+            assert False, 'share with invalid PoW accepted'
+        assert validator.pending == 0
+
+    def test_inline(self):
+        return self.check_validator(validation.ShareValidator(net))
+
+    @defer.inlineCallbacks
+    def test_pool(self):
+        validator = validation.ShareValidator(net, workers=2, batch_size=3)
+        try:
+            yield self.check_validator(validator)
+        finally:
+            validator.stop()
+
+    def test_unknown_net(self):
+        # a worker that can't find the net fails each share instead of losing the whole batch
+        res = pickle.loads(validation._load_shares('no_such_net', [share.as_share() for share in self.shares[:2]]))
+        assert [ok for ok, value in res] == [False, False]
+        assert all(isinstance(value, KeyError) for ok, value in res)
+
+    def test_bad_share_bans_peer(self):
+        node = math.Object(
+            net=net,
+            traffic_happened=variable.Event(),
+            known_txs_var=variable.Variable({}),
+            known_share_stats=dict(checked=0, dropped=0, dropped_bytes=0),
+            is_share_known=lambda share_hash: False,
+            share_validator=validation.ShareValidator(net),
+            bans={},
+        )
+        proto = p2p.Protocol(node, False)
+        proto.transport = FakeTransport()
+        proto.addr = ('10.0.0.2', 9333)
+        proto.known_txs_cache = {}
+        proto.paused_for_share_validator = False
+        proto.handle_shares([make_bad_pow_share(self.shares[3])])
+        assert proto.transport.aborted
+        assert '10.0.0.2' in node.bans
@@ -98,6 +98,9 @@ def test_tracker(self):
         
         length = random.randrange(a[0])
         assert list(self.get_chain(start, length)) == list(t.get_chain(start, length))
+        
+        n = random.randrange(a[0] + 1)
+        assert self.get_nth_parent_hash(start, n) == t.get_nth_parent_hash(start, n)
 
 def generate_tracker_simple(n):
     t = forest.Tracker(math.shuffled(FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None) for i in xrange(n)))
@@ -132,6 +135,14 @@ class Test(unittest.TestCase):
             res = t.get_nth_parent_hash(a, b)
             assert res == a - b, (a, b, res)
     
+    def test_ancestor_index(self):
+        t = generate_tracker_random(300)
+        skip_list = forest.DistanceSkipList(t)
+        for i in xrange(1000):
+            start = random.choice(t.items.keys())
+            n = random.randrange(t.get_height(start) + 1)
+            assert t.get_nth_parent_hash(start, n) == skip_list(start, n)
+    
     def test_tracker2(self):
         for ii in xrange(20):
             t = generate_tracker_random(random.randrange(100))
@@ -36,3 +36,22 @@ class Test(unittest.TestCase):
             for x in xrange(n + 1):
                 left, right = math.binomial_conf_interval(x, n)
                 assert 0 <= left <= x/n <= right <= 1, (left, right, x, n)
+    
+    def test_histogram(self):
+        h = math.Histogram([.01, .1, 1])
+        assert h.get_count() == 0 and h.get_quantile(.5) is None
+        for value in [.001, .01, .05, .5, .7, 5]:
+            h.add(value)
+        assert h.counts == [2, 1, 2, 1]
+        assert h.get_count() == 6 and h.max == 5
+        assert [h.get_quantile(q) for q in [.1, .5, .8, .99]] == [.01, .1, 1, None]
+    
+    def test_rate_monitor(self):
+        rm = math.RateMonitor(10)
+        for i in xrange(4):
+            rm.add_datum(i) # the first one only starts the clock
+        rm.datums[0] = (rm.datums[0][0] - 20, rm.datums[0][1])
+        datums, dt = rm.get_datums_in_last()
+        assert datums == [2, 3] and rm.datums[0][1] == 2
+        rm.datums = [(ts - 20, datum) for ts, datum in rm.datums]
+        assert rm.get_datums_in_last()[0] == [] and rm.datums == []
@@ -9,3 +9,15 @@ class Test(unittest.TestCase):
             assert t.unpack(t.pack(i)) == i
         for i in xrange(2**36, 2**36+25):
             assert t.unpack(t.pack(i)) == i
+    
+    def test_skip(self):
+        t = pack.ComposedType([
+            ('a', pack.PossiblyNoneType(0, pack.IntType(256))),
+            ('b', pack.VarStrType()),
+            ('c', pack.ListType(pack.IntType(32))),
+            ('d', pack.ListType(pack.VarIntType(), 2)),
+            ('e', pack.FixedStrType(3)),
+        ])
+        data = t.pack(dict(a=None, b='hello', c=[1, 2, 3], d=[1, 2**20, 3, 4], e='xyz')) + 'tail'
+        assert t.skip((data, 0)) == (data, len(data) - 4)
+        self.assertRaises(pack.EarlyEnd, t.skip, (data[:10], 0))
@@ -47,6 +47,41 @@ class DistanceSkipList(TrackerSkipList):
         assert dist == n
         return hash
 
+class AncestorIndex(object):
+    # get_nth_parent_hash with, for each item, pointers to its ancestors 1, 2, 4, 8, ... generations up. pointers are added
+    # when an item is, and ones that couldn't be made then (because ancestors were missing) are filled in when needed
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.jumps = {} # item hash -> [parent hash, grandparent hash, 4th ancestor's hash, ...]
+        
+        for item in tracker.items.itervalues():
+            self.add_item(item)
+        self.tracker.added.watch_weakref(self, lambda self, item: self.add_item(item))
+        self.tracker.removed.watch_weakref(self, lambda self, item: self.jumps.pop(self.tracker._delta_type.get_head(item), None))
+    
+    def add_item(self, item):
+        jumps = [self.tracker._delta_type.get_tail(item)]
+        while jumps[-1] in self.jumps and len(self.jumps[jumps[-1]]) >= len(jumps):
+            jumps.append(self.jumps[jumps[-1]][len(jumps) - 1])
+        self.jumps[self.tracker._delta_type.get_head(item)] = jumps
+    
+    def _get_jump(self, item_hash, level):
+        jumps = self.jumps[item_hash]
+        while len(jumps) <= level:
+            jumps.append(self._get_jump(jumps[-1], len(jumps) - 1))
+        return jumps[level]
+    
+    def __call__(self, item_hash, n):
+        assert n >= 0
+        level = 0
+        while n:
+            if n & 1:
+                item_hash = self._get_jump(item_hash, level)
+            n >>= 1
+            level += 1
+        return item_hash
+
 def get_attributedelta_type(attrs): # attrs: {name: func}
     class ProtoAttributeDelta(object):
         __slots__ = ['head', 'tail'] + attrs.keys()
@@ -234,9 +269,8 @@ class Tracker(object):
         self.remove_special2 = variable.Event()
         self.removed = variable.Event()
         
-        self.get_nth_parent_hash = DistanceSkipList(self)
-        
         self._delta_type = delta_type
+        self.get_nth_parent_hash = AncestorIndex(self)
         self._default_view = TrackerView(self, delta_type)
         
         for item in items:
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division
 
 import __builtin__
+import bisect
 import math
 import random
 import time
@@ -218,10 +219,11 @@ class RateMonitor(object):
     
     def _prune(self):
         start_time = time.time() - self.max_lookback_time
-        for i, (ts, datum) in enumerate(self.datums):
-            if ts > start_time:
-                self.datums[:] = self.datums[i:]
-                return
+        i = 0
+        while i < len(self.datums) and self.datums[i][0] <= start_time:
+            i += 1
+        if i: # only copy when something actually expired
+            del self.datums[:i]
     
     def get_datums_in_last(self, dt=None):
         if dt is None:
@@ -239,6 +241,35 @@ class RateMonitor(object):
         else:
             self.datums.append((t, datum))
 
+class Histogram(object):
+    # bucket i counts the values in (bounds[i-1], bounds[i]]; the last one counts everything above bounds[-1]
+    
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.total = 0
+        self.max = None
+    
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+    
+    def get_count(self):
+        return sum(self.counts)
+    
+    def get_quantile(self, q):
+        # upper bound of the bucket holding the q-quantile; None for the open-ended bucket or when empty
+        count = self.get_count()
+        if not count:
+            return None
+        seen = 0
+        for bound, bucket_count in zip(self.bounds, self.counts):
+            seen += bucket_count
+            if seen >= q*count:
+                return bound
+        return None
+
 def merge_dicts(*dicts):
     res = {}
     for d in dicts: res.update(d)
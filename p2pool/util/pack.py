@@ -74,6 +74,13 @@ class Type(object):
         # No check since obj can have more keys than our type
         return self._pack(obj)
     
+    def skip(self, file):
+        # moves past an item without building it, where the type allows
+        return self.read(file)[1]
+    
+    def get_fixed_size(self):
+        return None # varies
+    
     def packed_size(self, obj):
         if hasattr(obj, '_packed_size') and obj._packed_size is not None:
             type_obj, packed_size = obj._packed_size
@@ -126,6 +133,10 @@ class VarStrType(Type):
         length, file = self._inner_size.read(file)
         return read(file, length)
     
+    def skip(self, file):
+        length, file = self._inner_size.read(file)
+        return read(file, length)[1]
+    
     def write(self, file, item):
         return self._inner_size.write(file, len(item)), item
 
@@ -166,6 +177,16 @@ class ListType(Type):
             res[i], file = self.type.read(file)
         return res, file
     
+    def skip(self, file):
+        length, file = self._inner_size.read(file)
+        length *= self.mul
+        size = self.type.get_fixed_size()
+        if size is not None:
+            return read(file, length*size)[1]
+        for i in xrange(length):
+            file = self.type.skip(file)
+        return file
+    
     def write(self, file, item):
         assert len(item) % self.mul == 0
         file = self._inner_size.write(file, len(item)//self.mul)
@@ -184,6 +205,9 @@ class StructType(Type):
         data, file = read(file, self.length)
         return struct.unpack(self.desc, data)[0], file
     
+    def get_fixed_size(self):
+        return self.length
+    
     def write(self, file, item):
         return file, struct.pack(self.desc, item)
 
@@ -213,6 +237,9 @@ class IntType(Type):
         data, file = read(file, self.bytes)
         return int(b2a_hex(data[::self.step]), 16), file
     
+    def get_fixed_size(self):
+        return self.bytes
+    
     def write(self, file, item, a2b_hex=binascii.a2b_hex):
         if self.bytes == 0:
             return file
@@ -240,6 +267,13 @@ class IPV6AddressType(Type):
 
 _record_types = {}
 
+def _make_record(fields, values):
+    # for unpickling
+    item = get_record(fields)()
+    for k, v in zip(fields, values):
+        item[k] = v
+    return item
+
 def get_record(fields):
     fields = tuple(sorted(fields))
     if 'keys' in fields or '_packed_size' in fields:
@@ -275,6 +309,8 @@ def get_record(fields):
                 raise TypeError()
             def __ne__(self, other):
                 return not (self == other)
+            def __reduce__(self):
+                return _make_record, (fields, tuple(getattr(self, k) for k in fields))
         _record_types[fields] = _Record
     return _record_types[fields]
 
@@ -290,6 +326,11 @@ class ComposedType(Type):
             item[key], file = type_.read(file)
         return item, file
     
+    def skip(self, file):
+        for key, type_ in self.fields:
+            file = type_.skip(file)
+        return file
+    
     def write(self, file, item):
         assert set(item.keys()) >= self.field_names
         for key, type_ in self.fields:
@@ -305,6 +346,9 @@ class PossiblyNoneType(Type):
         value, file = self.inner.read(file)
         return None if value == self.none_value else value, file
     
+    def skip(self, file):
+        return self.inner.skip(file)
+    
     def write(self, file, item):
         if item == self.none_value:
             raise ValueError('none_value used')
@@ -317,6 +361,9 @@ class FixedStrType(Type):
     def read(self, file):
         return read(file, self.length)
     
+    def get_fixed_size(self):
+        return self.length
+    
     def write(self, file, item):
         if len(item) != self.length:
             raise ValueError('incorrect length item!')
@@ -0,0 +1,111 @@
+'''
+Loads shares received from peers, optionally doing the stateless part (unpacking, hash_link, merkle and PoW checks) in a
+pool of worker processes so that big batches don't hold up the reactor. Checks that need the tracker still happen
+afterwards, on the reactor.
+'''
+
+from __future__ import division
+
+import collections
+import multiprocessing
+import pickle
+import signal
+
+from twisted.internet import defer, reactor
+
+from p2pool import data as p2pool_data, networks
+from p2pool.util import variable
+
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent handles ^C and terminates the pool
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) # Pool.terminate relies on this, but the reactor's handler may have been inherited
+
+def _load_shares(net_name, shares):
+    # runs in a worker process. returns a pickled list of (True, (contents, gentx_hash, pow_hash)) or (False, exception)
+    # for each share, see data.load_share
+    res = []
+    for share in shares:
+        try:
+            share_obj = p2pool_data.load_share(share, networks.nets[net_name], None)
+        except Exception, e:
+            try:
+                pickle.dumps(e, 2)
+            except Exception:
+                from p2pool import p2p
+                # keep PeerMisbehavingErrors recognizable, the peer gets banned for those
+                e = (p2p.PeerMisbehavingError if isinstance(e, p2p.PeerMisbehavingError) else ValueError)('%s: %s' % (type(e).__name__, e))
+            res.append((False, e))
+        else:
+            res.append((True, (share_obj.contents, share_obj.gentx_hash, share_obj.pow_hash)))
+    # pickled here so that a failure can't get lost in the pool, which would leave the batch pending forever
+    try:
+        return pickle.dumps(res, 2)
+    except Exception, e:
+        return pickle.dumps([(False, ValueError('error returning share: %r' % (e,)))]*len(shares), 2)
+
+class ShareValidator(object):
+    def __init__(self, net, workers=0, max_pending=5000, batch_size=50):
+        self.net = net
+        self.pool = multiprocessing.Pool(workers, _init_worker) if workers else None
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        
+        self.pending = 0 # shares handed to the pool that haven't been delivered yet
+        self.queues = {} # key -> deque of [deferred, shares, peer_addr, results], in submission order
+        self.room_available = variable.Event()
+    
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+    
+    def is_full(self):
+        return self.pending >= self.max_pending
+    
+    def wait_for_room(self):
+        return self.room_available.get_deferred()
+    
+    def load_shares(self, shares, peer_addr, key=None):
+        # returns a Deferred that fires with the loaded shares, or fails with the first share's error.
+        # results for the same key are delivered in the order they were asked for
+        if self.pool is None:
+            return defer.execute(self._make_shares, shares, peer_addr, None)
+        
+        entry = [defer.Deferred(), shares, peer_addr, None]
+        self.queues.setdefault(key, collections.deque()).append(entry)
+        self.pending += len(shares)
+        
+        chunks = [shares[i:i + self.batch_size] for i in xrange(0, len(shares), self.batch_size)] or [[]]
+        chunk_results = [None]*len(chunks)
+        remaining = [len(chunks)]
+        def got_chunk(i, res):
+            chunk_results[i] = res
+            remaining[0] -= 1
+            if not remaining[0]:
+                entry[3] = sum(map(pickle.loads, chunk_results), [])
+                self._deliver(key)
+        for i, chunk in enumerate(chunks):
+            self.pool.apply_async(_load_shares, (self.net.NAME, chunk), callback=lambda res, i=i: reactor.callFromThread(got_chunk, i, res))
+        return entry[0]
+    
+    def _deliver(self, key):
+        queue = self.queues[key]
+        while queue and queue[0][3] is not None:
+            df, shares, peer_addr, results = queue.popleft()
+            self.pending -= len(shares)
+            defer.maybeDeferred(self._make_shares, shares, peer_addr, results).chainDeferred(df)
+        if not queue:
+            del self.queues[key]
+        if not self.is_full():
+            self.room_available.happened()
+    
+    def _make_shares(self, shares, peer_addr, results):
+        if results is None:
+            return [p2pool_data.load_share(share, self.net, peer_addr) for share in shares]
+        res = []
+        for share, (ok, x) in zip(shares, results):
+            if not ok:
+                raise x
+            contents, gentx_hash, pow_hash = x
+            res.append(p2pool_data.load_share(share, self.net, peer_addr, contents=contents, checked_hashes=(gentx_hash, pow_hash)))
+        return res
@@ -139,6 +139,14 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         for addr in wb.last_work_shares.value:
             miner_last_difficulties[addr] = bitcoin_data.target_to_difficulty(wb.last_work_shares.value[addr].target)
         
+        miner_stratum_sessions = {}
+        for session in wb.stratum_sessions.itervalues():
+            miner_stratum_sessions.setdefault(session.username, []).append(dict(
+                difficulty=bitcoin_data.target_to_difficulty(session.target) if session.target is not None else None,
+                vardiff=session.uses_vardiff(),
+                hash_rate=session.vardiff.hash_rate,
+            ))
+        
         return dict(
             my_hash_rates_in_last_hour=dict(
                 note="DEPRECATED",
@@ -161,6 +169,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             miner_hash_rates=miner_hash_rates,
             miner_dead_hash_rates=miner_dead_hash_rates,
             miner_last_difficulties=miner_last_difficulties,
+            miner_stratum_sessions=miner_stratum_sessions,
             efficiency_if_miner_perfect=(1 - stale_orphan_shares/shares)/(1 - global_stale_prop) if shares else None, # ignores dead shares because those are miner's fault and indicated by pseudoshare rejection
             efficiency=(1 - (stale_orphan_shares+stale_doa_shares)/shares)/(1 - global_stale_prop) if shares else None,
             peers=dict(
@@ -181,6 +190,20 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             version=p2pool.__version__,
             protocol_version=p2p.Protocol.VERSION,
             fee=wb.worker_fee,
+            best_share_selection=dict(
+                requests=node.think_requests,
+                runs=node.thinks,
+                saved=node.think_requests - node.thinks,
+            ),
+            known_shares_dropped=dict(node.p2p_node.known_share_stats),
+            notify_latency=dict(
+                count=wb.notify_latency.get_count(),
+                median=wb.notify_latency.get_quantile(.5),
+                p90=wb.notify_latency.get_quantile(.9),
+                p99=wb.notify_latency.get_quantile(.99),
+                max=wb.notify_latency.max,
+                buckets=zip(wb.notify_latency.bounds + [None], wb.notify_latency.counts), # (upper bound in seconds, count)
+            ),
         )
     
     class WebInterface(deferred_resource.DeferredResource):
@@ -289,6 +312,8 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         if int(share_hash_str, 16) not in node.tracker.items:
             return None
         share = node.tracker.items[int(share_hash_str, 16)]
+        if isinstance(share, p2pool_data.ColdShare):
+            share = share.load()
         
         return dict(
             parent='%064x' % share.previous_hash,
@@ -2,6 +2,7 @@ from __future__ import division
 from collections import deque
 
 import base64
+import itertools
 import random
 import re
 import sys
@@ -22,7 +23,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
     
     def __init__(self, node, my_pubkey_hash, donation_percentage, merged_urls, worker_fee, args, pubkeys, bitcoind):
         worker_interface.WorkerBridge.__init__(self)
-        self.recent_shares_ts_work = []
+        self.recent_shares_ts_work = deque(maxlen=50)
         
         self.node = node
 
@@ -120,6 +121,14 @@ class WorkerBridge(worker_interface.WorkerBridge):
         self.node.best_block_header.changed.watch(lambda _: compute_work())
         compute_work()
         
+        # dropped before new_work_event fires, so the get_work calls it triggers build a fresh template
+        self._work_template = None
+        def _clear_work_template(_):
+            self._work_template = None
+        self.current_work.changed.watch(_clear_work_template)
+        self.merged_work.changed.watch(_clear_work_template)
+        self.node.best_share_var.changed.watch(_clear_work_template)
+        
         self.new_work_event = variable.Event()
         @self.current_work.transitioned.watch
         def _(before, after):
@@ -205,17 +214,18 @@ class WorkerBridge(worker_interface.WorkerBridge):
         
         return user, pubkey_hash, desired_share_target, desired_pseudoshare_target
     
-    def preprocess_request(self, user):
+    def preprocess_request(self, user, desired_pseudoshare_target=None):
+        # desired_pseudoshare_target is the frontend's choice, for when the username doesn't ask for a difficulty
         if (self.node.p2p_node is None or len(self.node.p2p_node.peers) == 0) and self.node.net.PERSIST:
             raise jsonrpc.Error_for_code(-12345)(u'p2pool is not connected to any peers')
         if time.time() > self.current_work.value['last_update'] + 60:
             raise jsonrpc.Error_for_code(-12345)(u'lost contact with bitcoind')
-        user, pubkey_hash, desired_share_target, desired_pseudoshare_target = self.get_user_details(user)
-        return pubkey_hash, desired_share_target, desired_pseudoshare_target
+        user, pubkey_hash, desired_share_target, user_pseudoshare_target = self.get_user_details(user)
+        return pubkey_hash, desired_share_target, user_pseudoshare_target if user_pseudoshare_target is not None else desired_pseudoshare_target
     
     def _estimate_local_hash_rate(self):
         if len(self.recent_shares_ts_work) == 50:
-            hash_rate = sum(work for ts, work in self.recent_shares_ts_work[1:])//(self.recent_shares_ts_work[-1][0] - self.recent_shares_ts_work[0][0])
+            hash_rate = sum(work for ts, work in itertools.islice(self.recent_shares_ts_work, 1, None))//(self.recent_shares_ts_work[-1][0] - self.recent_shares_ts_work[0][0])
             if hash_rate > 0:
                 return hash_rate
         return None
@@ -237,14 +247,13 @@ class WorkerBridge(worker_interface.WorkerBridge):
             addr_hash_rates[datum['pubkey_hash']] = addr_hash_rates.get(datum['pubkey_hash'], 0) + datum['work']/dt
         return addr_hash_rates
  
-    def get_work(self, pubkey_hash, desired_share_target, desired_pseudoshare_target):
-        global print_throttle
-        if (self.node.p2p_node is None or len(self.node.p2p_node.peers) == 0) and self.node.net.PERSIST:
-            raise jsonrpc.Error_for_code(-12345)(u'p2pool is not connected to any peers')
-        if self.node.best_share_var.value is None and self.node.net.PERSIST:
-            raise jsonrpc.Error_for_code(-12345)(u'p2pool is downloading shares')
-        if set(r[1:] if r.startswith('!') else r for r in self.node.bitcoind_work.value['rules']) - set(getattr(self.node.net, 'SOFTFORKS_REQUIRED', [])):
-            raise jsonrpc.Error_for_code(-12345)(u'unknown rule activated')
+    def _get_work_template(self):
+        # the part of get_work that is the same for every miner. it only changes with current_work, merged_work
+        # and the best share (or the height below it, while the chain is still downloading), so it's built
+        # once for each of those and shared by every get_work call until one of them changes
+        height = self.node.tracker.get_height(self.node.best_share_var.value) if self.node.best_share_var.value is not None else 0
+        if self._work_template is not None and self._work_template['height'] == height:
+            return self._work_template
         
         if self.merged_work.value:
             tree, size = bitcoin_data.make_auxpow_tree(self.merged_work.value)
@@ -266,7 +275,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
         if previous_share is None:
             share_type = p2pool_data.Share
         else:
-            previous_share_type = type(previous_share)
+            previous_share_type = previous_share.share_class
             
             if previous_share_type.SUCCESSOR is None or self.node.tracker.get_height(previous_share.hash) < self.node.net.CHAIN_LENGTH:
                 share_type = previous_share_type
@@ -284,6 +293,49 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 else:
                     share_type = previous_share_type
         
+        lookbehind = 3600//self.node.net.SHARE_PERIOD
+        
+        share_template = share_type.generate_template(
+            tracker=self.node.tracker,
+            previous_share_hash=self.node.best_share_var.value,
+            subsidy=self.current_work.value['subsidy'],
+            block_target=self.current_work.value['bits'].target,
+            desired_other_transaction_hashes_and_fees=zip(tx_hashes, self.current_work.value['transaction_fees']),
+            net=self.node.net,
+            known_txs=tx_map,
+            base_subsidy=self.node.net.PARENT.SUBSIDY_FUNC(self.current_work.value['height']),
+        )
+        other_transaction_hashes = share_template['other_transaction_hashes']
+        
+        self._work_template = dict(
+            height=height,
+            share_type=share_type,
+            previous_share_hash=self.node.best_share_var.value,
+            pool_attempts_per_second=p2pool_data.get_pool_attempts_per_second(self.node.tracker, previous_share.hash, lookbehind)
+                if previous_share is not None and height > lookbehind else None,
+            coinbase=(script.create_push_script([
+                self.current_work.value['height'],
+                ] + ([mm_data] if mm_data else []) + [
+            ]) + self.current_work.value['coinbaseflags'])[:100],
+            mm_later=mm_later,
+            share_template=share_template,
+            other_transactions=[tx_map[tx_hash] for tx_hash in other_transaction_hashes],
+            merkle_link=bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0) if not share_template['segwit_activated'] else share_template['segwit_data']['txid_merkle_link'],
+        )
+        return self._work_template
+    
+    def get_work(self, pubkey_hash, desired_share_target, desired_pseudoshare_target):
+        global print_throttle
+        if (self.node.p2p_node is None or len(self.node.p2p_node.peers) == 0) and self.node.net.PERSIST:
+            raise jsonrpc.Error_for_code(-12345)(u'p2pool is not connected to any peers')
+        if self.node.best_share_var.value is None and self.node.net.PERSIST:
+            raise jsonrpc.Error_for_code(-12345)(u'p2pool is downloading shares')
+        if set(r[1:] if r.startswith('!') else r for r in self.node.bitcoind_work.value['rules']) - set(getattr(self.node.net, 'SOFTFORKS_REQUIRED', [])):
+            raise jsonrpc.Error_for_code(-12345)(u'unknown rule activated')
+        
+        work_template = self._get_work_template()
+        share_type, mm_later = work_template['share_type'], work_template['mm_later']
+        
         if desired_share_target is None:
             desired_share_target = 2**256-1
             local_hash_rate = self._estimate_local_hash_rate()
@@ -292,10 +344,9 @@ class WorkerBridge(worker_interface.WorkerBridge):
                     bitcoin_data.average_attempts_to_target(local_hash_rate * self.node.net.SHARE_PERIOD / 0.0167)) # limit to 1.67% of pool shares by modulating share difficulty
             
             local_addr_rates = self.get_local_addr_rates()
-            lookbehind = 3600//self.node.net.SHARE_PERIOD
             block_subsidy = self.node.bitcoind_work.value['subsidy']
-            if previous_share is not None and self.node.tracker.get_height(previous_share.hash) > lookbehind:
-                expected_payout_per_block = local_addr_rates.get(pubkey_hash, 0)/p2pool_data.get_pool_attempts_per_second(self.node.tracker, self.node.best_share_var.value, lookbehind) \
+            if work_template['pool_attempts_per_second'] is not None:
+                expected_payout_per_block = local_addr_rates.get(pubkey_hash, 0)/work_template['pool_attempts_per_second'] \
                     * block_subsidy*(1-self.donation_percentage/100) # XXX doesn't use global stale rate to compute pool hash
                 if expected_payout_per_block < self.node.net.PARENT.DUST_THRESHOLD:
                     desired_share_target = min(desired_share_target,
@@ -306,11 +357,8 @@ class WorkerBridge(worker_interface.WorkerBridge):
             share_info, gentx, other_transaction_hashes, get_share = share_type.generate_transaction(
                 tracker=self.node.tracker,
                 share_data=dict(
-                    previous_share_hash=self.node.best_share_var.value,
-                    coinbase=(script.create_push_script([
-                        self.current_work.value['height'],
-                        ] + ([mm_data] if mm_data else []) + [
-                    ]) + self.current_work.value['coinbaseflags'])[:100],
+                    previous_share_hash=work_template['previous_share_hash'],
+                    coinbase=work_template['coinbase'],
                     nonce=random.randrange(2**32),
                     pubkey_hash=pubkey_hash,
                     subsidy=self.current_work.value['subsidy'],
@@ -326,14 +374,13 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 desired_timestamp=int(time.time() + 0.5),
                 desired_target=desired_share_target,
                 ref_merkle_link=dict(branch=[], index=0),
-                desired_other_transaction_hashes_and_fees=zip(tx_hashes, self.current_work.value['transaction_fees']),
+                desired_other_transaction_hashes_and_fees=None,
                 net=self.node.net,
-                known_txs=tx_map,
-                base_subsidy=self.node.net.PARENT.SUBSIDY_FUNC(self.current_work.value['height']),
+                template=work_template['share_template'],
             )
         
         packed_gentx = bitcoin_data.tx_id_type.pack(gentx) # stratum miners work with stripped transactions
-        other_transactions = [tx_map[tx_hash] for tx_hash in other_transaction_hashes]
+        other_transactions = work_template['other_transactions']
         
         mm_later = [(dict(aux_work, target=aux_work['target'] if aux_work['target'] != 'p2pool' else share_info['bits'].target), index, hashes) for aux_work, index, hashes in mm_later]
         
@@ -345,14 +392,15 @@ class WorkerBridge(worker_interface.WorkerBridge):
                     bitcoin_data.average_attempts_to_target(local_hash_rate * 1)) # limit to 1 share response every second by modulating pseudoshare difficulty
         else:
             target = desired_pseudoshare_target
-        target = max(target, share_info['bits'].target)
-        for aux_work, index, hashes in mm_later:
-            target = max(target, aux_work['target'])
-        target = math.clip(target, self.node.net.PARENT.SANE_TARGET_RANGE)
+        # no harder than the share and merged targets, so that every share and merged block gets submitted
+        min_target = max([share_info['bits'].target] + [aux_work['target'] for aux_work, index, hashes in mm_later])
+        sane_low, sane_high = self.node.net.PARENT.SANE_TARGET_RANGE
+        target_range = min(max(min_target, sane_low), sane_high), sane_high
+        target = math.clip(target, target_range)
         
         getwork_time = time.time()
         lp_count = self.new_work_event.times
-        merkle_link = bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0) if share_info.get('segwit_data', None) is None else share_info['segwit_data']['txid_merkle_link']
+        merkle_link = work_template['merkle_link']
         
         if print_throttle is 0.0:
             print_throttle = time.time()
@@ -379,106 +427,117 @@ class WorkerBridge(worker_interface.WorkerBridge):
             timestamp=self.current_work.value['time'],
             bits=self.current_work.value['bits'],
             share_target=target,
+            share_target_range=target_range, # for frontends that change a worker's difficulty mid-job
         )
         
         received_header_hashes = set()
+        solution_target = max([ba['bits'].target, share_info['bits'].target] + [aux_work['target'] for aux_work, index, hashes in mm_later]) # anything above this is only a pseudoshare
+        users = {} # username -> user, parsed once per job
         
-        def got_response(header, user, coinbase_nonce):
+        def got_response(header, user, coinbase_nonce, pseudoshare_target=None, got_pseudoshare=None):
             assert len(coinbase_nonce) == self.COINBASE_NONCE_LENGTH
-            new_packed_gentx = packed_gentx[:-self.COINBASE_NONCE_LENGTH-4] + coinbase_nonce + packed_gentx[-4:] if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else packed_gentx
-            new_gentx = bitcoin_data.tx_type.unpack(new_packed_gentx) if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else gentx
-            if bitcoin_data.is_segwit_tx(gentx): # reintroduce witness data to the gentx produced by stratum miners
-                new_gentx['marker'] = 0
-                new_gentx['flag'] = gentx['flag']
-                new_gentx['witness'] = gentx['witness']
-            
-            header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(header))
-            pow_hash = self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header))
-            try:
-                if pow_hash <= header['bits'].target or p2pool.DEBUG:
-                    helper.submit_block(dict(header=header, txs=[new_gentx] + other_transactions), False, self.node.factory, self.node.bitcoind, self.node.bitcoind_work, self.node.net)
-                    if pow_hash <= header['bits'].target:
-                        print
-                        print 'GOT BLOCK FROM MINER! Passing to bitcoind! %s%064x' % (self.node.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, header_hash)
-                        print
-            except:
-                log.err(None, 'Error while processing potential block:')
+            packed_header = bitcoin_data.block_header_type.pack(header)
+            pow_hash = self.node.net.PARENT.POW_FUNC(packed_header)
+            header_hash = pow_hash if self.node.net.PARENT.POW_FUNC is bitcoin_data.hash256 else bitcoin_data.hash256(packed_header)
             
-            user, _, _, _ = self.get_user_details(user)
+            if user not in users:
+                users[user] = self.get_user_details(user)[0]
+            user = users[user]
             assert header['previous_block'] == ba['previous_block']
-            assert header['merkle_root'] == bitcoin_data.check_merkle_link(bitcoin_data.hash256(new_packed_gentx), merkle_link)
             assert header['bits'] == ba['bits']
             
             on_time = self.new_work_event.times == lp_count
             
-            for aux_work, index, hashes in mm_later:
+            if pow_hash <= solution_target or p2pool.DEBUG: # only now is the gentx worth rebuilding
+                new_packed_gentx = packed_gentx[:-self.COINBASE_NONCE_LENGTH-4] + coinbase_nonce + packed_gentx[-4:] if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else packed_gentx
+                new_gentx = bitcoin_data.tx_type.unpack(new_packed_gentx) if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else gentx
+                if bitcoin_data.is_segwit_tx(gentx): # reintroduce witness data to the gentx produced by stratum miners
+                    new_gentx['marker'] = 0
+                    new_gentx['flag'] = gentx['flag']
+                    new_gentx['witness'] = gentx['witness']
+                
                 try:
-                    if pow_hash <= aux_work['target'] or p2pool.DEBUG:
-                        df = deferral.retry('Error submitting merged block: (will retry)', 10, 10)(aux_work['merged_proxy'].rpc_getauxblock)(
-                            pack.IntType(256, 'big').pack(aux_work['hash']).encode('hex'),
-                            bitcoin_data.aux_pow_type.pack(dict(
-                                merkle_tx=dict(
-                                    tx=new_gentx,
-                                    block_hash=header_hash,
-                                    merkle_link=merkle_link,
-                                ),
-                                merkle_link=bitcoin_data.calculate_merkle_link(hashes, index),
-                                parent_block_header=header,
-                            )).encode('hex'),
-                        )
-                        @df.addCallback
-                        def _(result, aux_work=aux_work):
-                            if result != (pow_hash <= aux_work['target']):
-                                print >>sys.stderr, 'Merged block submittal result: %s Expected: %s' % (result, pow_hash <= aux_work['target'])
-                            else:
-                                print 'Merged block submittal result: %s' % (result,)
-                        @df.addErrback
-                        def _(err):
-                            log.err(err, 'Error submitting merged block:')
+                    if pow_hash <= header['bits'].target or p2pool.DEBUG:
+                        helper.submit_block(dict(header=header, txs=[new_gentx] + other_transactions), False, self.node.factory, self.node.bitcoind, self.node.bitcoind_work, self.node.net)
+                        if pow_hash <= header['bits'].target:
+                            print
+                            print 'GOT BLOCK FROM MINER! Passing to bitcoind! %s%064x' % (self.node.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, header_hash)
+                            print
                 except:
-                    log.err(None, 'Error while processing merged mining POW:')
-            
-            if pow_hash <= share_info['bits'].target and header_hash not in received_header_hashes:
-                last_txout_nonce = pack.IntType(8*self.COINBASE_NONCE_LENGTH).unpack(coinbase_nonce)
-                share = get_share(header, last_txout_nonce)
+                    log.err(None, 'Error while processing potential block:')
                 
-                print 'GOT SHARE! %s %s prev %s age %.2fs%s' % (
-                    user,
-                    p2pool_data.format_hash(share.hash),
-                    p2pool_data.format_hash(share.previous_hash),
-                    time.time() - getwork_time,
-                    ' DEAD ON ARRIVAL' if not on_time else '',
-                )
-                self.my_share_hashes.add(share.hash)
-                if not on_time:
-                    self.my_doa_share_hashes.add(share.hash)
+                assert header['merkle_root'] == bitcoin_data.check_merkle_link(bitcoin_data.hash256(new_packed_gentx), merkle_link)
                 
-                self.node.tracker.add(share)
-                self.node.set_best_share()
+                for aux_work, index, hashes in mm_later:
+                    try:
+                        if pow_hash <= aux_work['target'] or p2pool.DEBUG:
+                            df = deferral.retry('Error submitting merged block: (will retry)', 10, 10)(aux_work['merged_proxy'].rpc_getauxblock)(
+                                pack.IntType(256, 'big').pack(aux_work['hash']).encode('hex'),
+                                bitcoin_data.aux_pow_type.pack(dict(
+                                    merkle_tx=dict(
+                                        tx=new_gentx,
+                                        block_hash=header_hash,
+                                        merkle_link=merkle_link,
+                                    ),
+                                    merkle_link=bitcoin_data.calculate_merkle_link(hashes, index),
+                                    parent_block_header=header,
+                                )).encode('hex'),
+                            )
+                            @df.addCallback
+                            def _(result, aux_work=aux_work):
+                                if result != (pow_hash <= aux_work['target']):
+                                    print >>sys.stderr, 'Merged block submittal result: %s Expected: %s' % (result, pow_hash <= aux_work['target'])
+                                else:
+                                    print 'Merged block submittal result: %s' % (result,)
+                            @df.addErrback
+                            def _(err):
+                                log.err(err, 'Error submitting merged block:')
+                    except:
+                        log.err(None, 'Error while processing merged mining POW:')
                 
-                try:
-                    if (pow_hash <= header['bits'].target or p2pool.DEBUG) and self.node.p2p_node is not None:
-                        self.node.p2p_node.broadcast_share(share.hash)
-                except:
-                    log.err(None, 'Error forwarding block solution:')
+                if pow_hash <= share_info['bits'].target and header_hash not in received_header_hashes:
+                    last_txout_nonce = pack.IntType(8*self.COINBASE_NONCE_LENGTH).unpack(coinbase_nonce)
+                    share = get_share(header, last_txout_nonce)
+                    
+                    print 'GOT SHARE! %s %s prev %s age %.2fs%s' % (
+                        user,
+                        p2pool_data.format_hash(share.hash),
+                        p2pool_data.format_hash(share.previous_hash),
+                        time.time() - getwork_time,
+                        ' DEAD ON ARRIVAL' if not on_time else '',
+                    )
+                    self.my_share_hashes.add(share.hash)
+                    if not on_time:
+                        self.my_doa_share_hashes.add(share.hash)
+                    
+                    self.node.tracker.add(share)
+                    self.node.set_best_share(immediate=True) # our own share goes out to peers, and our miners onto it, right away
+                    
+                    try:
+                        if (pow_hash <= header['bits'].target or p2pool.DEBUG) and self.node.p2p_node is not None:
+                            self.node.p2p_node.broadcast_share(share.hash)
+                    except:
+                        log.err(None, 'Error forwarding block solution:')
+                    
+                    self.share_received.happened(bitcoin_data.target_to_average_attempts(share.target), not on_time, share.hash)
                 
-                self.share_received.happened(bitcoin_data.target_to_average_attempts(share.target), not on_time, share.hash)
-            
-            if pow_hash > target:
+            submit_target = target if pseudoshare_target is None else math.clip(pseudoshare_target, target_range)
+            if pow_hash > submit_target:
                 print 'Worker %s submitted share with hash > target:' % (user,)
                 print '    Hash:   %56x' % (pow_hash,)
-                print '    Target: %56x' % (target,)
+                print '    Target: %56x' % (submit_target,)
             elif header_hash in received_header_hashes:
                 print >>sys.stderr, 'Worker %s submitted share more than once!' % (user,)
             else:
                 received_header_hashes.add(header_hash)
                 
-                self.pseudoshare_received.happened(bitcoin_data.target_to_average_attempts(target), not on_time, user)
-                self.recent_shares_ts_work.append((time.time(), bitcoin_data.target_to_average_attempts(target)))
-                while len(self.recent_shares_ts_work) > 50:
-                    self.recent_shares_ts_work.pop(0)
-                self.local_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(target), dead=not on_time, user=user, share_target=share_info['bits'].target))
-                self.local_addr_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(target), pubkey_hash=pubkey_hash))
+                work = bitcoin_data.target_to_average_attempts(submit_target)
+                self.pseudoshare_received.happened(work, not on_time, user)
+                self.recent_shares_ts_work.append((time.time(), work))
+                self.local_rate_monitor.add_datum(dict(work=work, dead=not on_time, user=user, share_target=share_info['bits'].target))
+                self.local_addr_rate_monitor.add_datum(dict(work=work, pubkey_hash=pubkey_hash))
+                if got_pseudoshare is not None: # lets stratum's vardiff count only work that was accepted
+                    got_pseudoshare(work)
             
             return on_time
         
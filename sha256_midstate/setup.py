@@ -0,0 +1,9 @@
+from distutils.core import setup, Extension
+
+sha256_midstate_module = Extension('sha256_midstate',
+                               sources = ['sha256module.c'])
+
+setup (name = 'sha256_midstate',
+       version = '1.0',
+       description = 'SHA-256 compression function with resumable midstate, used by p2pool for hash_link checking',
+       ext_modules = [sha256_midstate_module])
@@ -0,0 +1,93 @@
+#include <Python.h>
+
+#include <stdint.h>
+#include <string.h>
+
+static const uint32_t k[64] = {
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+};
+
+#define ROTR(x, n) (((x) >> (n)) | ((x) << (32 - (n))))
+
+static uint32_t load_be32(const unsigned char *p)
+{
+    return ((uint32_t)p[0] << 24) | ((uint32_t)p[1] << 16) | ((uint32_t)p[2] << 8) | (uint32_t)p[3];
+}
+
+static void store_be32(unsigned char *p, uint32_t x)
+{
+    p[0] = x >> 24; p[1] = x >> 16; p[2] = x >> 8; p[3] = x;
+}
+
+static void compress(uint32_t state[8], const unsigned char *chunk)
+{
+    uint32_t w[64];
+    uint32_t a, b, c, d, e, f, g, h, t1, t2;
+    int i;
+
+    for (i = 0; i < 16; i++)
+        w[i] = load_be32(chunk + 4*i);
+    for (i = 16; i < 64; i++) {
+        uint32_t s0 = ROTR(w[i-15], 7) ^ ROTR(w[i-15], 18) ^ (w[i-15] >> 3);
+        uint32_t s1 = ROTR(w[i-2], 17) ^ ROTR(w[i-2], 19) ^ (w[i-2] >> 10);
+        w[i] = w[i-16] + s0 + w[i-7] + s1;
+    }
+
+    a = state[0]; b = state[1]; c = state[2]; d = state[3];
+    e = state[4]; f = state[5]; g = state[6]; h = state[7];
+    for (i = 0; i < 64; i++) {
+        t1 = h + (ROTR(e, 6) ^ ROTR(e, 11) ^ ROTR(e, 25)) + ((e & f) ^ (~e & g)) + k[i] + w[i];
+        t2 = (ROTR(a, 2) ^ ROTR(a, 13) ^ ROTR(a, 22)) + ((a & b) ^ (a & c) ^ (b & c));
+        h = g; g = f; f = e; e = d + t1;
+        d = c; c = b; b = a; a = t1 + t2;
+    }
+    state[0] += a; state[1] += b; state[2] += c; state[3] += d;
+    state[4] += e; state[5] += f; state[6] += g; state[7] += h;
+}
+
+static PyObject *sha256_process_blocks(PyObject *self, PyObject *args)
+{
+    const unsigned char *state_str, *data;
+    int state_len, data_len, i;
+    uint32_t state[8];
+    unsigned char output[32];
+
+    if (!PyArg_ParseTuple(args, "s#s#", &state_str, &state_len, &data, &data_len))
+        return NULL;
+    if (state_len != 32) {
+        PyErr_SetString(PyExc_ValueError, "state must be 32 bytes");
+        return NULL;
+    }
+    if (data_len % 64 != 0) {
+        PyErr_SetString(PyExc_ValueError, "data length must be a multiple of 64 bytes");
+        return NULL;
+    }
+
+    for (i = 0; i < 8; i++)
+        state[i] = load_be32(state_str + 4*i);
+
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < data_len; i += 64)
+        compress(state, data + i);
+    Py_END_ALLOW_THREADS
+
+    for (i = 0; i < 8; i++)
+        store_be32(output + 4*i, state[i]);
+    return Py_BuildValue("s#", output, 32);
+}
+
+static PyMethodDef Sha256Methods[] = {
+    { "process_blocks", sha256_process_blocks, METH_VARARGS, "Runs the SHA-256 compression function over whole 64-byte blocks, starting from and returning a 32-byte midstate" },
+    { NULL, NULL, 0, NULL }
+};
+
+PyMODINIT_FUNC initsha256_midstate(void) {
+    (void) Py_InitModule("sha256_midstate", Sha256Methods);
+}